@@ -1,129 +1,413 @@
+import json
 import math
-from pygeodesy.sphericalNvector import LatLon
-from sgqlc.endpoint.http import HTTPEndpoint
-from statistics import mean
-import threading
+import sys
+import time
 
 from algorithms.helpers.node import Node
 import config
+from geo_transform import GpsTransform
+from publisher import Publisher
+from spool import Spool
+
+###################
+# Mutation fields #
+###################
+# The input object of an updateNode mutation is built from these pieces, so the
+# same strings can go into a single mutation, a batch of aliased ones (one
+# request per cycle) or anywhere else they need to be kept.
+
+NODE_FIELDS = 'type: %s name: %s'
+POSITION_FIELDS = 'position: {lat: %.6f lon: %.6f accuracy: %.3f}'
+ORIENTATION_FIELDS = 'orientation: {heading: %.2f source: %s}'
+TELEMETRY_FIELDS = 'telemetry: {temp: %.2f batt: %.2f}'
+UPDATE_NODE = '%supdateNode(id: %s, node: {%s}) { id }'
+
+
+def node_input(node_fields, position=None, orientation=None, telemetry=None):
+    # Joins the pieces of one node into the contents of its input object
+    parts = [node_fields]
+    if position is not None or orientation is not None:
+        parts.append('pose: {%s}' % ' '.join(p for p in (position, orientation) if p is not None))
+    if telemetry is not None:
+        parts.append(telemetry)
+    return ' '.join(parts)
+
+
+def update_mutation(updates):
+    # One mutation document for [(node_id, input contents), ...]. Several
+    # updates get aliased as n<id>, n<id>_1, ... so they fit in one request.
+    if len(updates) == 1:
+        node_id, contents = updates[0]
+        return 'mutation { %s }' % (UPDATE_NODE % ('', json.dumps(node_id), contents))
+    fields = []
+    aliases = set()
+    for node_id, contents in updates:
+        alias = 'n' + ''.join(c if c.isalnum() else '_' for c in node_id)
+        while alias in aliases:
+            alias += '_1'
+        aliases.add(alias)
+        fields.append(UPDATE_NODE % (alias + ': ', json.dumps(node_id), contents))
+    return 'mutation {\n  %s\n}' % '\n  '.join(fields)
+
+
+##############
+# Coalescing #
+##############
+# Holds the newest pending update of each kind per node (a newer one replaces
+# it) and decides when it is worth sending:
+#   - position updates are dropped unless the node moved more than 'min_move' or
+#     its guess radius changed more than 'min_radius_change' since the last one
+#     that was sent, or that was more than 'heartbeat' secs ago
+#   - a node gets at most one update of each kind every 'node_interval' secs and
+#     all nodes together at most 'max_rate' per sec; anything over that waits
+#
+# Position payloads are the node objects themselves, so a waiting update always
+# goes out with the node's latest state.
+
+POSITION = 'position'
+TELEMETRY = 'telemetry'
+
+
+class UpdateCoalescer:
+    def __init__(self, min_move=config.BACKEND_MIN_MOVE, min_radius_change=config.BACKEND_MIN_RADIUS_CHANGE,
+                 node_interval=config.BACKEND_NODE_INTERVAL, max_rate=config.BACKEND_MAX_RATE,
+                 heartbeat=config.BACKEND_HEARTBEAT):
+        self.min_move = min_move
+        self.min_radius_change = min_radius_change
+        self.node_interval = node_interval
+        self.max_rate = max_rate
+        self.heartbeat = heartbeat
+        self.pending = {}  # {(kind, node_id): payload}
+        self.last_sent = {}  # {(kind, node_id): (time, x, y, radius)}
+        self.tokens = max_rate
+        self.refilled = time.time()
+
+        # Counters
+        self.offered_ctr = 0
+        self.coalesced_ctr = 0  # Replaced by a newer update before being sent
+        self.suppressed_ctr = 0  # Didn't change enough
+        self.deferred_ctr = 0  # Held back by a rate limit (counted every time)
+        self.heartbeat_ctr = 0  # Sent only because of the heartbeat
+        self.sent_ctr = 0
+
+    def offer(self, kind, node_id, payload):
+        key = (kind, node_id)
+        if key in self.pending:
+            self.coalesced_ctr += 1
+        self.pending[key] = payload
+        self.offered_ctr += 1
+
+    def take(self, force=False):
+        # Returns {(kind, node_id): payload} of everything that should be sent now.
+        # 'force' ignores the rate limits, for flushing on shutdown.
+        now = time.time()
+        self.tokens = min(self.max_rate, self.tokens + (now - self.refilled) * self.max_rate)
+        self.refilled = now
+        ready = {}
+        for key, payload in list(self.pending.items()):
+            if key[0] == POSITION:
+                position = (payload.x, payload.y, payload.get_guess_radius())
+            else:
+                position = ()
+            last = self.last_sent.get(key)
+            heartbeat = False
+            if last is not None:
+                age = now - last[0]
+                if position and not self._changed(last[1:], position):
+                    if age < self.heartbeat:
+                        del self.pending[key]
+                        self.suppressed_ctr += 1
+                        continue
+                    heartbeat = True
+                if age < self.node_interval and not force:
+                    self.deferred_ctr += 1
+                    continue
+            if self.tokens < 1 and not force:
+                self.deferred_ctr += 1
+                continue
+            self.tokens -= 1
+            del self.pending[key]
+            self.last_sent[key] = (now,) + position
+            self.heartbeat_ctr += heartbeat
+            ready[key] = payload
+        self.sent_ctr += len(ready)
+        return ready
+
+    def _changed(self, last, position):
+        x, y, radius = last
+        new_x, new_y, new_radius = position
+        if x is None or new_x is None:
+            return (x, y) != (new_x, new_y)
+        return (math.hypot(new_x - x, new_y - y) > self.min_move or
+                abs(new_radius - radius) > self.min_radius_change)
+
+    def stats(self):
+        return {
+            'offered': self.offered_ctr,
+            'coalesced': self.coalesced_ctr,
+            'suppressed': self.suppressed_ctr,
+            'deferred': self.deferred_ctr,
+            'heartbeats': self.heartbeat_ctr,
+            'sent_updates': self.sent_ctr,
+            'pending': len(self.pending),
+        }
 
 
 class Backend:
-    def __init__(self, anchored_base_id, calculated_base_id):
+    def __init__(self, anchored_base_id, calculated_base_id, telemetry=None):
         self.anchored_base_id = anchored_base_id
         self.calculated_base_id = calculated_base_id
         self.anchored_base_node: Node = None
         self.calculated_base_node: Node = None
-        self.endpoint = HTTPEndpoint(config.BACKEND_URL) if config.ENABLE_BACKEND else lambda x: None
+        self.gps = GpsTransform()
+        self.publisher = None
+        self.spool = None
+        if config.ENABLE_BACKEND and config.BACKEND_SPOOL:
+            self.spool = Spool(update_mutation, config.SPOOL_PATH, config.BACKEND_URL)
+        elif config.ENABLE_BACKEND:
+            self.publisher = Publisher(config.BACKEND_URL)
+        self.batch = config.BACKEND_BATCH
+        # Telemetry for the next batch: {node_id: (node fields, orientation, telemetry)}, or with a
+        # TelemetryStore {node_id: (node, source)} and the values are read from the store when it is sent
+        self.pending_telemetry = {}
+        self.telemetry = telemetry
+        self.coalescer = UpdateCoalescer() if config.BACKEND_COALESCE else None
 
-    def clear_nodes(self):
-        mutation = \
-            """
-            mutation {
-              clearNodes
-            }       
-            """
-        threading.Thread(target=lambda: self.endpoint(mutation)).start()
+        # Counters
+        self.request_ctr = 0
+        self.update_ctr = 0
+        self.byte_ctr = 0
 
-    def update_node(self, node):
-        if not node.is_resolved():
+    def send(self, mutation, key=None, updates=1):
+        # Mutations with the same key (node ID) are sent in order, see publisher.py
+        self.request_ctr += 1
+        self.update_ctr += updates
+        self.byte_ctr += len(mutation)
+        if self.publisher is not None:
+            self.publisher.publish(mutation, key=key)
+
+    def send_updates(self, updates, key=None):
+        # [(node_id, kind, contents), ...] as one request, or into the spool
+        if self.spool is not None:
+            self.update_ctr += len(updates)
+            self.spool.add(updates)
             return
+        self.send(update_mutation([(node_id, contents) for node_id, _, contents in updates]), key=key,
+                  updates=len(updates))
 
+    def close(self):
+        # Sends whatever is still queued
+        if self.coalescer is not None:
+            self.send_due(force=True)
+        self.flush_telemetry()
+        if self.publisher is not None:
+            self.publisher.close()
+        if self.spool is not None:
+            self.spool.close()
+
+    def stats(self):
+        stats = {
+            'requests': self.request_ctr,
+            'updates': self.update_ctr,
+            'mutation_bytes': self.byte_ctr,
+        }
+        if self.coalescer is not None:
+            stats.update(self.coalescer.stats())
+        if self.publisher is not None:
+            stats.update(self.publisher.stats())
+        if self.spool is not None:
+            stats.update(self.spool.stats())
+        return stats
+
+    def clear_nodes(self):
         mutation = \
             """
             mutation {
-              updateNode(id: "%(id)s", node: {
-                type: %(type)s
-                name: "%(name)s"
-                pose: {
-                  position: {
-                    lat: %(lat).6f
-                    lon: %(lon).6f
-                    accuracy: %(accuracy).3f
-                  }
-                }
-              }) {
-                id
-              }
+              clearNodes
             }
             """
+        if self.spool is not None:
+            self.spool.clear(mutation)
+            return
+        self.send(mutation, updates=0)
 
+    def node_fields(self, node):
+        return NODE_FIELDS % ('BASE' if node.is_base else 'MOBILE', json.dumps(node.name))
+
+    def position_fields(self, node, gps=None):
+        # 'gps' is the (lat, lon) of the node if it has already been translated
         if node.id == self.anchored_base_id:
             self.anchored_base_node = node
             lat, lon = config.ANCHORED_BASE_GPS
-        elif node.id == self.calculated_base_id:
-            self.calculated_base_node = node
-            # lat, lon = config.CALCULATED_BASE_GPS  # could do this, but can also be sanity check for GPS translator
-            lat, lon = self.translate_node_to_gps_coords(node)
         else:
-            lat, lon = self.translate_node_to_gps_coords(node)
-
-        mutation = mutation % {
-            'id': node.id,
-            'name': node.name,
-            'type': 'BASE' if node.is_base else 'MOBILE',
-            'lat': lat,
-            'lon': lon,
-            'accuracy': node.get_guess_radius()
-        }
-        threading.Thread(target=lambda: self.endpoint(mutation)).start()
+            # The calculated base is translated too, instead of using config.CALCULATED_BASE_GPS, as a sanity check
+            lat, lon = gps or self.translate_node_to_gps_coords(node)
+        return POSITION_FIELDS % (lat, lon, node.get_guess_radius())
+
+    def node_update(self, node_id, node=None, telemetry=None, gps=None):
+        # (node_id, kind, contents) of an update with the position of 'node' and/or
+        # 'telemetry' fields (node fields, orientation, telemetry)
+        if telemetry is None:
+            return node_id, POSITION, node_input(self.node_fields(node), position=self.position_fields(node, gps))
+        node_fields, orientation, fields = telemetry
+        if node is None:
+            return node_id, TELEMETRY, node_input(node_fields, orientation=orientation, telemetry=fields)
+        return node_id, POSITION + ',' + TELEMETRY, node_input(node_fields, self.position_fields(node, gps),
+                                                               orientation, fields)
+
+    def update_node(self, node):
+        if not node.is_resolved():
+            return
+        if self.coalescer is not None:
+            self.coalescer.offer(POSITION, node.id, node)
+            if not self.batch:
+                self.send_due()
+            return
+        self.send_updates([self.node_update(node.id, node=node)], key=node.id)
+
+    def telemetry_fields(self, node, temp, batt, heading, source="TELEMETRY"):
+        return self.node_fields(node), ORIENTATION_FIELDS % (heading, source), TELEMETRY_FIELDS % (temp, batt)
 
     def update_node_telemetry(self, node, temp, batt, heading, source="TELEMETRY"):
-        mutation = \
-            """
-            mutation {
-              updateNode(id: "%(id)s", node: {
-                type: %(type)s
-                name: "%(name)s"
-                pose: {
-                  orientation: {
-                    heading: %(heading).2f
-                    source: %(source)s
-                  }
-                }
-                telemetry: {
-                  temp: %(temp).2f
-                  batt: %(batt).2f
-                }
-              }) {
-                id
-              }
-            }
-            """
+        if self.batch and self.coalescer is None:
+            # Goes out with the next cycle
+            if self.telemetry is not None:
+                self.pending_telemetry[node.id] = (node, source)
+            else:
+                self.pending_telemetry[node.id] = self.telemetry_fields(node, temp, batt, heading, source)
+            return
+        fields = self.telemetry_fields(node, temp, batt, heading, source)
+        if self.coalescer is not None:
+            self.coalescer.offer(TELEMETRY, node.id, fields)
+            if not self.batch:
+                self.send_due()
+            return
+        self.send_updates([self.node_update(node.id, telemetry=fields)], key=node.id)
+
+    def take_telemetry(self):
+        # {node_id: fields} of the telemetry waiting for the next batch
+        pending = self.pending_telemetry
+        self.pending_telemetry = {}
+        if self.telemetry is None:
+            return pending
+        telemetry = {}
+        for node_id, (node, source) in pending.items():
+            latest = self.telemetry.latest(node_id)
+            if latest is not None:
+                telemetry[node_id] = self.telemetry_fields(node, latest['temp'], latest['batt'], latest['heading'],
+                                                           source)
+        return telemetry
+
+    def send_due(self, force=False):
+        # Sends the coalesced updates that are due, one by one or as a batch
+        ready = self.coalescer.take(force)
+        positions = {node_id: node for (kind, node_id), node in ready.items() if kind == POSITION}
+        telemetry = {node_id: fields for (kind, node_id), fields in ready.items() if kind == TELEMETRY}
+        if self.batch:
+            self.send_batch(positions, telemetry)
+            return
+        for node_id, node in positions.items():
+            self.send_updates([self.node_update(node_id, node=node)], key=node_id)
+        for node_id, fields in telemetry.items():
+            self.send_updates([self.node_update(node_id, telemetry=fields)], key=node_id)
+
+    def publish_cycle(self, nodes):
+        # Publishes the solution of a cycle ({node_id: node}). In batch mode this is
+        # one request with the positions of all resolved nodes and the telemetry
+        # that came in since the last one.
+        if not self.batch:
+            for node in nodes.values():
+                self.update_node(node)
+            return
+        if self.coalescer is not None:
+            for node in nodes.values():
+                self.update_node(node)
+            self.send_due()
+            return
+        self.send_batch({node_id: node for node_id, node in nodes.items() if node.is_resolved()},
+                        self.take_telemetry())
+
+    def send_batch(self, positions, telemetry):
+        # One request for {node_id: node} positions and {node_id: fields} telemetry
+        gps = self.translate_nodes(positions.values())
+        updates = [self.node_update(node_id, node, telemetry.pop(node_id, None), gps[node_id])
+                   for node_id, node in positions.items()]
+        updates.extend(self.node_update(node_id, telemetry=fields) for node_id, fields in telemetry.items())
+        if updates:
+            self.send_updates(updates)
+
+    def flush_telemetry(self):
+        if self.pending_telemetry:
+            self.send_batch({}, self.take_telemetry())
 
-        mutation = mutation % {
-            'id': node.id,
-            'name': node.name,
-            'type': 'BASE' if node.is_base else 'MOBILE',
-            'temp': temp,
-            'batt': batt,
-            'heading': heading,
-            'source': source
-        }
-        threading.Thread(target=lambda: self.endpoint(mutation)).start()
 
     def translate_node_to_gps_coords(self, node):
+        return self.translate_nodes([node])[node.id]
+
+    def translate_nodes(self, nodes):
+        # {node_id: (lat, lon)} for all 'nodes', converted in one batch (see geo_transform.py)
+        nodes = list(nodes)
+        for node in nodes:
+            if node.id == self.anchored_base_id:
+                self.anchored_base_node = node
+            elif node.id == self.calculated_base_id:
+                self.calculated_base_node = node
         if not self.anchored_base_node or not self.calculated_base_node:
-            return node.x, node.y
-
-        # Set up coordinate transforms
-        anchored_base, calculated_base = LatLon(*config.ANCHORED_BASE_GPS), LatLon(*config.CALCULATED_BASE_GPS)
-        virtual_base_distance = self.calculated_base_node.x  # TODO: actually calculate this
-        real_base_distance = anchored_base.distanceTo(calculated_base)
-        distance_scale = real_base_distance / virtual_base_distance
-        heading_offset = mean([anchored_base.initialBearingTo(calculated_base),
-                               calculated_base.initialBearingTo(anchored_base) - 180]) - 90
-        # Transform node virtual coordinates
-        new_x, new_y = self.rotate_point((node.x * distance_scale, node.y * distance_scale), heading_offset)
-        n_d, n_a = math.sqrt(math.pow(new_x, 2) + math.pow(new_y, 2)), 90 - math.degrees(math.atan2(-new_y, new_x))
-
-        # Add to anchored base GPS coords
-        node_gps = anchored_base.destination(n_d, n_a)
-        return node_gps.latlon2(ndigits=6)
-
-    @staticmethod
-    def rotate_point(point, angle):
-        rad = math.radians(angle)
-        x = math.cos(rad) * point[0] - math.sin(rad) * point[1]
-        y = math.sin(rad) * point[0] + math.cos(rad) * point[1]
-        return x, y
+            return {node.id: (node.x, node.y) for node in nodes}
+
+        self.gps.update(self.calculated_base_node.x)  # TODO: actually calculate the virtual base distance
+        lat, lon = self.gps.to_gps([node.x for node in nodes], [node.y for node in nodes])
+        return {node.id: (round(float(node_lat), 6), round(float(node_lon), 6))
+                for node, node_lat, node_lon in zip(nodes, lat, lon)}
+
+
+#############
+# Benchmark #
+#############
+# Requests and bytes a stand-in backend receives for the same cycles, published
+# node by node and batched.
+# Usage: python3 backend.py [num_cycles] [num_nodes]
+
+class _BenchNode:
+    def __init__(self, node_id, is_base):
+        self.id = node_id
+        self.name = "Node " + node_id
+        self.is_base = is_base
+        self.x = 1000.0 * int(node_id)
+        self.y = 500.0 * int(node_id)
+
+    def is_resolved(self):
+        return True
+
+    def get_guess_radius(self):
+        return 250.0
+
+
+if __name__ == "__main__":
+    from publisher import _StandInServer
+
+    num_cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_nodes = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    nodes = {str(n): _BenchNode(str(n), n < 2) for n in range(num_nodes)}
+    nodes['1'].y = 0
+
+    for batch in (False, True):
+        server = _StandInServer()
+        config.BACKEND_URL = server.url
+        config.ENABLE_BACKEND = True
+        config.BACKEND_BATCH = batch
+        backend = Backend('0', '1')
+        start = time.perf_counter()
+        for cycle in range(num_cycles):
+            for node in nodes.values():
+                if not node.is_base:
+                    backend.update_node_telemetry(node, 25.0, 80.0, 90.0)
+            backend.publish_cycle(nodes)
+            backend.publisher.flush()  # One cycle at a time, nothing dropped
+        backend.close()
+        elapsed = time.perf_counter() - start
+        stats = backend.stats()
+        print("{:<13} {:>6} requests ({:.1f}/cycle), {:>9} bytes, {} updates, {:.3f} secs".format(
+            "Batched:" if batch else "Node by node:", server.requests, server.requests / num_cycles, server.bytes,
+            stats['updates'], elapsed))
+        server.stop()
@@ -1,40 +1,127 @@
-import math
+import os
+import sys
+import time
 
-bat_step = 0
-bat_start_volts = 0
-bat_percentage_array = []
-bat_imported = False
+import numpy
+
+import config
+
+#################
+# Battery model #
+#################
+# Converts battery voltages to percentages with a discharge table: a 'step=' and
+# 'start=' (volts) header followed by one percentage per step. The table is only
+# read on first use and kept next to it as a binary .npy cache, which is used as
+# long as it is newer than the table.
+#
+# to_percentage() takes a float, to_percentages() a NumPy array. Both
+# interpolate between table entries and clamp below and above the table to its
+# first and last entry. Steps are uniform, so the entry is found by arithmetic
+# rather than a search. Floats skip NumPy entirely and use the precomputed
+# slope of each entry, so a call costs about as much as a plain table lookup.
+
+class BatteryModel:
+    def __init__(self, filename, cache=True):
+        if not os.path.isabs(filename):
+            filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+        self.filename = filename
+        self.cache = cache
+        self.start = None
+        self.step = None
+        self.percentages = None
+        self.table = None  # Same as 'percentages', as a list for single floats
+        self.slopes = None  # Change to the next entry, per entry
+        self.inv_step = None
+        self.last = None  # Index of the last entry
+
+    def load(self):
+        cache_name = os.path.splitext(self.filename)[0] + '.npy'
+        if self.cache and os.path.exists(cache_name) and \
+                os.path.getmtime(cache_name) >= os.path.getmtime(self.filename):
+            data = numpy.load(cache_name)
+            self._set(data[0], data[1], data[2:])
+            return
+        step, start, values = 0, 0, []
+        with open(self.filename, 'r') as f:
+            for line in f:
+                if "=" in line:
+                    key, value = line.rstrip().split('=')
+                    if key == 'step':
+                        step = float(value)
+                    elif key == 'start':
+                        start = float(value)
+                elif line.strip():
+                    values.append(line)
+        self._set(start, step, numpy.array(values, dtype=numpy.float64))
+        if self.cache:
+            try:
+                numpy.save(cache_name, numpy.concatenate(([start, step], self.percentages)))
+            except OSError:
+                pass  # Read-only checkout, parse again next time
+
+    def _set(self, start, step, percentages):
+        self.start = float(start)
+        self.step = float(step)
+        self.percentages = percentages
+        self.table = percentages.tolist()
+        self.slopes = numpy.diff(percentages).tolist() + [0.0]
+        self.inv_step = 1 / self.step
+        self.last = len(self.table) - 1
+
+    def to_percentage(self, volts):
+        if self.table is None:
+            self.load()
+        pos = (volts - self.start) * self.inv_step
+        if pos <= 0:
+            return self.table[0]
+        if pos >= self.last:
+            return self.table[self.last]
+        index = int(pos)
+        return self.table[index] + self.slopes[index] * (pos - index)
+
+    def to_percentages(self, volts):
+        if self.table is None:
+            self.load()
+        last = self.last
+        pos = numpy.clip((numpy.asarray(volts, dtype=numpy.float64) - self.start) / self.step, 0, last)
+        index = numpy.minimum(pos.astype(numpy.intp), last - 1)
+        return self.percentages[index] + (self.percentages[index + 1] - self.percentages[index]) * (pos - index)
+
+
+_models = {}  # {table name: BatteryModel}
+
+
+def battery_model(node_id=None):
+    # Model of the node's 'battery' table in config.NODES, "default" if it has none
+    name = config.NODES.get(node_id, {}).get('battery', 'default')
+    if name not in _models:
+        _models[name] = BatteryModel(config.BATTERY_TABLES[name])
+    return _models[name]
 
 
 def import_bat_data(filename):
-    global bat_step, bat_start_volts, bat_percentage_array, bat_imported
-    bat_percentage_array = []
-    with open(filename, 'r') as f:
-        for line in f:
-            if "=" in line:
-                line_arr = (line.rstrip()).split('=')
-                if line_arr[0] == 'step':
-                    bat_step = float(line_arr[1])
-                elif line_arr[0] == 'start':
-                    bat_start_volts = float(line_arr[1])
-            else:
-                bat_percentage_array.append(float(line.rstrip()))
-    bat_imported = True
+    _models['default'] = BatteryModel(filename)
 
 
 def volts_to_percentage(volts_in):
-    if bat_imported is False:
-        print('Run \'import_bat_data(filename)\' before running \'volts_to_percentage\'')
-        return -1
-    index = math.floor((volts_in - bat_start_volts) / bat_step)
+    return battery_model().to_percentage(volts_in)
+
+
+#############
+# Benchmark #
+#############
+# Converts the same voltages one call at a time (the old table lookup and
+# BatteryModel) and in one batch.
+# Usage: python3 battery.py [num_samples]
+
+def _legacy_volts_to_percentage(volts_in, start, step, table):
+    index = int((volts_in - start) // step)
     if index < 0:
         return 0.0
-    elif index > len(bat_percentage_array):
+    elif index >= len(table):  # The old check was 'index > len(table)', which overflowed at the top
         return 100.0
-    return bat_percentage_array[index]
-
+    return table[index]
 
-import_bat_data('./battery.dat')
 
 if __name__ == "__main__":
     print(volts_to_percentage(3.3))  # 0%
@@ -44,3 +131,39 @@ if __name__ == "__main__":
     print(volts_to_percentage(3.71))  # 17.3236%
     print(volts_to_percentage(1.0))  # 0%
     print(volts_to_percentage(5.3))  # 100%
+
+    num_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    numpy.random.seed(1)
+    volts = numpy.random.uniform(3.2, 4.3, num_samples)
+    volts_list = volts.tolist()
+
+    model = BatteryModel(config.BATTERY_TABLES['default'], cache=False)
+    start = time.perf_counter()
+    model.load()
+    parse_time = time.perf_counter() - start
+    model = BatteryModel(config.BATTERY_TABLES['default'])
+    model.load()  # Writes the cache if there is none
+    model = BatteryModel(config.BATTERY_TABLES['default'])
+    start = time.perf_counter()
+    model.load()
+    cache_time = time.perf_counter() - start
+
+    table = model.percentages.tolist()
+    start = time.perf_counter()
+    legacy = [_legacy_volts_to_percentage(v, model.start, model.step, table) for v in volts_list]
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    single = [model.to_percentage(v) for v in volts_list]
+    single_time = time.perf_counter() - start
+    start = time.perf_counter()
+    batch = model.to_percentages(volts)
+    batch_time = time.perf_counter() - start
+
+    print("Table: parsed in {:.4f} secs, loaded from the .npy cache in {:.4f} secs".format(parse_time, cache_time))
+    print("{} samples: table lookup per call {:.3f} secs, BatteryModel per call {:.3f} secs, "
+          "one batch {:.4f} secs ({:.0f}x)".format(num_samples, legacy_time, single_time, batch_time,
+                                                   legacy_time / batch_time))
+    print("Max difference: batch to per call {:.2g}%, to numpy.interp {:.2g}%, to the old lookup (no "
+          "interpolation) {:.3f}%".format(numpy.abs(batch - single).max(), numpy.abs(batch - numpy.interp(
+              volts, model.start + model.step * numpy.arange(len(table)), model.percentages)).max(),
+              numpy.abs(batch - legacy).max()))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import binascii
+import struct
+import sys
+import time
+
+from packet_decoder import decode_line, RangePacket, StatsPacket
+
+###################
+# Frame layout    #
+###################
+# All frames are little-endian and start with a sync word, followed by a frame
+# type and a fixed-size payload. The last two bytes are a CRC-16/CCITT over the
+# type and payload bytes.
+#
+# Range frame (18 bytes):
+#   sync(2) type(1) cycle(4) from(1) to(1) seq(2) hops(1) range_mm(4) crc(2)
+# Stats frame (19 bytes):
+#   sync(2) type(1) cycle(4) from(1) seq(2) hops(1) batt_mv(2) temp_centi_c(2) heading_deci_deg(2) crc(2)
+
+SYNC = b'\xa5\x5a'
+TYPE_RANGE = 0x01
+TYPE_STATS = 0x02
+
+RANGE_FRAME = struct.Struct('<2sBIBBHBIH')
+STATS_FRAME = struct.Struct('<2sBIBHBHhHH')
+
+FRAME_STRUCTS = {TYPE_RANGE: RANGE_FRAME, TYPE_STATS: STATS_FRAME}
+MAX_FRAME_SIZE = max(RANGE_FRAME.size, STATS_FRAME.size)
+
+LOG_EXTENSION = '.bin'
+
+_CRC_INIT = 0xFFFF
+_new = tuple.__new__
+_NODE_IDS = tuple(str(i) for i in range(256))
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, _CRC_INIT)
+
+
+############
+# Encoding #
+############
+
+def encode_packet(packet):
+    if type(packet) is RangePacket:
+        frame = bytearray(RANGE_FRAME.pack(SYNC, TYPE_RANGE, packet.cycle, int(packet.from_id), int(packet.to_id),
+                                           packet.seq, packet.hops, packet.range, 0))
+    elif type(packet) is StatsPacket:
+        frame = bytearray(STATS_FRAME.pack(SYNC, TYPE_STATS, packet.cycle, int(packet.from_id), packet.seq,
+                                           packet.hops, round(packet.batt * 1000), round(packet.temp * 100),
+                                           round(packet.heading * 10) % 3600, 0))
+    else:
+        raise TypeError("Can't encode {}".format(type(packet).__name__))
+    struct.pack_into('<H', frame, len(frame) - 2, crc16(memoryview(frame)[2:-2]))
+    return bytes(frame)
+
+
+def convert_log(text_path, binary_path):
+    # Converts a text log (as written by Main) to the binary frame format.
+    # Returns (lines read, frames written).
+    lines = 0
+    frames = 0
+    with open(text_path, 'r') as src, open(binary_path, 'wb') as dst:
+        for line in src:
+            lines += 1
+            packet = decode_line(line)
+            if packet is None:
+                continue
+            dst.write(encode_packet(packet))
+            frames += 1
+    return lines, frames
+
+
+############
+# Decoding #
+############
+
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.skipped_bytes = 0
+
+    def feed(self, data):
+        # Appends raw bytes and returns every complete frame as a packet record.
+        # Partial frames are kept until the next call.
+        self.buffer += data
+        packets = []
+        consumed = self.decode_into(self.buffer, 0, len(self.buffer), packets)
+        del self.buffer[:consumed]
+        return packets
+
+    def decode_into(self, buf, pos, end, packets):
+        # Decodes frames in buf[pos:end] straight out of the buffer (no slicing) and
+        # appends them to 'packets'. Returns the position of the first byte that
+        # was not consumed, i.e. the start of a trailing partial frame.
+        with memoryview(buf) as view:
+            while True:
+                sync_pos = buf.find(SYNC, pos, end)
+                if sync_pos < 0:
+                    # Keep a possible first half of a sync word
+                    keep = 1 if end > pos and buf[end - 1] == SYNC[0] else 0
+                    self.skipped_bytes += end - pos - keep
+                    return end - keep
+                self.skipped_bytes += sync_pos - pos
+                pos = sync_pos
+                if end - pos < 3:
+                    return pos
+                frame = FRAME_STRUCTS.get(buf[pos + 2])
+                if frame is None:
+                    pos += 1
+                    self.skipped_bytes += 1
+                    continue
+                size = frame.size
+                if end - pos < size:
+                    return pos
+                fields = frame.unpack_from(buf, pos)
+                if fields[-1] != crc16(view[pos + 2:pos + size - 2]):
+                    # Corrupt frame or a sync word inside a payload, resync on the next byte
+                    self.crc_errors += 1
+                    self.skipped_bytes += 1
+                    pos += 1
+                    continue
+                pos += size
+                self.frames += 1
+                if frame is RANGE_FRAME:
+                    _, _, cycle, from_id, to_id, seq, hops, dist, _ = fields
+                    packets.append(_new(RangePacket, (cycle, _NODE_IDS[from_id], _NODE_IDS[to_id], seq, hops, dist)))
+                else:
+                    _, _, cycle, from_id, seq, hops, batt, temp, heading, _ = fields
+                    packets.append(_new(StatsPacket, (cycle, _NODE_IDS[from_id], seq, hops, batt / 1000,
+                                                      temp / 100, heading / 10)))
+
+
+#######
+# CLI #
+#######
+# Converts a text log to the binary format and decodes it back as a check.
+# Usage: python3 binary_protocol.py <text log> [binary log]
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 binary_protocol.py <text log> [binary log]")
+        exit(1)
+    in_path = sys.argv[1]
+    out_path = sys.argv[2] if len(sys.argv) > 2 else in_path.rsplit('.', 1)[0] + LOG_EXTENSION
+
+    line_count, frame_count = convert_log(in_path, out_path)
+    print("Converted {} lines into {} frames -> '{}'".format(line_count, frame_count, out_path))
+
+    with open(in_path, 'r') as f:
+        text_data = f.read()
+    with open(out_path, 'rb') as f:
+        binary_data = f.read()
+    print("Size: {} bytes text, {} bytes binary ({:.1f}x smaller)".format(len(text_data.encode('utf-8')),
+                                                                          len(binary_data),
+                                                                          len(text_data) / max(len(binary_data), 1)))
+
+    text_start = time.perf_counter()
+    text_packets = [p for p in map(decode_line, text_data.splitlines()) if p is not None]
+    text_time = time.perf_counter() - text_start
+
+    decoder = FrameDecoder()
+    binary_start = time.perf_counter()
+    binary_packets = []
+    for offset in range(0, len(binary_data), 4096):
+        binary_packets += decoder.feed(binary_data[offset:offset + 4096])
+    binary_time = time.perf_counter() - binary_start
+
+    print("Text decode:   {:.3f} secs".format(text_time))
+    print("Binary decode: {:.3f} secs ({} frames, {} CRC errors)".format(binary_time, decoder.frames,
+                                                                       decoder.crc_errors))
+    mismatches = sum(1 for a, b in zip(text_packets, binary_packets) if type(a) is not type(b) or a[:4] != b[:4])
+    print("Mismatched packets: {}".format(mismatches + abs(len(text_packets) - len(binary_packets))))
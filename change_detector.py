@@ -0,0 +1,82 @@
+import config
+
+
+###################
+# Change detector #
+###################
+# Compares the averaged pair distances of a cycle snapshot against the ones the
+# last solve was done with. A pair has moved if its average changed by more than
+# max(tolerance, std_factor * std), so noisy links need a bigger jump. Nodes on a
+# moved (or newly appearing/disappearing) pair are dirty; no dirty nodes means
+# the previous solution still holds and the solve can be skipped.
+
+class ChangeDetector:
+    def __init__(self, calculated_base, tolerance=config.CHANGE_TOLERANCE, std_factor=config.CHANGE_STD_FACTOR,
+                 max_skipped=config.CHANGE_MAX_SKIPPED):
+        self.calculated_base = calculated_base
+        self.tolerance = tolerance
+        self.std_factor = std_factor
+        self.max_skipped = max_skipped
+        self.baseline = None  # {(n1, n2): avg} of the last solve
+        self.baseline_base_x = None
+        self.skipped_in_a_row = 0
+
+        # Metrics
+        self.solved_ctr = 0
+        self.skipped_ctr = 0
+
+    def dirty_nodes(self, snapshot):
+        # Returns the set of node IDs affected since the last solve
+        if self.baseline is None:
+            return None  # Nothing solved yet, everything is dirty
+        dirty = set()
+        seen = 0
+        for n1, n2, avg, std in snapshot.measurements:
+            old = self.baseline.get((n1, n2))
+            if old is None:
+                dirty.add(n1)
+                dirty.add(n2)
+                continue
+            seen += 1
+            if abs(avg - old) > max(self.tolerance, self.std_factor * std):
+                dirty.add(n1)
+                dirty.add(n2)
+        if seen != len(self.baseline):
+            # Some pairs dropped out
+            current = {(n1, n2) for n1, n2, _, _ in snapshot.measurements}
+            for n1, n2 in self.baseline.keys() - current:
+                dirty.add(n1)
+                dirty.add(n2)
+        if snapshot.base_x is not None and (self.baseline_base_x is None or
+                                            abs(snapshot.base_x - self.baseline_base_x) > self.tolerance):
+            dirty.add(self.calculated_base)
+        return dirty
+
+    def should_solve(self, snapshot):
+        # Returns (solve?, dirty node IDs or None for all). Records the snapshot as
+        # the new baseline when it should be solved.
+        if snapshot is None:
+            dirty = None
+        else:
+            dirty = self.dirty_nodes(snapshot)
+        if dirty is not None and len(dirty) == 0 and self.skipped_in_a_row < self.max_skipped:
+            self.skipped_in_a_row += 1
+            self.skipped_ctr += 1
+            return False, dirty
+        if self.skipped_in_a_row >= self.max_skipped and dirty is not None and len(dirty) == 0:
+            dirty = None  # Periodic full refresh
+        self.skipped_in_a_row = 0
+        self.solved_ctr += 1
+        if snapshot is not None:
+            self.baseline = {(n1, n2): avg for n1, n2, avg, _ in snapshot.measurements}
+            if snapshot.base_x is not None:
+                self.baseline_base_x = snapshot.base_x
+        return True, dirty
+
+    def stats(self):
+        total = self.solved_ctr + self.skipped_ctr
+        return {
+            'solved': self.solved_ctr,
+            'skipped': self.skipped_ctr,
+            'skip_ratio': self.skipped_ctr / total if total else 0,
+        }
@@ -4,12 +4,41 @@
 
 SERIAL_PORT = "/dev/tty.usbserial-UUT2"
 SERIAL_BAUD = 256000  # 921600
+SERIAL_PROTOCOL = "text"  # "text" (human readable lines) or "binary" (framed, see binary_protocol.py)
+LOG_FLUSH_INTERVAL = 0.25  # secs, raw serial data is written to the log at least this often
+LOG_FLUSH_BYTES = 64 * 1024  # or whenever this much is pending
+
+####################
+# Ingest config    #
+####################
+
+# Run read -> parse -> solve -> publish as separate stages connected by bounded queues
+INGEST_PIPELINE = False
+# Input queue of each stage: (policy, max size). Policies: "block", "drop_oldest", "latest"
+PIPELINE_QUEUES = {
+    'read': ("block", 64),  # raw serial batches waiting to be parsed
+    'parse': ("block", 64),  # packet batches waiting for the packet processors / algorithm
+    'publish': ("block", 4096),  # display messages and backend calls, dropping them loses frame markers and updates
+}
+PIPELINE_METRICS_INTERVAL = 10  # secs between queue metric printouts, 0 to disable
 
 ####################
 # Algorithm config #
 ####################
 
 MAX_HISTORY = 20  # How many historical cycles to feed to algorithm
+# Ignore range samples that are more than RANGE_OUTLIER_MAD_SCALE (normal-scaled) median absolute
+# deviations away from the median of their pair's window, but never closer than RANGE_OUTLIER_MIN_DEV
+RANGE_OUTLIER_REJECTION = False
+RANGE_OUTLIER_MAD_SCALE = 3.0
+RANGE_OUTLIER_MIN_DEV = 300  # mm
+# Skip the solve (and redraw/publish) when no pair distance moved more than max(CHANGE_TOLERANCE,
+# CHANGE_STD_FACTOR * std) since the last solve. Only the nodes on moved pairs are published.
+CHANGE_DETECTION = False
+CHANGE_TOLERANCE = 100  # mm
+CHANGE_STD_FACTOR = 1.0
+CHANGE_MAX_SKIPPED = 10  # Solve at least every this many cycles, even if nothing moved
+SOLVER_PROCESS = False  # Run the algorithm in a worker process. If it falls behind, only the newest cycle is solved
 
 ##################
 # Backend config #
@@ -17,6 +46,59 @@ MAX_HISTORY = 20  # How many historical cycles to feed to algorithm
 
 ENABLE_BACKEND = True
 BACKEND_URL = "https://web.mnslac.xtriage.com/graphql"
+PUBLISH_WORKERS = 2  # Connections to the backend. All updates of a node go through the same one, in order
+PUBLISH_QUEUE_SIZE = 256  # Updates waiting per connection, the oldest are dropped when full
+PUBLISH_TIMEOUT = 5  # secs
+BACKEND_BATCH = False  # One request per cycle with all node positions and the telemetry received since the last one
+# Only publish the latest state of a node, when it changed enough, and not too often
+BACKEND_COALESCE = False
+BACKEND_MIN_MOVE = 250  # mm a node has to move to be published again
+BACKEND_MIN_RADIUS_CHANGE = 250  # mm its guess radius has to change by (if it didn't move)
+BACKEND_NODE_INTERVAL = 1.0  # secs, at most one position and one telemetry update per node this often
+BACKEND_MAX_RATE = 20  # updates/sec over all nodes
+BACKEND_HEARTBEAT = 30  # secs, publish unchanged nodes at least this often
+# Keep updates in an on-disk spool until the backend confirms them, so they survive backend outages
+BACKEND_SPOOL = False
+SPOOL_PATH = "backend_spool.db"
+SPOOL_MAX_ROWS = 100000  # The oldest updates are dropped beyond this
+SPOOL_BATCH = 200  # Updates per replayed request
+SPOOL_BACKOFF = (0.5, 60)  # secs, the retry delay doubles from the first to the second while requests fail
+SPOOL_CLOSE_TIMEOUT = 5  # secs to keep trying on shutdown, anything left is lost
+
+##################
+# Display config #
+##################
+
+# Send the engineering display one message per frame instead of one per primitive (see display_protocol.py)
+DISPLAY_BATCH = False
+DISPLAY_FLUSH_INTERVAL = 0.1  # secs, comm counters and status updates are sent at least this often between frames
+DISPLAY_FPS = 30  # The display renders at most this often and sleeps in between
+# Send display messages from a background thread through a bounded queue, so a slow display never stalls ingest
+DISPLAY_SENDER = False
+DISPLAY_QUEUE_SIZE = 2048  # Messages
+# What a full queue gives up, in order: "comm" (report_communication messages), "frames" (all but the newest
+# queued frame), "oldest" (draw or comm message), or "block" to wait. The new message is dropped if none of them
+# made room, which can unbalance frames, so keep "block" last.
+DISPLAY_OVERFLOW = ("comm", "frames", "oldest", "block")
+DISPLAY_CLOSE_TIMEOUT = 5  # secs to keep sending what is queued on shutdown
+# Skip what is off screen and simplify what is drawn when zoomed out (see viewport.py)
+DISPLAY_CULLING = False
+DISPLAY_CULL_MARGIN = 100  # px beyond the window edges that are still drawn
+DISPLAY_LOD_LABELS = 2  # px/m below which link labels are hidden and overlapping links merged
+DISPLAY_LOD_MERGE = 12  # px, links whose ends are this close to those of a drawn link are merged into it
+DISPLAY_LOD_POINTS = 0.5  # px/m below which nodes are drawn as points instead of guess circles
+DISPLAY_POINT_RADIUS = 3  # px
+# Hand the display the latest frame (positions, guess radii, links, telemetry) through shared memory instead of
+# drawing commands over the pipe (see frame_buffer.py). The solver never waits and the display skips stale frames.
+DISPLAY_SHARED_FRAMES = False
+
+####################
+# Telemetry config #
+####################
+
+TELEMETRY_CAPACITY = 2048  # Raw samples kept per node, and buckets per rollup resolution
+TELEMETRY_RESOLUTIONS = (10, 60, 600)  # secs, min/max/mean rollups (600 secs reach back ~14 days)
+TELEMETRY_TREND_WINDOW = 600  # secs of battery history shown next to each node in the display
 
 ###############
 # Site config #
@@ -25,6 +107,11 @@ BACKEND_URL = "https://web.mnslac.xtriage.com/graphql"
 AUTO_SETUP_BASE = True
 MANUAL_BASE_DIST = 47000  # Units in mm. Only used if AUTO_SETUP_BASE is False
 
+# Discharge tables (see battery.py) a node can pick with a "battery" attribute, "default" otherwise
+BATTERY_TABLES = {
+    "default": "battery.dat",
+}
+
 NODES = {
     "0": {"name": "Base 1", "is_base": True, "base_type": "anchored"},
     "1": {"name": "Base 2", "is_base": True, "base_type": "calculated"},
@@ -36,3 +123,4 @@ NODES = {
 
 ANCHORED_BASE_GPS = 34.21797, -83.95238
 CALCULATED_BASE_GPS = 34.21763, -83.95173
+GPS_BASE_TOLERANCE = 1  # mm the calculated base's x has to change by to rescale the GPS transform
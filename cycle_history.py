@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+from collections import deque
+import pickle
+import sys
+import time
+
+import numpy
+
+import config
+
+CYCLE_DTYPE = numpy.dtype([
+    ('from', numpy.int16),
+    ('to', numpy.int16),
+    ('range', numpy.int32),  # mm
+    ('hops', numpy.int16),
+    ('seq', numpy.int32),
+    ('cycle', numpy.int32),
+])
+
+
+#################
+# Cycle history #
+#################
+# Range samples of the last 'max_cycles' cycles (plus the one in progress) in one
+# structured array. Every sample is written twice, at i and i + capacity, so any
+# window of up to 'capacity' consecutive samples is a contiguous slice and can be
+# returned as a view without copying. Capacity doubles when a window outgrows it.
+#
+# add() and end_cycle() only append to a list. The samples are converted into
+# the array the first time something reads the history (flush()), all at once
+# and only the ones that are still in the last 'max_cycles' cycles by then.
+# Node IDs may be passed as strings, they are converted along with the rest.
+#
+# Views are only valid until enough new samples have been added to wrap around
+# onto them; copy() anything that has to be kept.
+
+class CycleHistory:
+    def __init__(self, max_cycles=config.MAX_HISTORY, capacity=1024):
+        self.max_cycles = max_cycles
+        self.capacity = capacity
+        self.samples = numpy.zeros(2 * capacity, dtype=CYCLE_DTYPE)
+        self.total = 0  # Absolute index of the first sample not in the array yet
+        self.cycle_starts = deque()  # Absolute index of the first sample of each stored cycle, oldest first
+        self.current_start = 0  # Absolute index of the first sample of the cycle in progress
+        self.pending = []  # Samples from 'total' on, not yet copied into the array
+
+    def __len__(self):
+        return len(self.cycle_starts)
+
+    def __getitem__(self, index):
+        # Same order as the old list: 0 is the most recently completed cycle
+        if index < 0:
+            index += len(self.cycle_starts)
+        if not 0 <= index < len(self.cycle_starts):
+            raise IndexError('cycle history index out of range')
+        self.flush()
+        pos = len(self.cycle_starts) - 1 - index
+        start = self.cycle_starts[pos]
+        end = self.cycle_starts[pos + 1] if pos + 1 < len(self.cycle_starts) else self.current_start
+        return self._window(start, end)
+
+    def add(self, from_id, to_id, dist, hops, seq, cycle):
+        self.pending.append((from_id, to_id, dist, hops, seq, cycle))
+
+    def flush(self):
+        # Copies the pending samples that are still stored into the array with one conversion
+        self._skip_dropped()
+        if not self.pending:
+            return
+        block = numpy.array(self.pending, dtype=CYCLE_DTYPE)
+        self.pending = []
+        oldest = self.cycle_starts[0] if self.cycle_starts else self.current_start
+        while self.total + len(block) - oldest > self.capacity:
+            self._grow()
+        positions = numpy.arange(self.total, self.total + len(block)) % self.capacity
+        self.samples[positions] = block
+        self.samples[positions + self.capacity] = block
+        self.total += len(block)
+
+    def end_cycle(self):
+        self.cycle_starts.append(self.current_start)
+        self.current_start = self.total + len(self.pending)
+        while len(self.cycle_starts) > self.max_cycles:
+            self.cycle_starts.popleft()
+        if len(self.pending) > self.capacity:
+            self._skip_dropped()
+
+    def _skip_dropped(self):
+        # Forgets pending samples of cycles that dropped out, they are never written. Also keeps the
+        # list from growing while nothing reads the history.
+        oldest = self.cycle_starts[0] if self.cycle_starts else self.current_start
+        if oldest > self.total:
+            del self.pending[:oldest - self.total]
+            self.total = oldest
+
+    def current(self):
+        # Samples of the cycle in progress
+        self.flush()
+        return self._window(self.current_start, self.total)
+
+    def last_cycles(self, k=None):
+        # Samples of the last k completed cycles (all stored ones by default), oldest first
+        self.flush()
+        if not self.cycle_starts:
+            return self._window(self.current_start, self.current_start)
+        if k is None or k > len(self.cycle_starts):
+            k = len(self.cycle_starts)
+        return self._window(self.cycle_starts[-k], self.current_start)
+
+    def pair(self, node_1, node_2, k=None):
+        # All samples between two nodes (either direction) in the last k cycles.
+        # Boolean selection, so this one is a copy.
+        window = self.last_cycles(k)
+        n_from = window['from']
+        n_to = window['to']
+        return window[((n_from == node_1) & (n_to == node_2)) | ((n_from == node_2) & (n_to == node_1))]
+
+    def _window(self, start, end):
+        begin = start % self.capacity
+        return self.samples[begin:begin + (end - start)]
+
+    def _grow(self):
+        oldest = self.cycle_starts[0] if self.cycle_starts else self.current_start
+        live = self._window(oldest, self.total).copy()
+        self.capacity *= 2
+        self.samples = numpy.zeros(2 * self.capacity, dtype=CYCLE_DTYPE)
+        positions = numpy.arange(oldest, self.total) % self.capacity
+        self.samples[positions] = live
+        self.samples[positions + self.capacity] = live
+
+
+#############
+# Benchmark #
+#############
+# Compares the old list of lists (insert(0)/pop()) with CycleHistory. The
+# first query on CycleHistory includes converting the pending samples.
+# Usage: python3 cycle_history.py [num_nodes] [num_cycles]
+
+if __name__ == "__main__":
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    num_cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    packets = [(str(a), str(b), 10000 + a * 100 + b, 2, 0) for a in range(num_nodes) for b in range(num_nodes)
+               if a != b]
+
+    start = time.perf_counter()
+    history, data = [], []
+    for cycle in range(num_cycles):
+        for p_from, p_to, p_range, p_hops, p_seq in packets:
+            data.append([p_from, p_to, p_range, p_hops, p_seq])
+        while len(history) >= config.MAX_HISTORY:
+            history.pop()
+        history.insert(0, data)
+        data = []
+    legacy_add = time.perf_counter() - start
+    start = time.perf_counter()
+    legacy_pair = [s for c in history for s in c if (s[0], s[1]) in (('1', '2'), ('2', '1'))]
+    legacy_query = time.perf_counter() - start
+    start = time.perf_counter()
+    legacy_size = len(pickle.dumps(list(history)))
+    legacy_pickle = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ring = CycleHistory()
+    for cycle in range(num_cycles):
+        for p_from, p_to, p_range, p_hops, p_seq in packets:
+            ring.add(p_from, p_to, p_range, p_hops, p_seq, cycle)
+        ring.end_cycle()
+    ring_add = time.perf_counter() - start
+    start = time.perf_counter()
+    ring_pair = ring.pair(1, 2)
+    ring_query = time.perf_counter() - start
+    start = time.perf_counter()
+    ring_size = len(pickle.dumps(ring.last_cycles().copy()))
+    ring_pickle = time.perf_counter() - start
+
+    print("{} nodes, {} cycles, {} samples/cycle".format(num_nodes, num_cycles, len(packets)))
+    print("list of lists: {:.3f} secs to add, {:.6f} secs for one pair ({} samples), "
+          "snapshot {} bytes in {:.6f} secs".format(legacy_add, legacy_query, len(legacy_pair), legacy_size,
+                                                    legacy_pickle))
+    print("CycleHistory:  {:.3f} secs to add, {:.6f} secs for one pair ({} samples), "
+          "snapshot {} bytes in {:.6f} secs".format(ring_add, ring_query, len(ring_pair), ring_size, ring_pickle))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+from multiprocessing import Pipe
+import pickle
+import sys
+import threading
+import time
+
+import numpy
+
+import config
+
+##############################
+# Frame-batched display pipe #
+##############################
+# Drop-in for the display end of multi_pipe on the algorithm side. Instead of
+# one pickled message per primitive, everything the display needs for a frame
+# goes out as one 'frame' message (pickled once, sent with send_bytes):
+#   - circles and links: columns of their draw_circle/connect_points args, with
+#     positions and radii as NumPy arrays
+#   - comm: {pair key: count} of the report_communication messages since the last frame
+#   - status: the status_update args since the last frame
+#   - drawn: whether a frame_start/frame_end was in between (otherwise the
+#     message only carries comm and status)
+# Pending comm and status updates also go out after 'flush_interval' secs
+# without a frame, and before any other message so the order is kept.
+# decode_frame() turns the columns back into per-primitive args in one pass.
+
+BATCHED = ('draw_circle', 'connect_points', 'report_communication', 'status_update')
+NUMERIC = {'x', 'y', 'r', 'pos1', 'pos2'}
+
+
+class _Columns:
+    # One list per arg name, None where a primitive didn't have it
+    def __init__(self):
+        self.count = 0
+        self.columns = {}
+
+    def add(self, args):
+        for name, value in args.items():
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = [None] * self.count
+            column.append(value)
+        self.count += 1
+        if len(args) < len(self.columns):
+            for column in self.columns.values():
+                if len(column) < self.count:
+                    column.append(None)
+
+    def encode(self):
+        encoded = {}
+        for name, column in self.columns.items():
+            if name in NUMERIC and None not in column:
+                try:
+                    column = numpy.array(column, dtype=numpy.float64)
+                except (TypeError, ValueError):
+                    pass  # Positions with a missing coordinate stay a list
+            encoded[name] = column
+        return {'count': self.count, 'columns': encoded}
+
+
+class FramePipe:
+    def __init__(self, pipe, flush_interval=config.DISPLAY_FLUSH_INTERVAL):
+        self.pipe = pipe
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self._reset()
+        self.in_frame = False
+
+        # Metrics
+        self.messages_in = 0  # Messages the algorithm side sent
+        self.messages_out = 0  # Messages that went through the pipe
+        self.frames = 0
+        self.bytes_out = 0  # Of the batched messages
+
+    def _reset(self):
+        self.circles = _Columns()
+        self.links = _Columns()
+        self.comm = {}
+        self.status = []
+        self.drawn = False
+        self.clear_screen = False
+        self.since = None  # When the oldest pending update came in
+
+    def send(self, msg):
+        with self.lock:
+            self.messages_in += 1
+            cmd = msg.get('cmd') if type(msg) == dict else None
+            if cmd == 'frame_start':
+                self.in_frame = True
+                self.circles = _Columns()
+                self.links = _Columns()
+            elif cmd == 'frame_end':
+                self.in_frame = False
+                self.drawn = True
+                self._flush()
+            elif cmd == 'clear_screen':
+                self.clear_screen = True
+                self.circles = _Columns()
+                self.links = _Columns()
+            elif cmd in BATCHED and msg.get('args') is not None:
+                args = msg['args']
+                if cmd == 'draw_circle':
+                    self.circles.add(args)
+                elif cmd == 'connect_points':
+                    self.links.add(args)
+                elif cmd == 'report_communication':
+                    self.comm[args.get('key')] = self.comm.get(args.get('key'), 0) + 1
+                else:
+                    self.status.append(args)
+                if self.since is None:
+                    self.since = time.time()
+                elif not self.in_frame and time.time() - self.since > self.flush_interval:
+                    self._flush()
+            else:
+                if self.since is not None or self.clear_screen:
+                    self._flush()
+                self.pipe.send(msg)
+                self.messages_out += 1
+
+    def _flush(self):
+        frame = {
+            'drawn': self.drawn,
+            'clear_screen': self.clear_screen,
+            'circles': self.circles.encode() if self.drawn else None,
+            'links': self.links.encode() if self.drawn else None,
+            'comm': self.comm,
+            'status': self.status,
+        }
+        data = pickle.dumps({'cmd': 'frame', 'args': frame}, protocol=pickle.HIGHEST_PROTOCOL)
+        self.pipe.send_bytes(data)
+        self.messages_out += 1
+        self.bytes_out += len(data)
+        if self.drawn:
+            self.frames += 1
+        # Primitives of a frame in progress stay
+        circles, links = self.circles, self.links
+        self._reset()
+        if self.in_frame:
+            self.circles, self.links = circles, links
+
+    def flush(self):
+        with self.lock:
+            if self.since is not None or self.clear_screen:
+                self._flush()
+
+    def stats(self):
+        return {
+            'messages_in': self.messages_in,
+            'messages_out': self.messages_out,
+            'frames': self.frames,
+            'bytes_out': self.bytes_out,
+            'bytes_per_frame': self.bytes_out / self.frames if self.frames else 0,
+        }
+
+
+def decode_rows(columns):
+    # [args, ...] from the columns of _Columns.encode(), leaving out missing args
+    count = columns['count']
+    lists = []
+    for name, column in columns['columns'].items():
+        if isinstance(column, numpy.ndarray):
+            column = [tuple(value) for value in column.tolist()] if column.ndim == 2 else column.tolist()
+        lists.append((name, column))
+    return [{name: column[i] for name, column in lists if column[i] is not None} for i in range(count)]
+
+
+def decode_frame(frame):
+    # The frame's draw_circle and connect_points args (empty if nothing was drawn)
+    if not frame['drawn']:
+        return [], []
+    return decode_rows(frame['circles']), decode_rows(frame['links'])
+
+
+#############
+# Benchmark #
+#############
+# Sends the messages of a run through a real Pipe, one per primitive and
+# batched per frame, while another thread receives and decodes them.
+# Usage: python3 display_protocol.py [num_nodes] [num_frames]
+
+def _frame_messages(num_nodes, frame):
+    # What the algorithm side sends per cycle: every pair ranges, every node reports telemetry
+    msgs = [{'cmd': 'report_communication', 'args': {'key': '{}-{}'.format(a, b)}}
+            for a in range(num_nodes) for b in range(a + 1, num_nodes)]
+    msgs += [{'cmd': 'status_update', 'args': {'node_id': str(n), 'cycle': frame, 'bat': 80.0, 'temp': 25.0,
+                                               'heading': 90.0}} for n in range(num_nodes)]
+    msgs.append({'cmd': 'frame_start', 'args': None})
+    for n in range(num_nodes):
+        msgs.append({'cmd': 'draw_circle', 'args': {'x': 1000.0 * n + frame, 'y': 500.0 * n, 'r': 250.0,
+                                                    'text': 'Node {}'.format(n), 'fill': 'text'}})
+    for n in range(1, num_nodes):
+        msgs.append({'cmd': 'connect_points', 'args': {'pos1': (0.0, 0.0), 'pos2': (1000.0 * n + frame, 500.0 * n),
+                                                       'text': '{:.0f}'.format(1118.0 * n)}})
+    msgs.append({'cmd': 'frame_end', 'args': None})
+    return msgs
+
+
+def _receive(conn, counts):
+    while True:
+        data = conn.recv_bytes()
+        counts['messages'] += 1
+        counts['bytes'] += len(data)
+        msg = pickle.loads(data)
+        if msg == 'done':
+            return
+        if type(msg) == dict and msg.get('cmd') == 'frame':
+            decode_frame(msg['args'])
+
+
+if __name__ == "__main__":
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    num_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    frames = [_frame_messages(num_nodes, frame) for frame in range(num_frames)]
+
+    for batched in (False, True):
+        receiver, sender = Pipe(duplex=False)
+        counts = {'messages': 0, 'bytes': 0}
+        thread = threading.Thread(target=_receive, args=(receiver, counts))
+        thread.start()
+        pipe = FramePipe(sender, flush_interval=3600) if batched else sender
+        start = time.perf_counter()
+        for msgs in frames:
+            for msg in msgs:
+                pipe.send(msg)
+        pipe.send('done')
+        thread.join()
+        elapsed = time.perf_counter() - start
+        print("{:<12} {:>6} messages ({:.0f}/frame), {:>6.0f} bytes/frame, {:.3f} secs ({:.0f} frames/sec)".format(
+            "Batched:" if batched else "Per message:", counts['messages'], counts['messages'] / num_frames,
+            counts['bytes'] / num_frames, elapsed, num_frames / elapsed))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from multiprocessing import Pipe
+import os
+import sys
+import threading
+import time
+
+import config
+
+##################
+# Display sender #
+##################
+# Drop-in for multi_pipe on the algorithm side that never makes the caller wait
+# for the display. send() only appends to a bounded queue, a background thread
+# does the pickling and writing (through FramePipe, if that is the wrapped
+# pipe). When the queue is full, the steps of 'overflow' are tried in order
+# until there is room:
+#   comm   - drop the queued report_communication messages
+#   frames - drop the queued frames (frame_start ... frame_end and the draw
+#            messages in between) except the newest complete one and the one
+#            in progress
+#   oldest - drop the oldest queued draw or comm message (DROPPABLE), never
+#            one that starts, ends or clears something
+#   block  - wait for the thread to make room
+# If none of them made room, the new message is dropped. Every drop is counted.
+#
+# The thread is started on the first send(), in the process that sends (Main
+# is created in the display process and run in another one).
+
+COMM = 'comm'
+FRAMES = 'frames'
+OLDEST = 'oldest'
+BLOCK = 'block'
+
+FRAME_CMDS = ('frame_start', 'frame_end', 'draw_circle', 'connect_points')
+DROPPABLE = ('draw_circle', 'connect_points', 'report_communication')
+
+_STOP = object()
+
+
+def _cmd(msg):
+    return msg.get('cmd') if type(msg) == dict else None
+
+
+class DisplaySender:
+    def __init__(self, pipe, maxsize=config.DISPLAY_QUEUE_SIZE, overflow=config.DISPLAY_OVERFLOW):
+        for step in overflow:
+            if step not in (COMM, FRAMES, OLDEST, BLOCK):
+                raise ValueError("Unknown overflow step '{}'".format(step))
+        self.pipe = pipe
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.pid = None
+        self.thread = None
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.busy = False  # The thread is sending a batch
+
+        # Metrics
+        self.queued_ctr = 0
+        self.sent_ctr = 0
+        self.dropped_comm_ctr = 0
+        self.dropped_frames_ctr = 0  # Frames
+        self.dropped_frame_msgs_ctr = 0  # Messages of those frames
+        self.dropped_oldest_ctr = 0
+        self.dropped_new_ctr = 0
+        self.blocked_time = 0
+        self.max_depth = 0
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.busy = False
+        self.thread = threading.Thread(target=self._run, name='display-sender', daemon=True)
+        self.thread.start()
+
+    def send(self, msg):
+        if self.pid != os.getpid():
+            self._start()
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                for step in self.overflow:
+                    self._make_room(step)
+                    if len(self.items) < self.maxsize:
+                        break
+                else:
+                    self.dropped_new_ctr += 1
+                    return
+            self.items.append(msg)
+            self.queued_ctr += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify_all()
+
+    def _make_room(self, step):
+        items = self.items
+        if step == COMM:
+            kept = deque(msg for msg in items if _cmd(msg) != 'report_communication')
+            self.dropped_comm_ctr += len(items) - len(kept)
+            self.items = kept
+        elif step == FRAMES:
+            self._collapse_frames()
+        elif step == OLDEST:
+            for i, msg in enumerate(items):
+                if _cmd(msg) in DROPPABLE:
+                    del items[i]
+                    self.dropped_oldest_ctr += 1
+                    break
+        else:
+            start = time.perf_counter()
+            self.cond.wait_for(lambda: len(self.items) < self.maxsize)
+            self.blocked_time += time.perf_counter() - start
+
+    def _collapse_frames(self):
+        # Complete frames as (index of frame_start, index of frame_end)
+        frames = []
+        start = None
+        for i, msg in enumerate(self.items):
+            cmd = _cmd(msg)
+            if cmd == 'frame_start':
+                start = i
+            elif cmd == 'frame_end' and start is not None:
+                frames.append((start, i))
+                start = None
+        if len(frames) < 2:
+            return
+        drop = set()
+        for start, end in frames[:-1]:
+            drop.update(i for i in range(start, end + 1) if _cmd(self.items[i]) in FRAME_CMDS)
+        self.items = deque(msg for i, msg in enumerate(self.items) if i not in drop)
+        self.dropped_frames_ctr += len(frames) - 1
+        self.dropped_frame_msgs_ctr += len(drop)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.items) > 0)
+                batch = self.items
+                self.items = deque()
+                self.busy = True
+                self.cond.notify_all()
+            for msg in batch:
+                if msg is _STOP:
+                    with self.cond:
+                        self.busy = False
+                        self.cond.notify_all()
+                    return
+                self.pipe.send(msg)
+            with self.cond:
+                self.sent_ctr += len(batch)
+                self.busy = False
+                self.cond.notify_all()
+
+    def drain(self, timeout=None):
+        # Waits until everything queued so far has been sent, returns whether it was
+        if self.thread is None or self.pid != os.getpid():
+            return True
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.items and not self.busy, timeout)
+
+    def close(self, timeout=config.DISPLAY_CLOSE_TIMEOUT):
+        # Sends what is queued (for up to 'timeout' secs) and stops the thread
+        if self.thread is None or self.pid != os.getpid():
+            return
+        with self.cond:
+            self.items.append(_STOP)
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def stats(self):
+        with self.cond:
+            return {
+                'queued': self.queued_ctr,
+                'sent': self.sent_ctr,
+                'depth': len(self.items),
+                'max_depth': self.max_depth,
+                'dropped_comm': self.dropped_comm_ctr,
+                'dropped_frames': self.dropped_frames_ctr,
+                'dropped_frame_msgs': self.dropped_frame_msgs_ctr,
+                'dropped_oldest': self.dropped_oldest_ctr,
+                'dropped_new': self.dropped_new_ctr,
+                'dropped': self.dropped_comm_ctr + self.dropped_frame_msgs_ctr + self.dropped_oldest_ctr +
+                self.dropped_new_ctr,
+                'blocked_time': self.blocked_time,
+            }
+
+
+#############
+# Benchmark #
+#############
+# Sends the messages of a run to a display that takes 'delay' secs per message,
+# straight through a Pipe and through a DisplaySender, and measures how long
+# the sending (ingest) side spends in send().
+# Usage: python3 display_sender.py [num_frames] [delay]
+
+def _messages(num_frames, num_nodes=10):
+    msgs = []
+    for frame in range(num_frames):
+        msgs += [{'cmd': 'report_communication', 'args': {'key': '0-{}'.format(n)}} for n in range(1, num_nodes)]
+        msgs.append({'cmd': 'status_update', 'args': {'node_id': str(frame % num_nodes), 'bat': 80.0, 'temp': 25.0,
+                                                      'heading': 90.0}})
+        msgs.append({'cmd': 'frame_start', 'args': None})
+        msgs += [{'cmd': 'draw_circle', 'args': {'x': 1000.0 * n + frame, 'y': 0.0, 'r': 250.0,
+                                                 'text': 'Node {}'.format(n), 'padding': 'x' * 2000}}
+                 for n in range(num_nodes)]
+        msgs.append({'cmd': 'frame_end', 'args': None})
+    return msgs
+
+
+def _slow_display(conn, delay, counts):
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            return
+        counts[_cmd(msg)] = counts.get(_cmd(msg), 0) + 1
+        time.sleep(delay)
+
+
+if __name__ == "__main__":
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0005
+    msgs = _messages(num_frames)
+
+    for queued in (False, True):
+        receiver, sender = Pipe(duplex=False)
+        counts = {}
+        thread = threading.Thread(target=_slow_display, args=(receiver, delay, counts))
+        thread.start()
+        pipe = DisplaySender(sender, maxsize=256, overflow=(COMM, FRAMES, OLDEST)) if queued else sender
+        send_time = 0
+        worst = 0
+        for msg in msgs:
+            start = time.perf_counter()
+            pipe.send(msg)
+            elapsed = time.perf_counter() - start
+            send_time += elapsed
+            worst = max(worst, elapsed)
+        pipe.send(None)
+        if queued:
+            pipe.close()
+        thread.join()
+        print("{:<14} {:.3f} secs in send() ({:.1f} us avg, {:.1f} ms max), display got {} frames, {} comm".format(
+            "DisplaySender:" if queued else "Pipe:", send_time, send_time / len(msgs) * 1e6, worst * 1000,
+            counts.get('frame_end', 0), counts.get('report_communication', 0)))
+        if queued:
+            stats = pipe.stats()
+            print("{:<14} dropped {} comm, {} frames ({} messages), {} oldest, max depth {}".format(
+                "", stats['dropped_comm'], stats['dropped_frames'], stats['dropped_frame_msgs'],
+                stats['dropped_oldest'], stats['max_depth']))
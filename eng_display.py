@@ -1,16 +1,28 @@
 #!/usr/bin/env python3
 
 import math
+import pickle
+import sys
 import time
 
+import numpy
+
 import tkinter as tk
 from tkinter import font
 from tkinter import *
 from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 from eng_colors import EngColors
 
+from display_protocol import decode_frame
+from frame_buffer import FrameBuffer
 from main import Main
 import config
+from scene import FontCache, Scene
+from telemetry_store import TelemetryStore
+from viewport import Viewport
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
 
 
 class EngDisplay:
@@ -19,7 +31,16 @@ class EngDisplay:
         self.parent_conn, self.child_conn = Pipe()
         self.parent_conn_serial_out, self.child_conn_serial_out = Pipe()
         self.data_src = src
-        self.main = Main(src, multi_pipe=self.child_conn, serial_pipe=self.child_conn_serial_out, repeat_log=repeat_log)
+        # Frames come through shared memory instead of the pipe, see frame_buffer.py
+        self.frames = FrameBuffer(len(config.NODES), len(config.NODES) ** 2) if config.DISPLAY_SHARED_FRAMES else None
+        self.last_frame = 0  # Number of the last frame drawn from self.frames
+        self.frame_written = None  # When the solver wrote it
+        self.frame_measured = None  # When its measurements came in, until it's on screen
+        self.frame_latency = None  # secs from the measurements to the screen
+        self.stats_times = {}  # {node_id: time of the last status update drawn from a frame}
+        self.range_counts = numpy.zeros(len(config.NODES) ** 2)  # Of the last frame drawn
+        self.main = Main(src, multi_pipe=self.child_conn, serial_pipe=self.child_conn_serial_out,
+                         repeat_log=repeat_log, frame_buffer=self.frames)
         if src is None:
             self.using_serial = True
         else:
@@ -41,6 +62,7 @@ class EngDisplay:
         self.paused = True
         self.not_cleared = True
         self.tk_version = tk.TclVersion
+        self.telemetry = TelemetryStore()  # Filled from status updates, for the trends in the details panel
         self.create_eng_display()
 
     def create_eng_display(self):
@@ -52,6 +74,21 @@ class EngDisplay:
                                      highlightthickness=0)
         self.window.wm_title(f"MNSLAC Engineering Display")
         self.canvas.pack(fill=BOTH, expand=YES)
+        # Nodes, links and labels keep their canvas items from frame to frame, see scene.py
+        self.scene = Scene(self.canvas)
+        self.canvas.scene = self.scene
+        self.fonts = FontCache()
+        self.frame_time = 0  # secs spent drawing since the last Hz update
+        self.messages_received = 0  # since the last Hz update
+        self.bytes_received = 0
+        self.cpu_idle = None  # Share of a core the display used over the last readout without/with frames
+        self.cpu_active = None
+        # Off-screen culling and zoomed out simplification, see viewport.py. The draw calls of the last frame
+        # are kept to draw it again when the view changes in between frames.
+        self.viewport = Viewport() if config.DISPLAY_CULLING else None
+        self.view = None  # (x_pos, y_pos, scale, width, height) the viewport was last updated for
+        self.frame_draws = []  # [(draw function, args)] of the current/last frame
+        self.in_frame = False
         self.zoom(3)
 
         # Add menu
@@ -179,8 +216,10 @@ class EngDisplay:
         y_pos_o = y_pos
         rows_per_col = 5
         row_counter = 0
-        for name in self.main.name_arr:
-            id1, id2 = name.split('-')
+        history = self.main.history
+        for pair in history.all_pairs():
+            name = history.get_key(pair)
+            id1, id2 = history.get_nodes(pair)
             n1 = self.main.node_list[id1].name
             n2 = self.main.node_list[id2].name
             n1 = n1[0] + n1.split()[1]
@@ -356,10 +395,10 @@ class EngDisplay:
             if refresh_hz == 60:
                 refresh_hz = 0  # Sets unlimited hz
                 self.details.itemconfig(self.update_hz_target_text, text="∞".format(float(refresh_hz)),
-                                        font=font.Font(family=self.colors.data_font, size=22))
+                                        font=self.fonts.get(self.colors.data_font, 22))
             else:
                 self.details.itemconfig(self.update_hz_target_text, text="≈{:.2f}Hz".format(float(refresh_hz)),
-                                        font=font.Font(family=self.colors.data_font, size=10))
+                                        font=self.fonts.get(self.colors.data_font, 10))
             self.parent_conn_serial_out.send({
                 'cmd': 'set_speed',
                 'speed': refresh_hz
@@ -391,76 +430,128 @@ class EngDisplay:
         self.closed = True
         print('Window Closed!')
         self.proc.terminate()
+        if self.frames is not None:
+            self.frames.unlink()
 
     def main_loop(self):
+        # Sleeps until a message comes in or the next render/readout is due instead of spinning on poll(). The
+        # canvas is rendered (and Tk events handled) once per 1 / config.DISPLAY_FPS secs, a finished frame waits
+        # for the next render and the pipe isn't read meanwhile.
+        interval = 1 / config.DISPLAY_FPS
         frame_end = False
-        receiving = True
-        last_update = 0
-        message_timer = 0
+        next_render = readout_start = time.perf_counter()
+        next_readout = readout_start + 0.5
+        readout_cpu = time.process_time()
         try:
             while True:
-                if time.time() - message_timer > 0.5:
-                    message_timer = time.time()
-                    self.draw_update_hz(int(self.cycle_counter / 0.5))
+                now = time.perf_counter()
+                if now >= next_readout:
+                    # CPU use of the display process over the readout, idle if no frame was drawn
+                    cpu = (time.process_time() - readout_cpu) / max(now - readout_start, 1e-6)
+                    if self.cycle_counter:
+                        self.cpu_active = cpu
+                    else:
+                        self.cpu_idle = cpu
+                    readout_cpu, readout_start = time.process_time(), now
+                    next_readout = now + 0.5
+                    frame_age = None if self.frame_written is None else time.time() - self.frame_written
+                    self.draw_update_hz(int(self.cycle_counter / 0.5), self.frame_time / max(self.cycle_counter, 1),
+                                        self.messages_received / 0.5,
+                                        self.bytes_received / max(self.cycle_counter, 1), frame_age,
+                                        self.frame_latency, cpu_idle=self.cpu_idle, cpu_active=self.cpu_active,
+                                        drawn=self.viewport.drawn() if self.viewport is not None else None)
                     self.cycle_counter = 0
-                if frame_end is True:
+                    self.frame_time = 0
+                    self.messages_received = 0
+                    self.bytes_received = 0
+                if now >= next_render:
+                    if self.frames is not None and self.draw_shared_frame():
+                        frame_end = True
+                    elif self.viewport is not None and not self.in_frame and self.view != self.current_view():
+                        self.redraw_frame()
                     if not self.update_frame():
                         return
-                    last_update = time.time()
-                    # self.clear_canvas()
+                    next_render = max(next_render + interval, time.perf_counter())
+                    if frame_end and self.frame_measured is not None:
+                        self.frame_latency = time.time() - self.frame_measured
+                        self.frame_measured = None
                     frame_end = False
-                elif time.time() - last_update > 0.03333333333:
-                    if not self.update_frame():
-                        return
-                    last_update = time.time()
-                while receiving is True:
-                    if self.parent_conn.poll():
-                        msg = self.parent_conn.recv()
-                        if type(msg) == dict and "cmd" in msg:
-                            if "args" not in msg:
-                                continue
-                            if msg['cmd'] == "frame_start":
-                                frame_end = False
-                                self.clear_canvas()
-                                self.cycle_counter += 1
-                            elif msg['cmd'] == "frame_end":
-                                frame_end = True
-                                break
-                            elif msg['cmd'] == "clear_screen":
-                                self.clear_canvas()
-                            elif msg['cmd'] == "draw_circle":
-                                self.draw_circle(msg['args'])
-                            elif msg['cmd'] == "connect_points":
-                                self.connect_points(msg['args'])
-                            elif msg['cmd'] == "status_update":
-                                self.status_update(msg['args'])
-                            elif msg['cmd'] == "report_communication":
-                                self.report_communication(msg['args'])
-                            elif msg['cmd'] == "clear_connection_list":
-                                self.clear_connection_list(msg['args'])
-                            else:
-                                print(f"Unknown command: {msg['cmd']}")
-                        else:
-                            print(msg)
-                    else:
-                        receiving = False
-                receiving = True
+                timeout = min(next_render, next_readout) - time.perf_counter()
+                if frame_end:
+                    time.sleep(max(timeout, 0))
+                elif wait([self.parent_conn], max(timeout, 0)):
+                    # Everything that's there, up to the end of a frame or the next render
+                    while not frame_end and time.perf_counter() < next_render and self.parent_conn.poll():
+                        frame_end = self.handle_message(self.parent_conn.recv_bytes())
         except tk.TclError:
             print('Close detected. Exit!')
             exit()
 
+    def handle_message(self, data):
+        # Applies a message from the pipe. Returns whether it ended a frame.
+        draw_start = time.perf_counter()
+        msg = pickle.loads(data)
+        self.messages_received += 1
+        self.bytes_received += len(data)
+        frame_end = False
+        if type(msg) == dict and "cmd" in msg:
+            if "args" not in msg:
+                return False
+            if msg['cmd'] == "frame_start":
+                self.begin_frame()
+                self.cycle_counter += 1
+            elif msg['cmd'] == "frame_end":
+                frame_end = True
+                self.end_frame()
+            elif msg['cmd'] == "frame":
+                frame_end = self.apply_frame(msg['args'])
+            elif msg['cmd'] == "clear_screen":
+                self.clear_canvas()
+            elif msg['cmd'] == "draw_circle":
+                self.draw_circle(msg['args'])
+            elif msg['cmd'] == "connect_points":
+                self.connect_points(msg['args'])
+            elif msg['cmd'] == "status_update":
+                self.status_update(msg['args'])
+            elif msg['cmd'] == "report_communication":
+                self.report_communication(msg['args'])
+            elif msg['cmd'] == "clear_connection_list":
+                self.clear_connection_list(msg['args'])
+            else:
+                print(f"Unknown command: {msg['cmd']}")
+        else:
+            print(msg)
+        self.frame_time += time.perf_counter() - draw_start
+        return frame_end
+
     # Interactive features
 
-    def draw_update_hz(self, hz_value):
+    def draw_update_hz(self, hz_value, frame_time=None, messages_per_sec=None, bytes_per_frame=None, frame_age=None,
+                       frame_latency=None, cpu_idle=None, cpu_active=None, drawn=None):
         txt = "{} Hz".format(hz_value)
+        if frame_time is not None:
+            txt += "  {:.1f} ms/frame".format(frame_time * 1000)
+        if messages_per_sec is not None:
+            txt += "  {:.0f} msg/s  {:.1f} KB/frame".format(messages_per_sec, bytes_per_frame / 1024)
+        if frame_age is not None:
+            txt += "  age {:.0f} ms".format(frame_age * 1000)
+        if frame_latency is not None:
+            txt += "  latency {:.0f} ms".format(frame_latency * 1000)
+        if cpu_idle is not None or cpu_active is not None:
+            txt += "  CPU {} idle {} active".format(*["{:.0%}".format(cpu) if cpu is not None else "-"
+                                                     for cpu in (cpu_idle, cpu_active)])
+        if drawn is not None:
+            txt += "  {}/{} drawn".format(*drawn)
         self.canvas.itemconfig(self.update_hz, text=txt)
 
     def update_frame(self):
+        start = time.perf_counter()
         try:
             self.window.update_idletasks()
             self.window.update()
         except:
             return False
+        self.frame_time += time.perf_counter() - start
         return True
 
     def measure(self, event):
@@ -496,8 +587,8 @@ class EngDisplay:
             # Create the text
             self.cur_line_txt = event.widget.create_text(midx, midy, text=dist,
                                                          fill=self.colors.text,
-                                                         font=font.Font(family=self.colors.data_font,
-                                                                        size=self.colors.text_size_large),
+                                                         font=self.fonts.get(self.colors.data_font,
+                                                                             self.colors.text_size_large),
                                                          justify=tk.LEFT, angle=rotation)
             # Create the line
             self.cur_line = event.widget.create_line(self.start_pos[0], self.start_pos[1], x,
@@ -520,6 +611,7 @@ class EngDisplay:
         self.universal_scale *= scale
         self.canvas.scale("obj", self.canvas.x_pos, self.canvas.y_pos, scale, scale)
         self.canvas.scale("obj-bg", self.canvas.x_pos, self.canvas.y_pos, scale, scale)
+        self.scene.invalidate()
 
     def translate_screen_pos_to_canvas_pos(self, x, y):
         return x - self.canvas.x_pos - self.canvas.x_offset, y - self.canvas.y_pos - self.canvas.y_offset
@@ -559,8 +651,37 @@ class EngDisplay:
 
     # Helper Functions
 
+    def begin_frame(self):
+        if self.not_cleared:
+            self.canvas.delete("del")
+            self.not_cleared = False
+        self.scene.begin_frame()
+        self.in_frame = True
+        if self.viewport is not None:
+            self.view = self.current_view()
+            self.viewport.update(*self.view)
+            self.viewport.begin_frame()
+            self.frame_draws = []
+
+    def end_frame(self):
+        self.scene.end_frame()
+        self.in_frame = False
+
+    def current_view(self):
+        return (self.canvas.x_pos, self.canvas.y_pos, self.universal_scale * self.meas_to_map, self.canvas.width,
+                self.canvas.height)
+
+    def redraw_frame(self):
+        # Draws the last frame again for the current view
+        draws = self.frame_draws
+        self.begin_frame()
+        for draw, args in draws:
+            draw(args)
+        self.end_frame()
+
     def clear_canvas(self):
-        self.canvas.delete("obj")
+        self.scene.clear()
+        self.frame_draws = []
         self.canvas.delete("del")
         self.not_cleared = False
 
@@ -575,13 +696,73 @@ class EngDisplay:
         for key in self.connection_list.keys():
             self.connection_list[key]['counter'] = 0
 
-    def report_communication(self, args):
+    def apply_frame(self, args):
+        # A batched message from display_protocol.FramePipe. Returns whether it ended a frame.
+        if args['clear_screen']:
+            self.clear_canvas()
+        for key, count in args['comm'].items():
+            self.report_communication({'key': key}, count)
+        for status in args['status']:
+            self.status_update(status)
+        if not args['drawn']:
+            return False
+        circles, links = decode_frame(args)
+        self.begin_frame()
+        self.cycle_counter += 1
+        for circle in circles:
+            self.draw_circle(circle)
+        for link in links:
+            self.connect_points(link)
+        self.end_frame()
+        return True
+
+    def draw_shared_frame(self):
+        # Draws the newest frame of the frame buffer, if there is a new one. Returns whether it drew one.
+        frame = self.frames.read(after=self.last_frame)
+        if frame is None:
+            return False
+        draw_start = time.perf_counter()
+        self.last_frame = int(frame['frame'])
+        self.frame_written = float(frame['time'])
+        self.frame_measured = float(frame['measured'])
+        history = self.main.history
+        x, y = frame['x'], frame['y']
+        self.begin_frame()
+        self.cycle_counter += 1
+        for i, node_id in enumerate(history.node_ids):
+            if not numpy.isnan(x[i]):
+                self.draw_circle({'x': float(x[i]), 'y': float(y[i]), 'r': float(frame['r'][i]), 'id': node_id,
+                                  'text': self.main.node_list[node_id].name})
+            stats_time = float(frame['stats_time'][i])
+            if not numpy.isnan(stats_time) and self.stats_times.get(node_id) != stats_time:
+                self.stats_times[node_id] = stats_time
+                self.status_update({'node_id': node_id, 'cycle': int(frame['cycle']), 'bat': float(frame['batt'][i]),
+                                    'temp': float(frame['temp'][i]), 'heading': float(frame['heading'][i])})
+        for pair in numpy.flatnonzero(~numpy.isnan(frame['dist'])):
+            i, j = divmod(int(pair), history.num_nodes)
+            if not numpy.isnan(x[i]) and not numpy.isnan(x[j]):
+                key = history.get_key(int(pair))
+                self.connect_points({'pos1': (float(x[i]), float(y[i])), 'pos2': (float(x[j]), float(y[j])),
+                                     'text': "{:.2f} m".format(frame['dist'][pair] / 1000), 'id': key})
+        self.end_frame()
+        # Range counts restart at 0 when a log is repeated, like the connection list does
+        ranges = frame['ranges']
+        for pair in numpy.flatnonzero(ranges != self.range_counts):
+            count = int(ranges[pair])
+            if count > self.range_counts[pair]:
+                count -= int(self.range_counts[pair])
+            self.report_communication({'key': history.get_key(int(pair))}, count)
+        self.range_counts = ranges
+        self.frame_time += time.perf_counter() - draw_start
+        return True
+
+    def report_communication(self, args, count=1):
         key = self.get_val_from_args(args, "key")
         if key is None:
             print(f"Invalid args input for function 'report_communication': {args}")
             return
         if key in self.connection_list:
-            self.connection_list[key]['counter'] += 1
+            self.connection_list[key]['counter'] += count
             txt = "{}: {:<5}".format(self.connection_list[key]['name'], self.connection_list[key]['counter'])
             self.details.itemconfig(self.connection_list[key]['txt_id'], text=txt)
         else:
@@ -602,11 +783,24 @@ class EngDisplay:
                 print(f"Node '{node_id}' not in the details list. Command 'status_update'.")
             return
 
-        txt = "{:<7}| BAT {:<4}, TEMP {:<5}, HDG {}".format(self.node_details_list[node_id]['name'],
-                                                            str(round(bat)) + "%", str(round(temp)) + "°C",
-                                                            str(round(heading)) + "°")
+        self.telemetry.add(node_id, self.get_val_from_args(args, "cycle") or 0, batt=bat, temp=temp, heading=heading)
+        trend = self.battery_trend(node_id)
+        txt = "{:<7}| BAT {:<4}, TEMP {:<5}, HDG {:<4} {}".format(self.node_details_list[node_id]['name'],
+                                                                  str(round(bat)) + "%", str(round(temp)) + "°C",
+                                                                  str(round(heading)) + "°", trend)
         self.details.itemconfig(self.node_details_list[node_id]['txt_id'], text=txt)
 
+    def battery_trend(self, node_id, points=5):
+        # Sparkline of the battery level over the last config.TELEMETRY_TREND_WINDOW secs
+        start = time.time() - config.TELEMETRY_TREND_WINDOW
+        times, values = self.telemetry.downsample(node_id, 'batt', points, start=start)
+        if len(values) < 2:
+            return ""
+        low, high = values.min(), values.max()
+        if high - low < 1:
+            return SPARK_CHARS[0] * len(values)
+        return "".join(SPARK_CHARS[int((value - low) / (high - low) * (len(SPARK_CHARS) - 1))] for value in values)
+
     def draw_circle(self, args):
         x = self.get_val_from_args(args, "x")
         y = self.get_val_from_args(args, "y")
@@ -619,9 +813,14 @@ class EngDisplay:
         text_color = self.get_val_from_args(args, "text_color")
         text_size = self.get_val_from_args(args, "text_size")
         text_y_bias = self.get_val_from_args(args, "text_y_bias")
+        ident = self.get_val_from_args(args, "id") or text  # Matches the circle to its canvas items
         if x is None or y is None or r is None:
             print(f"Invalid args input for function 'draw_circle': {args}")
             return
+        if self.viewport is not None:
+            self.frame_draws.append((self.draw_circle, args))
+            if not self.viewport.circle_visible(x, y, r):
+                return
         x = x * self.universal_scale
         y = y * self.universal_scale
         r = r * self.universal_scale
@@ -637,7 +836,9 @@ class EngDisplay:
         x = x * self.meas_to_map
         y = y * self.meas_to_map
         r = r * self.meas_to_map
-        self.create_circle(x, y, r, extra_tags=tags, fill=fill, width=width, outline=outline)
+        if self.viewport is not None and self.viewport.points:
+            r = self.viewport.point_radius
+        self.create_circle(x, y, r, extra_tags=tags, fill=fill, width=width, outline=outline, ident=ident)
 
         if text is not None:
             if text_color is None:
@@ -650,7 +851,7 @@ class EngDisplay:
                     ypos = y + r + 20
             else:
                 ypos = text_y_bias
-            self.create_text(x, ypos, text=text, color=text_color, size=text_size)
+            self.create_text(x, ypos, text=text, color=text_color, size=text_size, ident=ident)
 
     def connect_points(self, args):
         pos1 = self.get_val_from_args(args, "pos1")
@@ -664,13 +865,19 @@ class EngDisplay:
         if pos1 is None or pos2 is None:
             print(f"Invalid args input for function 'connect_points': {args}")
             return
+        if self.viewport is not None:
+            self.frame_draws.append((self.connect_points, args))
+            if None in pos1 or None in pos2 or not self.viewport.link_visible(pos1[0], pos1[1], pos2[0], pos2[1]):
+                return
+            if not self.viewport.link_labels:
+                text = None
         if dashed is None:
             dashed = True
 
-        if arrow is "both":
+        if arrow == "both":
             arrow = tk.BOTH
         else:
-            arrow = None
+            arrow = tk.NONE
 
         pos1_scaled = (pos1[0] * self.meas_to_map * self.universal_scale + self.canvas.x_pos,
                        pos1[1] * self.meas_to_map * self.universal_scale + self.canvas.y_pos)
@@ -678,27 +885,27 @@ class EngDisplay:
                        pos2[1] * self.meas_to_map * self.universal_scale + self.canvas.y_pos)
 
         self._connect_points(pos1_scaled, pos2_scaled, text=text, text_size=text_size, text_color=text_color,
-                             dashed=dashed, color=color, arrow=arrow)
+                             dashed=dashed, color=color, arrow=arrow, ident=self.get_val_from_args(args, "id"))
 
-    def create_circle(self, x, y, r, extra_tags=[], fill=None, outline=None, **kwargs):
+    def create_circle(self, x, y, r, extra_tags=[], fill=None, outline=None, ident=None, **kwargs):
         fill = self.refrence_color(fill, default=self.colors.text)
         outline = self.refrence_color(outline, default=self.colors.blank)
         (x, y) = self.translate_canvas_pos_to_screen_pos(x, y)
         tags = ["obj"]
-        return self.canvas.create_oval(x - r, y - r, x + r, y + r, tags=(tags + extra_tags), fill=fill, outline=outline,
-                                       **kwargs)
+        return self.scene.oval('node', ident, (x - r, y - r, x + r, y + r), tags=tuple(tags + extra_tags), fill=fill,
+                               outline=outline, **kwargs)
 
-    def create_text(self, x, y, text="", color=None, size=None, extra_tags=[], **kwargs):
+    def create_text(self, x, y, text="", color=None, size=None, extra_tags=[], ident=None, **kwargs):
         size = self.refrence_color(size, self.colors.text_size_large)
         color = self.refrence_color(color, default=self.colors.text)
         (x, y) = self.translate_canvas_pos_to_screen_pos(x, y)
         tags = ["obj"]
-        self.canvas.create_text(x, y, text=text,
-                                fill=color, font=font.Font(family=self.colors.data_font, size=size),
-                                justify=tk.LEFT, tags=(tags + extra_tags))
+        return self.scene.text('node_label', ident, (x, y), text=text, fill=color,
+                               font=self.fonts.get(self.colors.data_font, size), justify=tk.LEFT,
+                               tags=tuple(tags + extra_tags))
 
     def _connect_points(self, node1_pos, node2_pos, text=None, text_size=None, text_color=None, dashed=True,
-                        color="#3c4048", arrow=None):
+                        color="#3c4048", arrow=tk.NONE, ident=None):
         if node2_pos[0] is None or node2_pos[1] is None or node1_pos[0] is None or node1_pos[1] is None:
             return
         if text is not None:
@@ -715,22 +922,17 @@ class EngDisplay:
             midy = (node1_pos[1] + node2_pos[1]) / 2 - math.cos(rrotation) * 5
             text_size = self.refrence_color(text_size, self.colors.text_size_large)
             text_color = self.refrence_color(text_color, default=self.colors.text)
+            label_font = self.fonts.get(self.colors.data_font, text_size)
             if self.tk_version >= 8.6:
-                self.canvas.create_text(midx, midy, text=text,
-                                        fill=text_color, font=font.Font(family=self.colors.data_font, size=text_size),
-                                        justify=tk.LEFT, tags=['scale', 'obj'], angle=rotation)
+                self.scene.text('link_label', ident, (midx, midy), text=text, fill=text_color, font=label_font,
+                                justify=tk.LEFT, tags=('scale', 'obj'), angle=rotation)
             else:
-                self.canvas.create_text(midx, midy, text=text,
-                                        fill=text_color, font=font.Font(family=self.colors.data_font, size=text_size),
-                                        justify=tk.LEFT, tags=['scale', 'obj'])
+                self.scene.text('link_label', ident, (midx, midy), text=text, fill=text_color, font=label_font,
+                                justify=tk.LEFT, tags=('scale', 'obj'))
         color = self.refrence_color(color, default=self.colors.main_line)
-        if dashed is True:
-            self.canvas.create_line(node1_pos[0], node1_pos[1], node2_pos[0], node2_pos[1],
-                                    width=self.colors.line_width, fill=color, dash=self.colors.dash_type, arrow=arrow,
-                                    tags="obj")
-        else:
-            self.canvas.create_line(node1_pos[0], node1_pos[1], node2_pos[0], node2_pos[1],
-                                    width=self.colors.line_width, fill=color, arrow=arrow, tags="obj")
+        self.scene.line('link', ident, (node1_pos[0], node1_pos[1], node2_pos[0], node2_pos[1]),
+                        width=self.colors.line_width, fill=color, dash=self.colors.dash_type if dashed is True else '',
+                        arrow=arrow)
 
     def refrence_color(self, color, default=None):
         if color == default and default is not None:
@@ -757,6 +959,7 @@ class ResizingCanvas(Canvas):
         self.y_pos = 0
         self.x_offset = 0
         self.y_offset = 0
+        self.scene = None  # Told when items are moved, see scene.py
         self.move_by(self.width / 4, 100)
         self.callback = None
         self.last_resize = None
@@ -789,9 +992,16 @@ class ResizingCanvas(Canvas):
         self.y_pos = self.y_pos + y
         self.move('obj', x, y)
         self.move('obj-bg', x, y)
+        if self.scene is not None:
+            self.scene.invalidate()
 
 
 def main():
+    if '-headless' in sys.argv[1:]:
+        # Renders the log to image files instead of opening a window
+        import headless_render
+        headless_render.main([arg for arg in sys.argv[1:] if arg != '-headless'])
+        return
     if len(sys.argv) > 1:
         first = True
         use_light_theme = False
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+from multiprocessing import Pipe, Process, shared_memory
+import pickle
+import sys
+import time
+
+import numpy
+
+################
+# Frame buffer #
+################
+# Latest-frame exchange between the solver process and the display through
+# shared memory. The region holds a small header and SLOTS frames, each with:
+#   - seq: sequence counter of the slot, odd while the slot is being written
+#   - frame, cycle: frame number (from 1) and the cycle it shows
+#   - time: when the frame was written, measured: when its measurements came in
+#   - NODE_FIELDS: one value per node, NaN where unknown (e.g. unresolved nodes)
+#   - LINK_FIELDS: one value per link (pair), NaN where not measured
+# The writer never waits: it fills the slot after the latest one and then
+# points the header at it, so the two newest frames are never overwritten. The
+# reader copies the latest slot and checks that its sequence counter didn't
+# change meanwhile (a seqlock), trying again on the rare torn read. Frames the
+# reader was too slow for are skipped, it always gets the newest complete one.
+#
+# The creating side owns the region and has to unlink() it. Pickling a buffer
+# (e.g. for a spawned process) attaches to the same region by name.
+
+SLOTS = 3
+NODE_FIELDS = ('x', 'y', 'r', 'batt', 'temp', 'heading', 'stats_time')
+LINK_FIELDS = ('dist', 'std', 'ranges')
+HEADER = numpy.dtype([('latest', numpy.int64), ('frames', numpy.int64)])
+
+
+def frame_dtype(num_nodes, num_links):
+    fields = [('seq', numpy.int64), ('frame', numpy.int64), ('cycle', numpy.int64), ('time', numpy.float64),
+              ('measured', numpy.float64)]
+    fields += [(name, numpy.float64, (num_nodes,)) for name in NODE_FIELDS]
+    fields += [(name, numpy.float64, (num_links,)) for name in LINK_FIELDS]
+    return numpy.dtype(fields)
+
+
+class FrameBuffer:
+    def __init__(self, num_nodes, num_links, name=None, max_retries=10):
+        self.num_nodes = num_nodes
+        self.num_links = num_links
+        self.max_retries = max_retries
+        self.dtype = frame_dtype(num_nodes, num_links)
+        size = HEADER.itemsize + SLOTS * self.dtype.itemsize
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.header = numpy.ndarray((), dtype=HEADER, buffer=self.shm.buf)
+        self.slots = numpy.ndarray((SLOTS,), dtype=self.dtype, buffer=self.shm.buf, offset=HEADER.itemsize)
+        if self.owner:
+            self.slots.fill(0)
+            self.header['latest'] = -1
+            self.header['frames'] = 0
+
+        # Counters, of this side only
+        self.written_ctr = 0
+        self.read_ctr = 0
+        self.skipped_ctr = 0  # Frames overwritten before this side read them
+        self.retry_ctr = 0  # Torn reads
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __reduce__(self):
+        return FrameBuffer, (self.num_nodes, self.num_links, self.shm.name, self.max_retries)
+
+    def write(self, cycle, measured=None, **columns):
+        # 'columns' are NODE_FIELDS and LINK_FIELDS values, the ones left out are NaN
+        slot = (int(self.header['latest']) + 1) % SLOTS
+        frame_no = int(self.header['frames']) + 1
+        seqs = self.slots['seq']
+        seqs[slot] += 1
+        for name in NODE_FIELDS + LINK_FIELDS:
+            self.slots[name][slot] = columns.get(name, numpy.nan)
+        now = time.time()
+        self.slots['frame'][slot] = frame_no
+        self.slots['cycle'][slot] = cycle
+        self.slots['time'][slot] = now
+        self.slots['measured'][slot] = now if measured is None else measured
+        seqs[slot] += 1
+        self.header['latest'] = slot
+        self.header['frames'] = frame_no
+        self.written_ctr += 1
+        return frame_no
+
+    def read(self, after=0):
+        # A copy of the newest complete frame if it's newer than frame number 'after', otherwise None
+        seqs = self.slots['seq']
+        for _ in range(self.max_retries):
+            slot = int(self.header['latest'])
+            if slot < 0:
+                return None
+            seq = int(seqs[slot])
+            if seq & 1:
+                self.retry_ctr += 1
+                continue
+            if int(self.slots['frame'][slot]) <= after:
+                return None
+            frame = self.slots[slot:slot + 1].copy()[0]
+            if int(seqs[slot]) != seq:
+                self.retry_ctr += 1
+                continue
+            self.read_ctr += 1
+            if after:
+                self.skipped_ctr += int(frame['frame']) - after - 1
+            return frame
+        return None
+
+    def stats(self):
+        return {
+            'frames': int(self.header['frames']),
+            'written': self.written_ctr,
+            'read': self.read_ctr,
+            'skipped': self.skipped_ctr,
+            'retries': self.retry_ctr,
+            'bytes': self.shm.size,
+        }
+
+    def close(self):
+        # Views into the region have to go before it can be closed
+        self.header = self.slots = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+#############
+# Benchmark #
+#############
+# A writer process produces frames as fast as it can while the reader shows one
+# every 1/30 sec, once through a Pipe (one pickled frame per message, like the
+# display protocol) and once through a FrameBuffer. The age of the frames the
+# reader gets shows the Pipe's backlog, the writer rate how much it blocks.
+# Usage: python3 frame_buffer.py [num_nodes] [secs]
+
+def _columns(num_nodes, num_links, frame):
+    columns = {name: numpy.full(num_nodes, float(frame)) for name in NODE_FIELDS}
+    columns.update({name: numpy.full(num_links, float(frame)) for name in LINK_FIELDS})
+    return columns
+
+
+def _write_frames(target, num_nodes, num_links, duration, done):
+    # 'target' is a FrameBuffer or the sending end of a Pipe
+    frames = 0
+    end = time.time() + duration
+    while time.time() < end:
+        frames += 1
+        columns = _columns(num_nodes, num_links, frames)
+        if isinstance(target, FrameBuffer):
+            target.write(frames, **columns)
+        else:
+            target.send_bytes(pickle.dumps({'cycle': frames, 'time': time.time(), 'columns': columns}))
+    if not isinstance(target, FrameBuffer):
+        target.send_bytes(pickle.dumps(None))
+    done.send(frames)
+
+
+def _show_frames(source, duration):
+    # Ages (secs) of the frames shown at 30 Hz
+    ages = []
+    last = 0
+    end = time.time() + duration
+    while time.time() < end:
+        if isinstance(source, FrameBuffer):
+            frame = source.read(after=last)
+            if frame is not None:
+                last = int(frame['frame'])
+                ages.append(time.time() - frame['time'])
+        else:
+            frame = pickle.loads(source.recv_bytes())
+            if frame is None:
+                break
+            ages.append(time.time() - frame['time'])
+        time.sleep(1 / 30)  # Drawing
+    return ages
+
+
+if __name__ == "__main__":
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+    num_links = num_nodes * num_nodes
+
+    for shared in (False, True):
+        done_recv, done_send = Pipe(duplex=False)
+        if shared:
+            buffer = FrameBuffer(num_nodes, num_links)
+            source = target = buffer
+        else:
+            source, target = Pipe(duplex=False)
+        writer = Process(target=_write_frames, args=(target, num_nodes, num_links, duration, done_send))
+        writer.start()
+        ages = _show_frames(source, duration)
+        if not shared:
+            while pickle.loads(source.recv_bytes()) is not None:
+                pass  # The writer blocks until its backlog is read
+        frames = done_recv.recv()
+        writer.join()
+        print("{:<13} writer {:>8.0f} frames/sec, reader {} frames, age {:.1f} ms avg, {:.1f} ms max".format(
+            "FrameBuffer:" if shared else "Pipe:", frames / duration, len(ages), numpy.mean(ages) * 1000,
+            numpy.max(ages) * 1000))
+        if shared:
+            stats = buffer.stats()
+            print("{:<13} {} bytes, {} frames skipped by the reader, {} torn reads retried".format(
+                "", stats['bytes'], stats['skipped'], stats['retries']))
+            buffer.unlink()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import math
+import sys
+import time
+
+import numpy
+
+import config
+
+R_M = 6371008.771415  # Mean earth radius (m), the one pygeodesy's spherical LatLon uses by default
+
+#################
+# GPS transform #
+#################
+# Turns node positions (mm, anchored base at the origin, calculated base on the
+# x axis) into GPS coordinates. Everything that only depends on the two base
+# stations (their distance, the heading of the base line, the local east/north/up
+# axes at the anchored base) is computed once. The scale is recomputed when the
+# calculated base's x changes by more than 'tolerance'.
+#
+# Positions are scaled and rotated onto the base line, giving east = x' and
+# north = -y', then projected from the tangent plane at the anchored base back
+# onto the sphere. Over a few km that is within millimetres of the great circle
+# destination the backend used to compute per node with pygeodesy.
+
+class GpsTransform:
+    def __init__(self, anchored_gps=config.ANCHORED_BASE_GPS, calculated_gps=config.CALCULATED_BASE_GPS,
+                 tolerance=config.GPS_BASE_TOLERANCE):
+        self.tolerance = tolerance
+        lat1, lon1 = map(math.radians, anchored_gps)
+        lat2, lon2 = map(math.radians, calculated_gps)
+
+        # Haversine distance and initial bearings both ways between the bases
+        a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        self.real_base_distance = 2 * R_M * math.asin(math.sqrt(a))
+        bearing_there = self._bearing(lat1, lon1, lat2, lon2)
+        bearing_back = self._bearing(lat2, lon2, lat1, lon1)
+        self.heading_offset = (bearing_there + bearing_back - 180) / 2 - 90
+        rad = math.radians(self.heading_offset)
+        self.cos = math.cos(rad)
+        self.sin = math.sin(rad)
+
+        # Local tangent plane at the anchored base
+        self.origin = R_M * numpy.array([math.cos(lat1) * math.cos(lon1), math.cos(lat1) * math.sin(lon1),
+                                         math.sin(lat1)])
+        self.east = numpy.array([-math.sin(lon1), math.cos(lon1), 0])
+        self.north = numpy.array([-math.sin(lat1) * math.cos(lon1), -math.sin(lat1) * math.sin(lon1), math.cos(lat1)])
+
+        self.base_x = None
+        self.scale = None
+        self.recompute_ctr = 0
+
+    @staticmethod
+    def _bearing(lat1, lon1, lat2, lon2):
+        # Compass degrees [0, 360)
+        y = math.sin(lon2 - lon1) * math.cos(lat2)
+        x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(lon2 - lon1)
+        return math.degrees(math.atan2(y, x)) % 360
+
+    def update(self, base_x):
+        # 'base_x' is the calculated base's x (mm)
+        if self.base_x is None or abs(base_x - self.base_x) > self.tolerance:
+            self.base_x = base_x
+            self.scale = self.real_base_distance / base_x
+            self.recompute_ctr += 1
+
+    def to_gps(self, x, y):
+        # Returns (lat, lon) in degrees for scalars or arrays of positions
+        x = numpy.asarray(x, dtype=float) * self.scale
+        y = numpy.asarray(y, dtype=float) * self.scale
+        east = self.cos * x - self.sin * y
+        north = -(self.sin * x + self.cos * y)
+        point = self.origin + east[..., None] * self.east + north[..., None] * self.north
+        lat = numpy.degrees(numpy.arctan2(point[..., 2], numpy.hypot(point[..., 0], point[..., 1])))
+        lon = numpy.degrees(numpy.arctan2(point[..., 1], point[..., 0]))
+        return lat, lon
+
+
+#############
+# Benchmark #
+#############
+# Compares GpsTransform with the per-node pygeodesy path Backend used to have.
+# Usage: python3 geo_transform.py [num_nodes] [area_in_m]
+
+def _legacy_translate(x, y, base_x, ndigits=6):
+    from pygeodesy.sphericalNvector import LatLon
+    from statistics import mean
+    anchored_base, calculated_base = LatLon(*config.ANCHORED_BASE_GPS), LatLon(*config.CALCULATED_BASE_GPS)
+    real_base_distance = anchored_base.distanceTo(calculated_base)
+    distance_scale = real_base_distance / base_x
+    heading_offset = mean([anchored_base.initialBearingTo(calculated_base),
+                           calculated_base.initialBearingTo(anchored_base) - 180]) - 90
+    rad = math.radians(heading_offset)
+    new_x = math.cos(rad) * x * distance_scale - math.sin(rad) * y * distance_scale
+    new_y = math.sin(rad) * x * distance_scale + math.cos(rad) * y * distance_scale
+    n_d, n_a = math.sqrt(math.pow(new_x, 2) + math.pow(new_y, 2)), 90 - math.degrees(math.atan2(-new_y, new_x))
+    node_gps = anchored_base.destination(n_d, n_a)
+    return node_gps.latlon2(ndigits=6) if ndigits else (node_gps.lat, node_gps.lon)
+
+
+if __name__ == "__main__":
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    area = float(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    base_x = 75000.0
+    numpy.random.seed(1)
+    xs = numpy.random.uniform(-area, area, num_nodes) * 1000
+    ys = numpy.random.uniform(-area, area, num_nodes) * 1000
+
+    start = time.perf_counter()
+    legacy = numpy.array([_legacy_translate(x, y, base_x) for x, y in zip(xs, ys)])
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    transform = GpsTransform()
+    transform.update(base_x)
+    lat, lon = transform.to_gps(xs, ys)
+    batch_time = time.perf_counter() - start
+
+    # Error in metres against the unrounded pygeodesy result
+    exact = numpy.array([_legacy_translate(x, y, base_x, ndigits=None) for x, y in zip(xs, ys)])
+    err_north = numpy.abs(lat - exact[:, 0]) * math.pi / 180 * R_M
+    err_east = numpy.abs(lon - exact[:, 1]) * math.pi / 180 * R_M * numpy.cos(numpy.radians(exact[:, 0]))
+    rounded = numpy.round(lat, 6) == legacy[:, 0]
+    rounded &= numpy.round(lon, 6) == legacy[:, 1]
+    print("{} nodes within {:.0f} m of the anchored base".format(num_nodes, area))
+    print("pygeodesy per node: {:.4f} secs".format(legacy_time))
+    print("GpsTransform batch: {:.4f} secs ({:.0f}x)".format(batch_time, legacy_time / batch_time))
+    print("Max difference: {:.4f} m north, {:.4f} m east, {}/{} identical after rounding to 6 digits".format(
+        err_north.max(), err_east.max(), rounded.sum(), num_nodes))
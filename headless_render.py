@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+import math
+import os
+import pickle
+import struct
+import sys
+import time
+from xml.sax.saxutils import escape
+import zlib
+
+import numpy
+
+import config
+from display_protocol import decode_frame
+from eng_colors import EngColors
+
+###################
+# Headless render #
+###################
+# Renders a log to images without Tk or a display server. The log is replayed
+# through Main with a _FrameRecorder as its display pipe, which keeps the
+# command stream the engineering display would get (draw_circle,
+# connect_points, status_update, report_communication, ... and the batched
+# 'frame' messages) as one record per frame. The frames are then rendered to
+# one SVG or PNG file each (an image sequence, e.g. for ffmpeg), split into
+# contiguous ranges over a process pool.
+#
+# All frames share one view that fits everything drawn in the log, so nodes
+# don't jump around between images. Circles, links and labels follow the
+# display's defaults, and the node status and comm counters are listed in the
+# top left corner. PNGs are rasterized with NumPy and written with zlib, text
+# uses a built-in 5x7 pixel font (upper case only).
+#
+# Usage: python3 headless_render.py <log> [-o DIR] [-format png|svg] [-frames START:END] [-size WxH]
+#                                         [-workers N] [-light]
+# or eng_display.py with -headless and the same arguments.
+
+FORMATS = ('png', 'svg')
+MARGIN = 40  # px around everything drawn
+PANEL_WIDTH = 330  # px, the status list on the left
+
+
+class _FrameRecorder:
+    # Stands in for multi_pipe, see display_protocol.py for the batched messages
+    def __init__(self):
+        self.frames = []  # [{'circles': [args], 'links': [args], 'status': {node_id: args}, 'comm': {key: count}}]
+        self.circles = []
+        self.links = []
+        self.status = {}
+        self.comm = {}
+
+    def send(self, msg):
+        cmd = msg.get('cmd') if type(msg) == dict else None
+        args = msg.get('args') if cmd is not None else None
+        if cmd == 'frame_start' or cmd == 'clear_screen':
+            self.circles, self.links = [], []
+        elif cmd == 'frame_end':
+            self._end_frame()
+        elif cmd == 'draw_circle' and args is not None:
+            self.circles.append(args)
+        elif cmd == 'connect_points' and args is not None:
+            self.links.append(args)
+        elif cmd == 'status_update' and args is not None:
+            self.status[args.get('node_id')] = args
+        elif cmd == 'report_communication' and args is not None:
+            self.comm[args.get('key')] = self.comm.get(args.get('key'), 0) + 1
+        elif cmd == 'clear_connection_list':
+            self.comm = {key: 0 for key in self.comm}
+        elif cmd == 'frame':
+            if args['clear_screen']:
+                self.circles, self.links = [], []
+            for key, count in args['comm'].items():
+                self.comm[key] = self.comm.get(key, 0) + count
+            for status in args['status']:
+                self.status[status.get('node_id')] = status
+            if args['drawn']:
+                self.circles, self.links = decode_frame(args)
+                self._end_frame()
+
+    def send_bytes(self, data):
+        self.send(pickle.loads(data))
+
+    def _end_frame(self):
+        self.frames.append({'circles': self.circles, 'links': self.links, 'status': dict(self.status),
+                            'comm': dict(self.comm)})
+        self.circles, self.links = [], []
+
+
+def record_log(src):
+    # The frames the display would show for the log 'src'
+    from main import Main
+    recorder = _FrameRecorder()
+    Main(src, multi_pipe=recorder).run()
+    return recorder.frames
+
+
+def fit_view(frames, width, height):
+    # (scale in px per mm, x offset, y offset) showing everything drawn in 'frames' right of the panel
+    xs, ys = [], []
+    for frame in frames:
+        for args in frame['circles']:
+            r = args.get('r') or 0
+            xs += [args['x'] - r, args['x'] + r]
+            ys += [args['y'] - r, args['y'] + r]
+        for args in frame['links']:
+            xs += [args['pos1'][0], args['pos2'][0]]
+            ys += [args['pos1'][1], args['pos2'][1]]
+    xs = [x for x in xs if x is not None]
+    ys = [y for y in ys if y is not None]
+    if not xs or not ys:
+        return 1 / 1000, PANEL_WIDTH + MARGIN, MARGIN
+    x0, x1, y0, y1 = min(xs), max(xs), min(ys), max(ys)
+    area_width = width - PANEL_WIDTH - 2 * MARGIN
+    area_height = height - 2 * MARGIN - 20  # Room for the labels above the nodes
+    scale = min(area_width / max(x1 - x0, 1), area_height / max(y1 - y0, 1))
+    x_off = PANEL_WIDTH + MARGIN + (area_width - (x1 - x0) * scale) / 2 - x0 * scale
+    y_off = MARGIN + 20 + (area_height - (y1 - y0) * scale) / 2 - y0 * scale
+    return scale, x_off, y_off
+
+
+##########
+# Images #
+##########
+# Both take colors as Tk does ("#rgb", "#rrggbb" or a name), "" is transparent.
+
+_NAMED_COLORS = {
+    'white': (255, 255, 255), 'black': (0, 0, 0), 'red': (255, 0, 0), 'orange': (255, 165, 0),
+    'yellow': (255, 255, 0), 'cyan': (0, 255, 255), 'purple': (128, 0, 128),
+}
+
+# 5x7 pixel font, one 5 bit row per line from the top
+_FONT = {
+    '0': (14, 17, 19, 21, 25, 17, 14), '1': (4, 12, 4, 4, 4, 4, 14), '2': (14, 17, 1, 2, 4, 8, 31),
+    '3': (31, 2, 4, 2, 1, 17, 14), '4': (2, 6, 10, 18, 31, 2, 2), '5': (31, 16, 30, 1, 1, 17, 14),
+    '6': (6, 8, 16, 30, 17, 17, 14), '7': (31, 1, 2, 4, 8, 8, 8), '8': (14, 17, 17, 14, 17, 17, 14),
+    '9': (14, 17, 17, 15, 1, 2, 12), 'A': (14, 17, 17, 17, 31, 17, 17), 'B': (30, 17, 17, 30, 17, 17, 30),
+    'C': (14, 17, 16, 16, 16, 17, 14), 'D': (28, 18, 17, 17, 17, 18, 28), 'E': (31, 16, 16, 30, 16, 16, 31),
+    'F': (31, 16, 16, 30, 16, 16, 16), 'G': (14, 17, 16, 23, 17, 17, 15), 'H': (17, 17, 17, 31, 17, 17, 17),
+    'I': (14, 4, 4, 4, 4, 4, 14), 'J': (7, 2, 2, 2, 2, 18, 12), 'K': (17, 18, 20, 24, 20, 18, 17),
+    'L': (16, 16, 16, 16, 16, 16, 31), 'M': (17, 27, 21, 21, 17, 17, 17), 'N': (17, 17, 25, 21, 19, 17, 17),
+    'O': (14, 17, 17, 17, 17, 17, 14), 'P': (30, 17, 17, 30, 16, 16, 16), 'Q': (14, 17, 17, 17, 21, 18, 13),
+    'R': (30, 17, 17, 30, 20, 18, 17), 'S': (15, 16, 16, 14, 1, 1, 30), 'T': (31, 4, 4, 4, 4, 4, 4),
+    'U': (17, 17, 17, 17, 17, 17, 14), 'V': (17, 17, 17, 17, 17, 10, 4), 'W': (17, 17, 17, 21, 21, 21, 10),
+    'X': (17, 17, 10, 4, 10, 17, 17), 'Y': (17, 17, 17, 10, 4, 4, 4), 'Z': (31, 1, 2, 4, 8, 16, 31),
+    ' ': (0, 0, 0, 0, 0, 0, 0), '.': (0, 0, 0, 0, 0, 12, 12), ',': (0, 0, 0, 0, 12, 4, 8),
+    '-': (0, 0, 0, 31, 0, 0, 0), '+': (0, 4, 4, 31, 4, 4, 0), '=': (0, 0, 31, 0, 31, 0, 0),
+    ':': (0, 12, 12, 0, 12, 12, 0), '%': (24, 25, 2, 4, 8, 19, 3), '/': (0, 1, 2, 4, 8, 16, 0),
+    '|': (4, 4, 4, 4, 4, 4, 4), '_': (0, 0, 0, 0, 0, 0, 31), '(': (2, 4, 8, 8, 8, 4, 2),
+    ')': (8, 4, 2, 2, 2, 4, 8), '°': (12, 18, 18, 12, 0, 0, 0), '?': (14, 17, 1, 2, 4, 0, 4),
+}
+_GLYPHS = {char: numpy.array([[(row >> (4 - col)) & 1 for col in range(5)] for row in rows], dtype=bool)
+           for char, rows in _FONT.items()}
+
+
+def parse_color(color):
+    # (r, g, b), None for ""
+    if not color:
+        return None
+    if color.startswith('#'):
+        digits = color[1:]
+        if len(digits) == 3:
+            digits = ''.join(digit * 2 for digit in digits)
+        return tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4))
+    return _NAMED_COLORS.get(color.lower(), (255, 255, 255))
+
+
+_backgrounds = {}  # {(width, height, color): empty image}, filling one is slower than copying it
+
+
+class PngImage:
+    def __init__(self, width, height, background):
+        self.width = width
+        self.height = height
+        key = (width, height, background)
+        if key not in _backgrounds:
+            _backgrounds[key] = numpy.empty((height, width, 3), dtype=numpy.uint8)
+            _backgrounds[key][:] = parse_color(background) or (0, 0, 0)
+        self.pixels = _backgrounds[key].copy()
+
+    def _box(self, x0, y0, x1, y1):
+        # Integer pixel bounds clipped to the image, None if nothing is left
+        x0, y0 = max(int(math.floor(x0)), 0), max(int(math.floor(y0)), 0)
+        x1, y1 = min(int(math.ceil(x1)) + 1, self.width), min(int(math.ceil(y1)) + 1, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def circle(self, x, y, r, fill=None, outline=None, width=1):
+        box = self._box(x - r, y - r, x + r, y + r)
+        if box is None:
+            return
+        x0, y0, x1, y1 = box
+        yy, xx = numpy.mgrid[y0:y1, x0:x1]
+        dist = numpy.hypot(xx + 0.5 - x, yy + 0.5 - y)
+        area = self.pixels[y0:y1, x0:x1]
+        fill, outline = parse_color(fill), parse_color(outline)
+        if fill is not None:
+            area[dist <= r] = fill
+        if outline is not None:
+            area[(dist <= r) & (dist > r - max(width, 1))] = outline
+
+    def line(self, x1, y1, x2, y2, color, width=1, dash=None):
+        color = parse_color(color)
+        if color is None:
+            return
+        steps = int(max(abs(x2 - x1), abs(y2 - y1))) + 1
+        if steps > 4 * (self.width + self.height):
+            return  # Way off the image
+        t = numpy.arange(steps + 1) / steps
+        xs = numpy.round(x1 + (x2 - x1) * t).astype(int)
+        ys = numpy.round(y1 + (y2 - y1) * t).astype(int)
+        if dash:
+            on = numpy.arange(len(t)) % sum(dash) < dash[0]
+            xs, ys = xs[on], ys[on]
+        half = max(int(width), 1) // 2
+        for dx in range(-half, max(int(width), 1) - half):
+            for dy in range(-half, max(int(width), 1) - half):
+                px, py = xs + dx, ys + dy
+                inside = (px >= 0) & (px < self.width) & (py >= 0) & (py < self.height)
+                self.pixels[py[inside], px[inside]] = color
+
+    def text(self, x, y, text, color, size=12, anchor='center'):
+        color = parse_color(color)
+        if color is None or not text:
+            return
+        scale = max(1, int(round(size / 8)))
+        text = str(text).upper()
+        if anchor == 'center':
+            x -= len(text) * 6 * scale / 2
+            y -= 7 * scale / 2
+        x, y = int(round(x)), int(round(y))
+        for char in text:
+            glyph = _GLYPHS.get(char, _GLYPHS['?'])
+            if scale > 1:
+                glyph = glyph.repeat(scale, axis=0).repeat(scale, axis=1)
+            box = self._box(x, y, x + glyph.shape[1] - 1, y + glyph.shape[0] - 1)
+            if box is not None:
+                x0, y0, x1, y1 = box
+                mask = glyph[y0 - y:y1 - y, x0 - x:x1 - x]
+                self.pixels[y0:y1, x0:x1][mask] = color
+            x += 6 * scale
+
+    def save(self, path):
+        rows = numpy.zeros((self.height, self.width * 3 + 1), dtype=numpy.uint8)  # Filter byte 0 (none) per row
+        rows[:, 1:] = self.pixels.reshape(self.height, -1)
+
+        def chunk(kind, data):
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+        with open(path, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n')
+            f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0)))
+            f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 1)))  # Mostly background, compresses well anyway
+            f.write(chunk(b'IEND', b''))
+
+
+class SvgImage:
+    def __init__(self, width, height, background, font_family="Courier New"):
+        self.width = width
+        self.height = height
+        self.font_family = font_family
+        self.elements = ['<rect width="100%" height="100%" fill="{}"/>'.format(background)]
+
+    def circle(self, x, y, r, fill=None, outline=None, width=1):
+        self.elements.append('<circle cx="{:.1f}" cy="{:.1f}" r="{:.1f}" fill="{}" stroke="{}" stroke-width="{}"/>'
+                             .format(x, y, r, fill or 'none', outline or 'none', width))
+
+    def line(self, x1, y1, x2, y2, color, width=1, dash=None):
+        if not color:
+            return
+        dash = ' stroke-dasharray="{}"'.format(' '.join(str(d) for d in dash)) if dash else ''
+        self.elements.append('<line x1="{:.1f}" y1="{:.1f}" x2="{:.1f}" y2="{:.1f}" stroke="{}" stroke-width="{}"{}/>'
+                             .format(x1, y1, x2, y2, color, width, dash))
+
+    def text(self, x, y, text, color, size=12, anchor='center', angle=0):
+        if not color or not text:
+            return
+        attrs = ' text-anchor="middle" dominant-baseline="central"' if anchor == 'center' else \
+            ' dominant-baseline="hanging"'
+        if angle:
+            attrs += ' transform="rotate({:.1f} {:.1f} {:.1f})"'.format(-angle, x, y)
+        self.elements.append('<text x="{:.1f}" y="{:.1f}" fill="{}" font-family="{}" font-size="{}"{}>{}</text>'.format(
+            x, y, color, escape(self.font_family), size, attrs, escape(str(text))))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write('<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}">\n'.format(self.width, self.height))
+            f.write('\n'.join(self.elements))
+            f.write('\n</svg>\n')
+
+
+#############
+# Rendering #
+#############
+
+def _color(colors, color, default):
+    # Like EngDisplay.refrence_color(): names of EngColors attributes, anything else is the default
+    if color is not None and isinstance(color, str) and hasattr(colors, color):
+        return getattr(colors, color)
+    return default
+
+
+def render_frame(frame, number, image, view, colors):
+    scale, x_off, y_off = view
+    for args in frame['links']:
+        (x1, y1), (x2, y2) = args['pos1'], args['pos2']
+        if None in (x1, y1, x2, y2):
+            continue
+        x1, y1, x2, y2 = x1 * scale + x_off, y1 * scale + y_off, x2 * scale + x_off, y2 * scale + y_off
+        dashed = args.get('dashed', True) is not False
+        image.line(x1, y1, x2, y2, _color(colors, args.get('color'), colors.main_line), colors.line_width,
+                   colors.dash_type if dashed else None)
+        if args.get('text') is not None:
+            angle = 180 - math.degrees(math.atan2(y1 - y2, x1 - x2))
+            if 90 < angle < 270:
+                angle -= 180
+            size = _color(colors, args.get('text_size'), colors.text_size_large)
+            color = _color(colors, args.get('text_color'), colors.text)
+            if isinstance(image, SvgImage):
+                image.text((x1 + x2) / 2, (y1 + y2) / 2, args['text'], color, size, angle=angle)
+            else:
+                image.text((x1 + x2) / 2, (y1 + y2) / 2, args['text'], color, size)
+    for args in frame['circles']:
+        x, y, r = args['x'] * scale + x_off, args['y'] * scale + y_off, args['r'] * scale
+        image.circle(x, y, r, _color(colors, args.get('fill'), colors.text),
+                     _color(colors, args.get('outline'), colors.blank), args.get('width') or 3)
+        if args.get('text') is not None:
+            ypos = y - r - 20 if y - r - 20 >= 0 else y + r + 20
+            image.text(x, ypos, args['text'], _color(colors, args.get('text_color'), colors.text),
+                       _color(colors, args.get('text_size'), colors.text_size_large))
+
+    # Status list, like the display's details panel
+    lines = ["Frame {}".format(number)]
+    for node_id, status in sorted(frame['status'].items(), key=lambda item: str(item[0])):
+        name = config.NODES.get(node_id, {}).get('name', node_id)
+        lines.append("{:<10}| BAT {:>3}% TEMP {:>3}° HDG {:>3}°".format(
+            name, round(status.get('bat') or 0), round(status.get('temp') or 0), round(status.get('heading') or 0)))
+    lines += ["{}: {}".format(key, count) for key, count in sorted(frame['comm'].items())]
+    for i, line in enumerate(lines):
+        image.text(10, 10 + i * 16, line, colors.text_details, colors.text_size_small, anchor='nw')
+
+
+def _render_range(frames, first, out_dir, fmt, size, view, light):
+    # Renders 'frames' (numbers from 'first') to out_dir/frame_NNNNNN.<fmt>, in a pool worker
+    colors = EngColors(use_dark=not light)
+    width, height = size
+    for i, frame in enumerate(frames):
+        if fmt == 'svg':
+            image = SvgImage(width, height, colors.background, colors.data_font)
+        else:
+            image = PngImage(width, height, colors.background)
+        render_frame(frame, first + i, image, view, colors)
+        image.save(os.path.join(out_dir, "frame_{:06d}.{}".format(first + i, fmt)))
+    return len(frames)
+
+
+def render(frames, out_dir, fmt='png', size=(1280, 720), start=0, end=None, workers=None, light=False):
+    # Renders frames[start:end] over 'workers' processes (all cores if None), returns how many
+    if fmt not in FORMATS:
+        raise ValueError("Unknown image format '{}'".format(fmt))
+    os.makedirs(out_dir, exist_ok=True)
+    view = fit_view(frames, *size)
+    end = len(frames) if end is None else min(end, len(frames))
+    if start >= end:
+        return 0
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        return _render_range(frames[start:end], start, out_dir, fmt, size, view, light)
+    # A few contiguous ranges per worker, so a slow range doesn't hold up the others
+    step = max(1, -(-(end - start) // (workers * 4)))
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = [pool.submit(_render_range, frames[i:min(i + step, end)], i, out_dir, fmt, size, view, light)
+                for i in range(start, end, step)]
+        return sum(job.result() for job in jobs)
+
+
+def main(argv):
+    src = None
+    out_dir = "frames"
+    fmt = 'png'
+    size = (1280, 720)
+    start, end = 0, None
+    workers = None
+    light = False
+    args = iter(argv)
+    try:
+        for arg in args:
+            if arg == '-o':
+                out_dir = next(args)
+            elif arg == '-format':
+                fmt = next(args)
+            elif arg == '-frames':
+                first, colon, last = next(args).partition(':')
+                start = int(first or 0)
+                end = int(last) if last else (None if colon else start + 1)  # "N" is just frame N
+            elif arg == '-size':
+                size = tuple(int(value) for value in next(args).lower().split('x'))
+            elif arg == '-workers':
+                workers = int(next(args))
+            elif arg == '-l' or arg == '-light':
+                light = True
+            elif src is None:
+                src = arg
+            else:
+                print(f"Unknown command entry: {arg}")
+                exit(1)
+    except (StopIteration, ValueError):
+        print("Invalid arguments: {}".format(' '.join(argv)))
+        exit(1)
+    if src is None or fmt not in FORMATS:
+        print("Usage: headless_render.py <log> [-o DIR] [-format png|svg] [-frames START:END] [-size WxH] "
+              "[-workers N] [-light]")
+        exit(1)
+
+    start_time = time.time()
+    frames = record_log(src)
+    record_time = time.time() - start_time
+    start_time = time.time()
+    rendered = render(frames, out_dir, fmt, size, start, end, workers, light)
+    render_time = time.time() - start_time
+    print("Recorded {} frames in {:.2f} secs, rendered {} to '{}' in {:.2f} secs ({:.1f} frames/sec)".format(
+        len(frames), record_time, rendered, out_dir, render_time, rendered / render_time if render_time else 0))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
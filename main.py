@@ -1,18 +1,31 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
+import functools
 import importlib
 import serial
 import sys
 import select
 import time
 import threading
+import numpy
 
 from algorithms.helpers.node import Node
 from backend import Backend
-from battery import volts_to_percentage
+from change_detector import ChangeDetector
+from cycle_history import CycleHistory
+from battery import battery_model
+import binary_protocol
 import config
-from meas_history import MeasHistory
+from display_protocol import FramePipe
+from display_sender import DisplaySender
+from frame_buffer import NODE_FIELDS
+from meas_history import MeasHistoryTable
+from packet_decoder import decode_buffer, RangePacket, StatsPacket
+from pipeline import IngestPipeline
+from serial_reader import BulkReader, GroupCommitLog
+from solver import AlgorithmRunner, CycleSnapshot, SolverWorker, merge_dirty
+from telemetry_store import TelemetryStore
 
 
 ########
@@ -21,28 +34,41 @@ from meas_history import MeasHistory
 
 class Main:
 
-    def __init__(self, src=None, alg_name='multi_tri', multi_pipe=None, serial_pipe=None, repeat_log=False):
+    def __init__(self, src=None, alg_name='multi_tri', multi_pipe=None, serial_pipe=None, repeat_log=False,
+                 frame_buffer=None):
 
-        self.PACKET_PROCESSORS = {"Range Packet": self.process_range, "Stats Packet": self.process_stats}
+        self.PACKET_PROCESSORS = {RangePacket: self.process_range, StatsPacket: self.process_stats}
 
         # Communication with engineering display
+        if multi_pipe is not None and config.DISPLAY_BATCH:
+            multi_pipe = FramePipe(multi_pipe)
+        if multi_pipe is not None and config.DISPLAY_SENDER:
+            multi_pipe = DisplaySender(multi_pipe)
         self.multi_pipe = multi_pipe
+        # With a frame buffer (see frame_buffer.py) frames, comm counts and telemetry go through shared memory
+        self.frame_buffer = frame_buffer
         self.kill = False
         self.log_file_name = None
         self.repeat_log = repeat_log
+        self.paused = True
+        self.pause_time = 0
 
         # Load from file if specified, otherwise serial
         if src:
+            # Binary logs are recognised by their extension, text logs are the default
+            self.binary = src.endswith(binary_protocol.LOG_EXTENSION)
             self.src_input = src
-            self.src = open(src)
+            self.src = open(src, 'rb')
             self.log_file = None
             self.playback_pipe = serial_pipe
         else:
             self.repeat_log = False
+            self.binary = config.SERIAL_PROTOCOL == 'binary'
             try:
                 self.src = serial.Serial(config.SERIAL_PORT, config.SERIAL_BAUD)
-                self.log_file_name = "log-{}.log".format(datetime.now().strftime("%Y%m%d-%H%M%S"))
-                self.log_file = open(self.log_file_name, 'w')
+                log_extension = binary_protocol.LOG_EXTENSION if self.binary else ".log"
+                self.log_file_name = "log-{}{}".format(datetime.now().strftime("%Y%m%d-%H%M%S"), log_extension)
+                self.log_file = GroupCommitLog(open(self.log_file_name, 'wb'))
                 # Thread for piping stdin to the serial port (for manually typing commands)
                 serial_sender = SerialSender(output_pipe=self.src, multi_pipe=serial_pipe)
                 self.playback_pipe = None
@@ -58,29 +84,40 @@ class Main:
                 return
 
         # Load algorithm
+        self.alg_name = alg_name
+        self.solver = None
         alg_module = importlib.import_module('algorithms.' + alg_name + '.' + alg_name)
         self.algorithm = getattr(alg_module, alg_name)
+        self.runner = AlgorithmRunner(self.algorithm, Main.r_nodes, Main.ANCHORED_BASE, Main.CALCULATED_BASE)
+        self.last_snapshot = None
+        self.change_detector = ChangeDetector(Main.CALCULATED_BASE) if config.CHANGE_DETECTION else None
+        self.dirty_nodes = set()  # Node IDs that were dirty but not in a solve's results yet
+
+        # Telemetry of every node, see telemetry_store.py
+        self.telemetry = TelemetryStore()
+        # Volts to percent of every node's battery, looked up once rather than per packet
+        self.battery_percentage = {node_id: battery_model(node_id).to_percentage for node_id in Main.r_nodes}
 
         # Connect to backend
-        self.backend = Backend(Main.ANCHORED_BASE, Main.CALCULATED_BASE)
-        if self.multi_pipe:
+        self.backend = Backend(Main.ANCHORED_BASE, Main.CALCULATED_BASE, telemetry=self.telemetry)
+        if self.multi_pipe and self.frame_buffer is None:
             for node_id, node in Main.r_nodes.items():
                 node.set_pipe(self.multi_pipe)
 
-        self.name_arr = []
-        self.history = {}
-        for key, value in Main.r_nodes.items():
-            val = int(key)
-            for i in range(val + 1, len(Main.r_nodes)):
-                self.name_arr.append(f"{val}-{i}")
+        # Pairs only get a history once they are heard from, see meas_history.py
+        self.history = MeasHistoryTable(Main.r_nodes.keys(), reject_outliers=config.RANGE_OUTLIER_REJECTION)
+        self.auto_base_pair = self.history.pair_index(Main.ANCHORED_BASE, Main.CALCULATED_BASE)
+        if Main.AUTO_SETUP_BASE is True:
+            self.history.set_limits(self.auto_base_pair, max_meas=100, min_vals=5)
 
-        for name in self.name_arr:
-            if Main.AUTO_SETUP_BASE is True and name == Main.auto_base_meas_key:
-                self.history[name] = MeasHistory(name, max_meas=100, min_vals=5)
-            else:
-                self.history[name] = MeasHistory(name)
         self.node_list = Main.r_nodes
 
+        # Frame buffer state: the nodes of the last solve, range counts per pair and when the measurements of
+        # the last snapshot came in
+        self.frame_nodes = Main.r_nodes
+        self.range_counts = numpy.zeros(self.history.num_nodes ** 2)
+        self.snapshot_time = None
+
     def run(self):
         if self.kill:
             return
@@ -89,84 +126,155 @@ class Main:
         # Clear out the backend of stale data
         self.backend.clear_nodes()
 
-        line_ctr = 0
-        packet_ctr = 0
+        # Started here rather than in __init__ since run() may be in a different process
+        if config.SOLVER_PROCESS:
+            self.solver = SolverWorker(self.alg_name, Main.r_nodes, Main.ANCHORED_BASE, Main.CALCULATED_BASE)
+
+        self.line_ctr = 0
+        self.packet_ctr = 0
         start_time = time.time()
 
-        paused = True
-        do = True
-        self.pause_time = 0
+        if config.INGEST_PIPELINE:
+            IngestPipeline(self).run()
+        else:
+            for packet in self.read_packets():
+                # Pass to packet processor for processing
+                self.PACKET_PROCESSORS[type(packet)](packet)
 
-        while do or self.repeat_log is True:
-            self.src.readline()  # discard first (possibly incomplete) line
-            for line in self.src:
-                if self.playback_pipe is not None:
-
-                    while do or paused is True:
-                        do = False
-                        msg = None
-                        if paused:
-                            msg = self.playback_pipe.recv()
-                        elif self.playback_pipe.poll():
-                            msg = self.playback_pipe.recv()
-                        if msg is not None and type(msg) == dict and "cmd" in msg:
-                            if msg['cmd'] == "play":
-                                paused = False
-                            elif msg['cmd'] == "pause":
-                                paused = True
-                            elif msg['cmd'] == "set_speed" and 'speed' in msg:
-                                if float(msg['speed']) == 0:
-                                    self.pause_time = 0
-                                else:
-                                    self.pause_time = 1 / float(msg['speed'])
-                    do = True
-                try:
-                    # Try to decode 'bytes' from serial
-                    line = line.decode("utf-8")
-                except AttributeError:
-                    # Probably already a 'str' from file
-                    pass
-
-                # Write log, flush to make sure we got it down
-                if self.log_file:
-                    self.log_file.write(line)
-                    self.log_file.flush()
-
-                tmp = line.strip().split("|")
-                line_ctr += 1
-
-                # Make sure we have a valid packet
-                if len(tmp) != 2:
-                    continue
-
-                # Check packet type
-                packet_type = tmp[0].strip()
-                if packet_type not in self.PACKET_PROCESSORS.keys():
-                    continue
-                packet_ctr += 1
-
-                # Clean up packet contents
-                packet_contents = tmp[1].strip().split(',')
-                for i in range(len(packet_contents)):
-                    packet_contents[i] = packet_contents[i].strip().split(":")[1]
+        print()
+        print("Processed {} lines ({} packets) in {} secs".format(self.line_ctr, self.packet_ctr,
+                                                                  time.time() - start_time))
+        if self.solver is not None:
+            self.solver.close(self.solver_result)
+            solver_stats = self.solver.stats()
+            print("Solver: {} cycles submitted, {} completed, {} dropped, {:.3f} secs avg".format(
+                solver_stats['submitted'], solver_stats['completed'], solver_stats['dropped'],
+                solver_stats['avg_solve_time']))
+        if self.change_detector is not None:
+            change_stats = self.change_detector.stats()
+            print("Change detection: {} cycles solved, {} skipped ({:.0%} skipped)".format(
+                change_stats['solved'], change_stats['skipped'], change_stats['skip_ratio']))
+        if self.history.reject_outliers:
+            print("Outlier rejection: {} range samples rejected".format(self.history.rejected()))
+        print("Total non-base node resolutions: {}".format(Main.resolved_ctr))
+        print("Telemetry: {} samples of {} nodes stored ({} KB)".format(
+            len(self.telemetry), len(self.telemetry.nodes()), self.telemetry.nbytes() // 1024))
+        self.backend.close()
+        backend_stats = self.backend.stats()
+        if self.backend.publisher is not None:
+            print("Backend: {} updates in {} requests ({} bytes), {} sent, {} failed, {} dropped, "
+                  "{:.3f} secs avg latency".format(backend_stats['updates'], backend_stats['requests'],
+                                                   backend_stats['mutation_bytes'], backend_stats['sent'],
+                                                   backend_stats['failed'], backend_stats['dropped'],
+                                                   backend_stats['avg_latency']))
+        if self.backend.spool is not None:
+            print("Backend spool: {} updates added, {} replaced by newer ones, {} replayed in {} requests "
+                  "({} failed), {} still spooled".format(backend_stats['added'], backend_stats['compacted'],
+                                                          backend_stats['replayed'], backend_stats['replay_requests'],
+                                                          backend_stats['replay_failures'], backend_stats['spooled']))
+        if self.backend.coalescer is not None:
+            print("Backend coalescing: {} updates offered, {} sent ({} heartbeats), {} replaced by newer ones, "
+                  "{} suppressed".format(backend_stats['offered'], backend_stats['sent_updates'],
+                                         backend_stats['heartbeats'], backend_stats['coalesced'],
+                                         backend_stats['suppressed']))
+        display_pipe = self.multi_pipe
+        if isinstance(display_pipe, DisplaySender):
+            display_pipe.drain(config.DISPLAY_CLOSE_TIMEOUT)
+            sender_stats = display_pipe.stats()
+            print("Display sender: {} messages queued, {} sent, {} dropped ({} comm, {} frames, {} oldest, {} new), "
+                  "max depth {}".format(sender_stats['queued'], sender_stats['sent'], sender_stats['dropped'],
+                                        sender_stats['dropped_comm'], sender_stats['dropped_frames'],
+                                        sender_stats['dropped_oldest'], sender_stats['dropped_new'],
+                                        sender_stats['max_depth']))
+            display_pipe = display_pipe.pipe
+        if isinstance(display_pipe, FramePipe):
+            display_pipe.flush()
+            display_stats = display_pipe.stats()
+            print("Display: {} messages sent as {} ({} frames, {:.0f} bytes/frame)".format(
+                display_stats['messages_in'], display_stats['messages_out'], display_stats['frames'],
+                display_stats['bytes_per_frame']))
+        if self.frame_buffer is not None:
+            frame_stats = self.frame_buffer.stats()
+            print("Frame buffer: {} frames written ({} bytes of shared memory)".format(frame_stats['written'],
+                                                                                       frame_stats['bytes']))
+        reader_stats = self.reader.stats()
+        print("Read {} bytes in {} reads ({:.3f} reads/packet, {:.0f} bytes/sec)".format(
+            reader_stats['bytes'], reader_stats['reads'], reader_stats['reads'] / max(self.packet_ctr, 1),
+            reader_stats['bytes_per_sec']))
+        self.multi_pipe.send("@realMainThread signing off. Peace.") if self.multi_pipe else None
+        if isinstance(self.multi_pipe, DisplaySender):
+            self.multi_pipe.close()
 
-                # Pass to packet processor for processing
-                self.PACKET_PROCESSORS[packet_type](packet_contents)
+    def read_packets(self):
+        do = True
+        while do or self.repeat_log is True:
+            self.reader = BulkReader(self.src, log=self.log_file)
+            if self.binary:
+                packets = self.read_binary_packets()
+            else:
+                packets = self.read_text_packets()
+            for packet in packets:
+                self.wait_for_playback()
+                yield packet
 
             if self.repeat_log:
                 self.multi_pipe.send({
                     'cmd':'clear_connection_list',
                     'args': {}
                 })
-                self.src = open(self.src_input)
+                self.range_counts[:] = 0
+                self.src = open(self.src_input, 'rb')
             else:
                 do = False
-            
-
-        print()
-        print("Processed {} lines ({} packets) in {} secs".format(line_ctr, packet_ctr, time.time() - start_time))
-        print("Total non-base node resolutions: {}".format(Main.resolved_ctr))
-        self.multi_pipe.send("@realMainThread signing off. Peace.") if self.multi_pipe else None
+        self.reader.close()
+
+    def read_text_packets(self):
+        # Lines are decoded in batches, straight out of the reader's buffer
+        reader = self.reader
+        reader.discard_partial_line = True  # discard first (possibly incomplete) line
+        while not reader.eof:
+            reader.fill()
+            lines_read = reader.lines_read
+            for packet in decode_buffer(reader.lines()):
+                self.packet_ctr += 1
+                yield packet
+            self.line_ctr += reader.lines_read - lines_read
+
+    def read_binary_packets(self):
+        # Frames are located by their sync word, so there is no partial first
+        # frame to discard; the decoder skips over it.
+        reader = self.reader
+        decoder = binary_protocol.FrameDecoder()
+        while not reader.eof:
+            reader.fill()
+            packets = []
+            reader.consume_to(decoder.decode_into(reader.buffer, reader.start, reader.end, packets))
+            self.line_ctr += len(packets)
+            self.packet_ctr += len(packets)
+            yield from packets
+
+    def wait_for_playback(self):
+        # Log playback: block while paused, otherwise just check for new commands
+        if self.playback_pipe is None:
+            return
+        check = True
+        while check or self.paused is True:
+            check = False
+            msg = None
+            if self.paused:
+                msg = self.playback_pipe.recv()
+            elif self.playback_pipe.poll():
+                msg = self.playback_pipe.recv()
+            if msg is not None and type(msg) == dict and "cmd" in msg:
+                if msg['cmd'] == "play":
+                    self.paused = False
+                elif msg['cmd'] == "pause":
+                    self.paused = True
+                elif msg['cmd'] == "set_speed" and 'speed' in msg:
+                    if float(msg['speed']) == 0:
+                        self.pause_time = 0
+                    else:
+                        self.pause_time = 1 / float(msg['speed'])
 
     #####################
     # Packet processors #
@@ -184,6 +292,9 @@ class Main:
             print('INVALID NODE SETUP: All nodes require the "name" attribute in config.py.')
             exit()
             continue
+        if details.get('battery', 'default') not in config.BATTERY_TABLES:
+            print('INVALID NODE SETUP: The "battery" attribute has to be one of config.BATTERY_TABLES.')
+            exit()
         if 'is_base' in details and details['is_base'] is True:
             r_nodes[node_id] = Node(node_id, details['name'], is_base=True)
             if 'base_type' in details:
@@ -212,12 +323,7 @@ class Main:
 
     r_current_cycle = None
     r_cycle_offset = None
-    r_cycle_data = []
-    r_cycle_history = []
-
-    auto_base_meas_key = ANCHORED_BASE + "-" + CALCULATED_BASE
-    if int(ANCHORED_BASE) > int(CALCULATED_BASE):
-        auto_base_meas_key = CALCULATED_BASE + "-" + ANCHORED_BASE
+    r_cycle_history = CycleHistory()  # Range samples of the last MAX_HISTORY cycles, see cycle_history.py
 
     if AUTO_SETUP_BASE is False:
         r_nodes[CALCULATED_BASE].set_real_x_pos(MANUAL_BASE_DIST)
@@ -226,26 +332,70 @@ class Main:
 
     resolved_ctr = 0
 
-    def algorithm_callback(self, nodes, _t, _n):
+    def algorithm_callback(self, nodes, _t, _n, dirty=None):
+        # Publishes the nodes of the solve that are 'dirty' (None for all of them)
+        # or were left over from an earlier one
         # self.backend.clear_nodes()
+        self.frame_nodes = nodes
+        dirty = merge_dirty(dirty, self.dirty_nodes)
+        publish = {}
         for node_id, node in nodes.items():
-            self.backend.update_node(node)
+            if dirty is None or node_id in dirty:
+                publish[node_id] = node
             if not node.is_base and node.is_resolved():
                 Main.resolved_ctr += 1
-
-    @staticmethod
-    def get_key_from_nodes(node_id_1, node_id_2):
-        n1 = int(node_id_1)
-        n2 = int(node_id_2)
-        if n1 > n2:
-            return str(n2) + "-" + str(n1)
-        else:
-            return str(n1) + "-" + str(n2)
+        self.backend.publish_cycle(publish)
+        self.dirty_nodes = set() if dirty is None else dirty - publish.keys()
+
+    def solve_needed(self, snapshot):
+        # Asks the change detector whether 'snapshot' needs solving. Returns
+        # (solve?, node IDs to publish afterwards or None for all of them).
+        if self.change_detector is None:
+            return True, None
+        return self.change_detector.should_solve(snapshot)
+
+    def solver_result(self, cycle, nodes, messages, dirty):
+        # Publishes a solve done by the worker process
+        if self.multi_pipe is not None and self.frame_buffer is None:
+            self.multi_pipe.send({"cmd": "frame_start", "args": None})
+            for msg in messages:
+                self.multi_pipe.send(msg)
+            self.multi_pipe.send({"cmd": "frame_end", "args": None})
+        self.algorithm_callback(nodes, None, None, dirty)
+
+    def write_frame(self):
+        # Positions of the last solve, the links of the last snapshot and everyone's latest telemetry into the
+        # frame buffer. Nodes and links are in the order of the history table (node index, pair index).
+        node_ids = self.history.node_ids
+        columns = {name: numpy.full(len(node_ids), numpy.nan) for name in NODE_FIELDS}
+        for i, node_id in enumerate(node_ids):
+            node = self.frame_nodes.get(node_id)
+            if node is not None and node.is_resolved() and node.x is not None:
+                columns['x'][i] = node.x
+                columns['y'][i] = node.y
+                columns['r'][i] = node.get_guess_radius()
+            stats = self.telemetry.latest(node_id)
+            if stats is not None:
+                for name in ('batt', 'temp', 'heading'):
+                    columns[name][i] = stats[name]
+                columns['stats_time'][i] = stats['time']
+        dist = numpy.full(len(self.range_counts), numpy.nan)
+        std = numpy.full(len(self.range_counts), numpy.nan)
+        cycle = Main.r_current_cycle
+        if self.last_snapshot is not None:
+            cycle = self.last_snapshot.cycle
+            for n1, n2, avg, dev in self.last_snapshot.measurements:
+                pair = self.history.pair_index(n1, n2)
+                dist[pair] = avg
+                std[pair] = dev
+        self.frame_buffer.write(cycle, measured=self.snapshot_time, dist=dist, std=std, ranges=self.range_counts,
+                                **columns)
 
     def process_range(self, packet):
         p_cycle, p_from, p_to, p_seq, p_hops, p_range = packet
-        p_cycle = int(p_cycle)
-        p_range = int(p_range)
+
+        if self.solver is not None:
+            self.solver.dispatch_results(self.solver_result)
 
         # START code to discard initial cycle
         if not Main.r_current_cycle:
@@ -259,67 +409,83 @@ class Main:
 
         if p_cycle != Main.r_current_cycle + Main.r_cycle_offset:
 
-            # Pop old cycle data out of the history, and
-            # insert the latest data at the front.
-            while len(Main.r_cycle_history) >= config.MAX_HISTORY:
-                Main.r_cycle_history.pop()
-            Main.r_cycle_history.insert(0, Main.r_cycle_data)
+            # Close the cycle in the history, the oldest one drops out
+            Main.r_cycle_history.end_cycle()
 
-            if self.multi_pipe is None:
-                self.algorithm(Main.r_nodes, Main.ANCHORED_BASE, Main.CALCULATED_BASE)._process(self.algorithm_callback)
+            if self.solver is not None:
+                pass  # Solved in the worker process as soon as the measurements are in, see below
             else:
-                self.multi_pipe.send({"cmd": "frame_start", "args": None})
-                self.algorithm(Main.r_nodes, Main.ANCHORED_BASE, Main.CALCULATED_BASE)._process(self.algorithm_callback,
-                                                                                                multi_pipe=self.multi_pipe)
-                self.multi_pipe.send({"cmd": "frame_end", "args": None})
+                solve, dirty = self.solve_needed(self.last_snapshot)
+                callback = functools.partial(self.algorithm_callback, dirty=dirty)
+                if not solve:
+                    # Nothing moved, the previous solution (and frame) still stands
+                    self.runner.update(self.last_snapshot)
+                elif self.multi_pipe is None or self.frame_buffer is not None:
+                    self.runner.run(self.last_snapshot, callback)
+                else:
+                    self.multi_pipe.send({"cmd": "frame_start", "args": None})
+                    self.runner.run(self.last_snapshot, callback, multi_pipe=self.multi_pipe)
+                    self.multi_pipe.send({"cmd": "frame_end", "args": None})
+
+            if self.frame_buffer is not None:
+                self.write_frame()
 
             # Keep track of cycle count in a way that's not affected by system reboots
             Main.r_current_cycle += 1
             Main.r_cycle_offset = p_cycle - Main.r_current_cycle
-            Main.r_cycle_data = []
+            measurements = []
+            base_x = None
             for node_id, node in Main.r_nodes.items():
                 node.start_new_cycle()
                 # node.show()
-            for name in self.name_arr:
-                # self.history[name].new_cycle()
-                meas = self.history[name]
-                n1 = meas.get_node_1()
-                n2 = meas.get_node_2()
-                avg = meas.get_avg()
-                std = meas.get_std_deviation()
-                meas.new_cycle()
-                if avg != 0:
-                    Main.r_nodes[n1].add_measurement(Main.r_nodes[n2], avg, std=std)
-                    Main.r_nodes[n2].add_measurement(Main.r_nodes[n1], avg, std=std)
-
-                if Main.AUTO_SETUP_BASE and name == Main.auto_base_meas_key and avg != 0:
+            # Averages and deviations of all pairs at once, see meas_history.py
+            pairs, avgs, stds = self.history.get_stats()
+            self.history.new_cycle()
+            for i in numpy.flatnonzero(avgs):
+                pair = int(pairs[i])
+                n1, n2 = self.history.get_nodes(pair)
+                avg = float(avgs[i])
+                std = float(stds[i])
+                Main.r_nodes[n1].add_measurement(Main.r_nodes[n2], avg, std=std)
+                Main.r_nodes[n2].add_measurement(Main.r_nodes[n1], avg, std=std)
+                measurements.append((n1, n2, avg, std))
+
+                if Main.AUTO_SETUP_BASE and pair == self.auto_base_pair:
                     Main.r_nodes[Main.CALCULATED_BASE].set_real_x_pos(avg)
+                    base_x = avg
+
+            self.last_snapshot = CycleSnapshot(Main.r_current_cycle, measurements, base_x)
+            self.snapshot_time = time.time()
+            if self.solver is not None:
+                self.solver.submit(self.last_snapshot, *self.solve_needed(self.last_snapshot))
 
             if self.pause_time > 0:
                 time.sleep(self.pause_time)
 
-        key = self.get_key_from_nodes(p_from, p_to)
-        if self.multi_pipe is not None:
+        pair = self.history.pair_index(p_from, p_to)
+        if self.frame_buffer is not None:
+            self.range_counts[pair] += 1
+        elif self.multi_pipe is not None:
             self.multi_pipe.send({
                 "cmd": "report_communication",
                 "args": {
-                    "key": key
+                    "key": self.history.get_key(pair)
                 }
             })
-        self.history[key].add_measurement(p_range)
-        Main.r_cycle_data.append([p_from, p_to, p_range, p_hops, p_seq])
+        self.history.add_measurement(pair, p_range)
+        Main.r_cycle_history.add(p_from, p_to, p_range, p_hops, p_seq, Main.r_current_cycle)
 
     def process_stats(self, packet):
         p_cycle, p_from, p_seq, p_hops, p_batt, p_temp, p_heading = packet
-        p_heading = float(p_heading)
-        p_temp = float(p_temp)
-        p_batt = volts_to_percentage(float(p_batt))
+        p_batt = self.battery_percentage[p_from](p_batt)
+        self.telemetry.add(p_from, p_cycle, batt=p_batt, temp=p_temp, heading=p_heading)
         self.backend.update_node_telemetry(Main.r_nodes[p_from], p_temp, p_batt, p_heading, "TELEMETRY")
-        if self.multi_pipe is not None:
+        if self.multi_pipe is not None and self.frame_buffer is None:
             self.multi_pipe.send({
                 'cmd': 'status_update',
                 'args': {
                     'node_id': p_from,
+                    'cycle': p_cycle,
                     'bat': p_batt,
                     'temp': p_temp,
                     'heading': p_heading
@@ -1,20 +1,109 @@
+from bisect import bisect_left, insort
+from collections import deque
+import math
+
 import numpy
 import config
 
 
+#################
+# Median filter #
+#################
+# The non-zero values of a window kept in sorted order, so the median is a
+# lookup and the median absolute deviation (MAD) a binary search, whatever the
+# window size. Used to reject range samples that are far off the rest of their
+# window. A pair that keeps getting rejected ('min_vals' samples in a row) has
+# really moved, so the next sample is let through.
+
+class MedianFilter:
+    MAD_TO_STD = 1.4826  # MAD * this = standard deviation, for normally distributed values
+
+    def __init__(self, min_vals, scale=config.RANGE_OUTLIER_MAD_SCALE, min_dev=config.RANGE_OUTLIER_MIN_DEV):
+        self.values = []
+        self.min_vals = min_vals
+        self.scale = scale
+        self.min_dev = min_dev
+        self.rejected_in_a_row = 0
+        self.rejected_ctr = 0
+
+    def add(self, value):
+        insort(self.values, value)
+
+    def remove(self, value):
+        del self.values[bisect_left(self.values, value)]
+
+    def median(self):
+        values = self.values
+        mid = len(values) // 2
+        if len(values) % 2:
+            return values[mid]
+        return (values[mid - 1] + values[mid]) / 2
+
+    def mad(self):
+        median = self.median()
+        mid = len(self.values) // 2
+        if len(self.values) % 2:
+            return self._kth_deviation(median, mid)
+        return (self._kth_deviation(median, mid - 1) + self._kth_deviation(median, mid)) / 2
+
+    def _kth_deviation(self, median, k):
+        # k-th smallest (from 0) |value - median|. The deviations below and above
+        # the median are two sorted sequences, so this is the k-th element of their
+        # merge: binary search for how many of them come from below.
+        values = self.values
+        split = bisect_left(values, median)
+        below = split
+        above = len(values) - split
+        lo = max(0, k + 1 - above)
+        hi = min(k + 1, below)
+        while lo < hi:
+            i = (lo + hi) // 2
+            if values[split + k - i] - median > median - values[split - 1 - i]:
+                lo = i + 1
+            else:
+                hi = i
+        dev = 0
+        if lo > 0:
+            dev = median - values[split - lo]
+        if lo < k + 1:
+            dev = max(dev, values[split + k - lo] - median)
+        return dev
+
+    def accept(self, value):
+        if len(self.values) >= self.min_vals and self.rejected_in_a_row < self.min_vals:
+            dev = abs(value - self.median())
+            if dev > self.min_dev and dev > self.scale * MedianFilter.MAD_TO_STD * self.mad():
+                self.rejected_in_a_row += 1
+                self.rejected_ctr += 1
+                return False
+        self.rejected_in_a_row = 0
+        return True
+
+
+################
+# Meas history #
+################
+# Running sum, sum of squares and non-zero count are updated as values enter and
+# leave the window, so averages and deviations cost the same for any 'max_meas'.
+# Ranges are integer mm, so the sums stay exact.
+
 class MeasHistory:
     MAX_MEAS = 20
     MIN_DIST = 750  # mm
     MAX_DIST = 500000  # mm
 
-    def __init__(self, key, max_meas=config.MAX_HISTORY, min_vals=5):
+    def __init__(self, key, max_meas=config.MAX_HISTORY, min_vals=5, reject_outliers=config.RANGE_OUTLIER_REJECTION):
         self.key = key
         self.node1, self.node2 = self.key.split('-')
-        self.meas_list = []
+        self.meas_list = deque()
         self.added_meas = False
         self.volatile_cycle = True
         self.max_meas = max_meas
         self.min_vals = min_vals
+        self.sum = 0
+        self.sum_sq = 0
+        self.nonzero = 0
+        self.filter = MedianFilter(min_vals) if reject_outliers else None
 
     def get_key(self):
         return self.key
@@ -35,21 +124,317 @@ class MeasHistory:
     def add_measurement(self, dist, override=False):
         if not override and (dist < MeasHistory.MIN_DIST or dist > MeasHistory.MAX_DIST):
             return
+        if not override and self.filter is not None and not self.filter.accept(dist):
+            return
         self.added_meas = True
         self.meas_list.append(dist)
+        self._count(dist, 1)
         if len(self.meas_list) > self.max_meas:
-            self.meas_list.pop(0)
+            self._count(self.meas_list.popleft(), -1)
+
+    def _count(self, dist, sign):
+        if dist != 0:
+            self.sum += sign * dist
+            self.sum_sq += sign * dist * dist
+            self.nonzero += sign
+            if self.filter is not None:
+                if sign > 0:
+                    self.filter.add(dist)
+                else:
+                    self.filter.remove(dist)
 
     def get_avg(self):
-        sum_val = 0
-        counter = 0
-        for dist in self.meas_list:
-            sum_val += dist
-            if dist != 0:
-                counter += 1
-        if counter < self.min_vals:
+        if self.nonzero < self.min_vals:
             return 0  # TODO: Remove when we do deviation?
-        return sum_val / counter
+        return self.sum / self.nonzero
 
     def get_std_deviation(self):
-        return numpy.std(self.meas_list)
+        n = len(self.meas_list)
+        if n == 0:
+            return math.nan
+        return math.sqrt(max(n * self.sum_sq - self.sum * self.sum, 0)) / n
+
+
+#######################
+# Measurement table   #
+#######################
+# The MeasHistory of every node pair that is in range, in one (rows x window)
+# array, so the averages and standard deviations of all pairs come out of a
+# single vectorized call per cycle.
+#
+# Pairs are identified by an integer pair index (lower node index * number of
+# nodes + higher node index, nodes ordered by ID) and only get a row once they
+# are first measured. A pair that was never measured would have received a 0
+# every other cycle, so a new row starts out with that many zeros (up to its
+# limit) and everything behaves exactly as if all pairs had a row from the start.
+# For the same reason, a row that holds nothing but zeros is freed again.
+#
+# Each row is a ring buffer of its own length limit ('max_meas'), which keeps the
+# semantics of MeasHistory: out of range values are ignored, the oldest value
+# drops out once a row is full, averages only count non-zero values and need
+# 'min_vals' of them, and the deviation is over all stored values. Like
+# MeasHistory, each row keeps running sums, so get_stats() doesn't depend on the
+# window size.
+
+class MeasHistoryTable:
+    def __init__(self, node_ids, max_meas=config.MAX_HISTORY, min_vals=5, reject_outliers=config.RANGE_OUTLIER_REJECTION,
+                 capacity=64):
+        self.node_ids = sorted(node_ids, key=int)
+        self.node_index = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        self.num_nodes = len(self.node_ids)
+        self.max_meas = max_meas
+        self.min_vals = min_vals
+        self.reject_outliers = reject_outliers
+        self.pair_limits = {}  # {pair: (max_meas, min_vals)} for pairs that differ from the defaults
+        self.pair_keys = {}  # {pair: "id1-id2"}, built on first use
+        self.rows = {}  # {pair: row}
+        self.zero_fills = 0  # Number of zeros a pair that was never measured would have by now
+        self.volatile_cycle = True  # Flips every cycle for all pairs alike
+        self.retired_rejected = 0
+
+        # Per row. The lists are touched for every packet, which is cheaper on lists than on numpy scalars.
+        self.capacity = capacity
+        self.window = max_meas
+        self.data = numpy.zeros((capacity, self.window))
+        self.row_limit = numpy.zeros(capacity, dtype=int)
+        self.row_min_vals = numpy.zeros(capacity, dtype=int)
+        self.sums = numpy.zeros(capacity)
+        self.sums_sq = numpy.zeros(capacity)
+        self.nonzero = numpy.zeros(capacity, dtype=int)
+        self.added_meas = numpy.zeros(capacity, dtype=bool)
+        self.row_pairs = numpy.full(capacity, -1)  # Pair of each row, -1 if the row is free
+        self.limits = [0] * capacity
+        self.head = [0] * capacity  # Next position to write in each row
+        self.length = [0] * capacity  # Number of stored values in each row
+        self.filters = [None] * capacity
+        self.free_rows = list(range(capacity - 1, -1, -1))
+        self.pending = []  # (row, new value, replaced value) not yet counted in the sums, see flush()
+
+    def pair_index(self, node_id_1, node_id_2):
+        i = self.node_index[node_id_1]
+        j = self.node_index[node_id_2]
+        if i > j:
+            return j * self.num_nodes + i
+        return i * self.num_nodes + j
+
+    def get_nodes(self, pair):
+        i, j = divmod(pair, self.num_nodes)
+        return self.node_ids[i], self.node_ids[j]
+
+    def get_key(self, pair):
+        # "id1-id2" with the lower node ID first, the display's name for the pair
+        key = self.pair_keys.get(pair)
+        if key is None:
+            key = self.pair_keys[pair] = "{}-{}".format(*self.get_nodes(pair))
+        return key
+
+    def all_pairs(self):
+        # Every possible pair index, in node order
+        for i in range(self.num_nodes):
+            for j in range(i + 1, self.num_nodes):
+                yield i * self.num_nodes + j
+
+    def set_limits(self, pair, max_meas=None, min_vals=None):
+        # Only meant to be used before the pair is measured
+        old_max, old_min = self.pair_limits.get(pair, (self.max_meas, self.min_vals))
+        self.pair_limits[pair] = (old_max if max_meas is None else max_meas, old_min if min_vals is None else min_vals)
+        if max_meas is not None and max_meas > self.window:
+            grown = numpy.zeros((self.capacity, max_meas))
+            grown[:, :self.window] = self.data
+            self.data = grown
+            self.window = max_meas
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add_measurement(self, pair, dist, override=False):
+        if not override and (dist < MeasHistory.MIN_DIST or dist > MeasHistory.MAX_DIST):
+            return
+        i = self.rows.get(pair)
+        if i is None:
+            i = self._new_row(pair)
+        if not override and self.reject_outliers and not self.filters[i].accept(dist):
+            return
+        self.added_meas[i] = True
+        head = self.head[i]
+        old = self.data[i, head].item()  # 0 while the row isn't full yet
+        self.data[i, head] = dist
+        self.pending.append((i, dist, old))
+        if self.reject_outliers:
+            if old:
+                self.filters[i].remove(old)
+            if dist:
+                self.filters[i].add(dist)
+        head += 1
+        self.head[i] = 0 if head == self.limits[i] else head
+        if self.length[i] < head:
+            self.length[i] = head
+
+    def _new_row(self, pair):
+        if not self.free_rows:
+            self._grow()
+        i = self.free_rows.pop()
+        limit, min_vals = self.pair_limits.get(pair, (self.max_meas, self.min_vals))
+        zeros = min(limit, self.zero_fills)
+        self.rows[pair] = i
+        self.row_pairs[i] = pair
+        self.row_limit[i] = self.limits[i] = limit
+        self.row_min_vals[i] = min_vals
+        self.head[i] = 0 if zeros == limit else zeros
+        self.length[i] = zeros
+        self.filters[i] = MedianFilter(min_vals) if self.reject_outliers else None
+        return i
+
+    def _grow(self):
+        old = self.capacity
+        self.capacity *= 2
+        grown = numpy.zeros((self.capacity, self.window))
+        grown[:old] = self.data
+        self.data = grown
+        for name in ('row_limit', 'row_min_vals', 'sums', 'sums_sq', 'nonzero', 'added_meas'):
+            array = getattr(self, name)
+            setattr(self, name, numpy.concatenate((array, numpy.zeros(old, dtype=array.dtype))))
+        self.row_pairs = numpy.concatenate((self.row_pairs, numpy.full(old, -1)))
+        for name in ('limits', 'head', 'length', 'filters'):
+            getattr(self, name).extend([None if name == 'filters' else 0] * old)
+        self.free_rows.extend(range(self.capacity - 1, old - 1, -1))
+
+    def flush(self):
+        # Applies the sum updates of all measurements added since the last call in one go
+        if not self.pending:
+            return
+        rows, new, old = numpy.array(self.pending).T
+        self.pending = []
+        rows = rows.astype(int)
+        numpy.add.at(self.sums, rows, new - old)
+        numpy.add.at(self.sums_sq, rows, new * new - old * old)
+        numpy.add.at(self.nonzero, rows, (new != 0).astype(int) - (old != 0))
+
+    def new_cycle(self):
+        # Every other cycle, pairs that got no measurement get a 0
+        self.flush()
+        if self.volatile_cycle:
+            self.zero_fills += 1
+            rows = numpy.flatnonzero((self.row_pairs >= 0) & ~self.added_meas)
+            if len(rows):
+                heads = numpy.array(self.head)[rows]
+                old = self.data[rows, heads]
+                self.data[rows, heads] = 0
+                self.sums[rows] -= old
+                self.sums_sq[rows] -= old * old
+                self.nonzero[rows] -= old != 0
+                if self.reject_outliers:
+                    for i, value in zip(rows[old != 0], old[old != 0]):
+                        self.filters[i].remove(value)
+                heads += 1
+                length = numpy.array(self.length)
+                length[rows] = numpy.maximum(length[rows], heads)
+                heads[heads == self.row_limit[rows]] = 0
+                head = numpy.array(self.head)
+                head[rows] = heads
+                self.head = head.tolist()
+                self.length = length.tolist()
+                self._retire(rows[(self.nonzero[rows] == 0) & (length[rows] == self.row_limit[rows])])
+        self.added_meas[:] = False
+        self.volatile_cycle = not self.volatile_cycle
+
+    def _retire(self, rows):
+        # Frees rows that only hold zeros, the same as a pair that was never measured
+        for i in rows.tolist():
+            del self.rows[self.row_pairs[i]]
+            self.row_pairs[i] = -1
+            self.data[i] = 0
+            self.sums[i] = self.sums_sq[i] = 0
+            self.head[i] = self.length[i] = 0
+            if self.reject_outliers:
+                self.retired_rejected += self.filters[i].rejected_ctr
+                self.filters[i] = None
+            self.free_rows.append(i)
+
+    def get_stats(self):
+        # Returns (pairs, averages, standard deviations) of all pairs with a row, in
+        # pair order. Averages are 0 for pairs with fewer than 'min_vals' non-zero
+        # values, deviations are NaN for empty pairs (like numpy.std([])).
+        self.flush()
+        rows = numpy.flatnonzero(self.row_pairs >= 0)
+        rows = rows[numpy.argsort(self.row_pairs[rows])]
+        length = numpy.array(self.length)[rows]
+        sums = self.sums[rows]
+        nonzero = self.nonzero[rows]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            avgs = numpy.where(nonzero >= self.row_min_vals[rows], sums / nonzero, 0)
+            spread = numpy.maximum(length * self.sums_sq[rows] - sums * sums, 0)
+            stds = numpy.sqrt(spread) / length
+        return self.row_pairs[rows], avgs, stds
+
+    def rejected(self):
+        # Number of samples dropped as outliers
+        if not self.reject_outliers:
+            return 0
+        return self.retired_rejected + sum(f.rejected_ctr for f in self.filters if f is not None)
+
+
+#############
+# Benchmark #
+#############
+# A MeasHistory object for every possible pair (as Main used to have) vs. the
+# sparse MeasHistoryTable, on a network where each node only reaches a few others.
+# Usage: python3 meas_history.py [num_nodes] [num_cycles] [neighbours]
+
+if __name__ == "__main__":
+    import random
+    import sys
+    import time
+
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    neighbours = int(sys.argv[3]) if len(sys.argv) > 3 else 6
+    node_ids = [str(n) for n in range(num_nodes)]
+    random.seed(1)
+    links = sorted({(a, b) for a in range(num_nodes) for b in random.sample(range(num_nodes), neighbours) if a < b})
+    cycles = []
+    for _ in range(num_cycles):
+        # Most links are heard once or twice a cycle, some drop out for a while
+        cycles.append([(str(a), str(b), random.randint(500, 60000)) for a, b in links for _ in range(random.randint(0, 2))])
+    samples = sum(len(c) for c in cycles)
+
+    start = time.perf_counter()
+    histories = {}
+    for a in range(num_nodes):
+        for b in range(a + 1, num_nodes):
+            histories["{}-{}".format(a, b)] = MeasHistory("{}-{}".format(a, b))
+    for cycle in cycles:
+        for n1, n2, dist in cycle:
+            histories["{}-{}".format(n1, n2) if int(n1) < int(n2) else "{}-{}".format(n2, n1)].add_measurement(dist)
+        measured = 0
+        for meas in histories.values():
+            avg = meas.get_avg()
+            std = meas.get_std_deviation()
+            meas.new_cycle()
+            if avg != 0:
+                measured += 1
+    dense_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    table = MeasHistoryTable(node_ids)
+    for cycle in cycles:
+        for n1, n2, dist in cycle:
+            table.add_measurement(table.pair_index(n1, n2), dist)
+        pairs, avgs, stds = table.get_stats()
+        table.new_cycle()
+    sparse_time = time.perf_counter() - start
+
+    pairs, avgs, stds = table.get_stats()
+    mismatches = 0
+    for pair, avg, std in zip(pairs, avgs, stds):
+        meas = histories[table.get_key(pair)]
+        if abs(meas.get_avg() - avg) > 1e-6 or abs(meas.get_std_deviation() - std) > 1e-6:
+            mismatches += 1
+    in_table = {table.get_key(pair) for pair in pairs}
+    missing = sum(1 for key, meas in histories.items() if key not in in_table and meas.get_avg() != 0)
+
+    print("{} nodes, {} links in range of {} possible pairs, {} cycles, {} samples".format(
+        num_nodes, len(links), len(histories), num_cycles, samples))
+    print("MeasHistory for every pair: {:.3f} secs".format(dense_time))
+    print("Sparse MeasHistoryTable:    {:.3f} secs, {} rows".format(sparse_time, len(table)))
+    print("Pairs that differ: {}, pairs with an average but no row: {}".format(mismatches, missing))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+import sys
+import time
+
+##################
+# Packet records #
+##################
+# Node IDs are kept as strings since they key into Main.r_nodes / config.NODES,
+# everything else is converted to its numeric type once, here.
+
+RangePacket = namedtuple('RangePacket', ['cycle', 'from_id', 'to_id', 'seq', 'hops', 'range'])
+StatsPacket = namedtuple('StatsPacket', ['cycle', 'from_id', 'seq', 'hops', 'batt', 'temp', 'heading'])
+
+# Packets are told apart by their prefix and split on ',' and ':' into fixed
+# field positions (names at even, values at odd indices):
+#   Range Packet | Cycle:5,	From:0,	To:1,	Seq:0,	Hops:2,	Range:40000
+#   Stats Packet | Cycle:5,	From:2,		Seq:0,	Hops:2,	Bat:4.01,	Temp:31.50,	Heading:90.0
+# int() and float() ignore the surrounding whitespace. Lines with the wrong
+# number of fields or values that don't convert are not packets.
+_RANGE = b'Range Packet'
+_STATS = b'Stats Packet'
+_RANGE_FIELDS = 12
+_STATS_FIELDS = 14
+
+# Skips the pure-Python namedtuple __new__, which is most of the construction cost
+_new = tuple.__new__
+
+# Node IDs repeat constantly, so keep a single str object per ID
+_node_ids = {}
+
+
+def _node_id(raw):
+    node_id = _node_ids.get(raw)
+    if node_id is None:
+        node_id = _node_ids[raw] = raw.strip().decode('utf-8')
+    return node_id
+
+
+def _decode(line):
+    if line[:1] in (b' ', b'\t'):
+        line = line.lstrip()
+    if line.startswith(_RANGE):
+        f = line.replace(b',', b':').split(b':')
+        if len(f) != _RANGE_FIELDS:
+            return None
+        try:
+            return _new(RangePacket, (int(f[1]), _node_id(f[3]), _node_id(f[5]), int(f[7]), int(f[9]), int(f[11])))
+        except ValueError:
+            return None
+    if line.startswith(_STATS):
+        f = line.replace(b',', b':').split(b':')
+        if len(f) != _STATS_FIELDS:
+            return None
+        try:
+            return _new(StatsPacket, (int(f[1]), _node_id(f[3]), int(f[5]), int(f[7]), float(f[9]), float(f[11]),
+                                      float(f[13])))
+        except ValueError:
+            return None
+    return None
+
+
+def decode_line(line):
+    # Accepts 'str' (log files) or 'bytes' (serial). Returns a RangePacket, a
+    # StatsPacket, or None if the line is not a (valid) packet.
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    return _decode(line)
+
+
+def decode_buffer(buf):
+    # Decodes every packet in a bytes-like buffer of complete lines, the same
+    # way decode_line() does. Invalid lines are skipped.
+    for line in bytes(buf).split(b'\n'):
+        packet = _decode(line)
+        if packet is not None:
+            yield packet
+
+
+#############
+# Benchmark #
+#############
+# Compares the decoder against the old split/strip parsing from Main.run.
+# Usage: python3 packet_decoder.py [size_in_MB]
+
+def _legacy_decode(line):
+    tmp = line.strip().split("|")
+    if len(tmp) != 2:
+        return None
+    packet_type = tmp[0].strip()
+    if packet_type not in ("Range Packet", "Stats Packet"):
+        return None
+    packet_contents = tmp[1].strip().split(',')
+    for i in range(len(packet_contents)):
+        packet_contents[i] = packet_contents[i].strip().split(":")[1]
+    # Conversions done later by process_range/process_stats
+    if packet_type == "Range Packet":
+        packet_contents[0] = int(packet_contents[0])
+        packet_contents[5] = int(packet_contents[5])
+    else:
+        packet_contents[4] = float(packet_contents[4])
+        packet_contents[5] = float(packet_contents[5])
+        packet_contents[6] = float(packet_contents[6])
+    return packet_contents
+
+
+def _make_log(size_mb, num_nodes=6):
+    lines = []
+    size = 0
+    cycle = 0
+    while size < size_mb * 1024 * 1024:
+        for n in range(num_nodes):
+            line = "Stats Packet | Cycle:{},\tFrom:{},\t\tSeq:0,\tHops:2,\tBat:4.01,\tTemp:31.50,\tHeading:{}.0\n" \
+                .format(cycle, n, cycle % 360)
+            lines.append(line)
+            size += len(line)
+        for a in range(num_nodes):
+            for b in range(num_nodes):
+                if a == b:
+                    continue
+                line = "Range Packet | Cycle:{},\tFrom:{},\tTo:{},\tSeq:{},\tHops:2,\tRange:{}\n" \
+                    .format(cycle, a, b, cycle % 256, 10000 + 137 * a + 71 * b)
+                lines.append(line)
+                size += len(line)
+        cycle += 1
+    return lines
+
+
+def _report(name, packets, elapsed):
+    print("{:<16} {:>9} packets in {:.3f} secs ({:,.0f} packets/sec)".format(name, packets, elapsed,
+                                                                            packets / elapsed))
+
+
+def _bench_lines(name, func, lines):
+    start = time.perf_counter()
+    packets = 0
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8') if func is _legacy_decode else line
+        if func(line) is not None:
+            packets += 1
+    _report(name, packets, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    log_lines = _make_log(size_mb)
+    log_bytes = [line.encode('utf-8') for line in log_lines]
+    print("Decoding {} MB ({} lines)".format(size_mb, len(log_lines)))
+    _bench_lines("legacy (str)", _legacy_decode, log_lines)
+    _bench_lines("decoder (str)", decode_line, log_lines)
+    _bench_lines("legacy (bytes)", _legacy_decode, log_bytes)
+    _bench_lines("decoder (bytes)", decode_line, log_bytes)
+    blob = b''.join(log_bytes)
+    bench_start = time.perf_counter()
+    _report("decode_buffer", sum(1 for _ in decode_buffer(blob)), time.perf_counter() - bench_start)
@@ -0,0 +1,267 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import binary_protocol
+import config
+from packet_decoder import decode_buffer
+from serial_reader import BulkReader
+
+##################
+# Bounded queues #
+##################
+# What happens when a stage's input queue is full:
+#   block       - the producer waits (backpressure)
+#   drop_oldest - the oldest queued item is discarded
+#   latest      - everything queued is discarded, only the newest item is kept
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+LATEST_WINS = 'latest'
+
+_END = object()  # End of stream marker, passed from stage to stage
+
+
+class BoundedQueue:
+    def __init__(self, name, maxsize, policy=BLOCK):
+        if policy not in (BLOCK, DROP_OLDEST, LATEST_WINS):
+            raise ValueError("Unknown queue policy '{}'".format(policy))
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.cond = None
+        self.loop = None
+
+        # Metrics
+        self.put_ctr = 0
+        self.dropped_ctr = 0
+        self.max_depth = 0
+
+    def bind(self, loop):
+        self.loop = loop
+        self.cond = asyncio.Condition()
+
+    async def put(self, item):
+        async with self.cond:
+            if len(self.items) >= self.maxsize and item is not _END:
+                if self.policy == BLOCK:
+                    await self.cond.wait_for(lambda: len(self.items) < self.maxsize)
+                elif self.policy == DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped_ctr += 1
+                else:
+                    self.dropped_ctr += len(self.items)
+                    self.items.clear()
+            self.items.append(item)
+            self.put_ctr += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify_all()
+
+    def put_threadsafe(self, item):
+        # For producers running outside the event loop (executor threads). Only
+        # waits for the put to complete if the queue applies backpressure.
+        future = asyncio.run_coroutine_threadsafe(self.put(item), self.loop)
+        if self.policy == BLOCK:
+            future.result()
+
+    async def get(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: len(self.items) > 0)
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    async def get_all(self):
+        # Waits for at least one item, then takes everything that is queued
+        async with self.cond:
+            await self.cond.wait_for(lambda: len(self.items) > 0)
+            items = list(self.items)
+            self.items.clear()
+            self.cond.notify_all()
+            return items
+
+    def metrics(self):
+        return {
+            'depth': len(self.items),
+            'max_depth': self.max_depth,
+            'put': self.put_ctr,
+            'dropped': self.dropped_ctr,
+        }
+
+
+########################
+# Publish redirections #
+########################
+# Hand display messages and backend calls from the solve stage to the publish stage.
+
+class PublishPipe:
+    def __init__(self, pipe, queue):
+        self.pipe = pipe
+        self.queue = queue
+
+    def send(self, msg):
+        self.queue.put_threadsafe((self.pipe.send, (msg,), {}))
+
+
+class PublishBackend:
+    def __init__(self, backend, queue):
+        self.backend = backend
+        self.queue = queue
+
+    def __getattr__(self, name):
+        func = getattr(self.backend, name)
+        if not callable(func):
+            return func
+        return lambda *args, **kwargs: self.queue.put_threadsafe((func, args, kwargs))
+
+
+###################
+# Ingest pipeline #
+###################
+# read -> parse -> solve -> publish, each stage a task connected by bounded queues.
+# Blocking work (serial reads, the packet processors and the algorithm) runs in
+# dedicated threads so a slow cycle never stops the serial port from being drained.
+
+class IngestPipeline:
+    def __init__(self, main):
+        self.main = main
+        self.queues = {}
+        for name in ('read', 'parse', 'publish'):
+            policy, maxsize = config.PIPELINE_QUEUES[name]
+            self.queues[name] = BoundedQueue(name, maxsize, policy)
+        self.read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-read')
+        self.solve_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-solve')
+        self.publish_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-publish')
+        self.pipe = None
+        self.last_metrics = time.time()
+
+    def run(self):
+        asyncio.run(self._run())
+        self.read_executor.shutdown()
+        self.solve_executor.shutdown()
+        self.publish_executor.shutdown()
+        self.print_metrics()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        for queue in self.queues.values():
+            queue.bind(loop)
+
+        main = self.main
+        self.pipe = pipe = main.multi_pipe
+        backend = main.backend
+        if pipe is not None:
+            main.multi_pipe = PublishPipe(pipe, self.queues['publish'])
+            for node in main.r_nodes.values():
+                node.set_pipe(main.multi_pipe)
+        main.backend = PublishBackend(backend, self.queues['publish'])
+        try:
+            await asyncio.gather(self.read_stage(), self.parse_stage(), self.solve_stage(), self.publish_stage())
+        finally:
+            main.multi_pipe, main.backend = pipe, backend
+            if pipe is not None:
+                for node in main.r_nodes.values():
+                    node.set_pipe(pipe)
+
+    def metrics(self):
+        return {name: queue.metrics() for name, queue in self.queues.items()}
+
+    def print_metrics(self):
+        for name, m in self.metrics().items():
+            print("Queue {:<8} depth {:>5} (max {:>5}), {:>8} in, {:>6} dropped".format(
+                name, m['depth'], m['max_depth'], m['put'], m['dropped']))
+
+    # Stages
+
+    async def read_stage(self):
+        main = self.main
+        loop = asyncio.get_running_loop()
+        do = True
+        while do or main.repeat_log is True:
+            main.reader = reader = BulkReader(main.src, log=main.log_file)
+            reader.discard_partial_line = not main.binary
+            while not reader.eof:
+                # Copy the batch out since the reader's buffer is reused on the next fill
+                batch = await loop.run_in_executor(self.read_executor, self._read_batch, reader)
+                if batch:
+                    await self.queues['read'].put(batch)
+                if time.time() - self.last_metrics > config.PIPELINE_METRICS_INTERVAL > 0:
+                    self.last_metrics = time.time()
+                    self.print_metrics()
+            if main.repeat_log:
+                await self.queues['read'].put(b'')  # Tells the parser to reset
+                await self.queues['publish'].put((self.pipe.send, ({
+                    'cmd': 'clear_connection_list',
+                    'args': {}
+                },), {}))
+                main.src = open(main.src_input, 'rb')
+            else:
+                do = False
+        main.reader.close()
+        await self.queues['read'].put(_END)
+
+    def _read_batch(self, reader):
+        reader.fill()
+        if self.main.binary:
+            batch = bytes(reader.view[reader.start:reader.end])
+            reader.consume_to(reader.end)
+        else:
+            lines_read = reader.lines_read
+            batch = bytes(reader.lines())
+            self.main.line_ctr += reader.lines_read - lines_read
+        return batch
+
+    async def parse_stage(self):
+        main = self.main
+        decoder = binary_protocol.FrameDecoder()
+        while True:
+            batch = await self.queues['read'].get()
+            if batch is _END:
+                break
+            if main.binary:
+                if not batch:
+                    decoder = binary_protocol.FrameDecoder()
+                    continue
+                packets = decoder.feed(batch)
+                main.line_ctr += len(packets)
+            else:
+                packets = list(decode_buffer(batch))
+            main.packet_ctr += len(packets)
+            if packets:
+                await self.queues['parse'].put(packets)
+        await self.queues['parse'].put(_END)
+
+    async def solve_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            packets = await self.queues['parse'].get()
+            if packets is _END:
+                break
+            await loop.run_in_executor(self.solve_executor, self._solve_batch, packets)
+        await self.queues['publish'].put(_END)
+
+    def _solve_batch(self, packets):
+        main = self.main
+        processors = main.PACKET_PROCESSORS
+        for packet in packets:
+            main.wait_for_playback()
+            processors[type(packet)](packet)
+
+    async def publish_stage(self):
+        # Pipe writes can block, so everything queued is published in one go on
+        # the publish thread rather than on the event loop.
+        loop = asyncio.get_running_loop()
+        done = False
+        while not done:
+            items = await self.queues['publish'].get_all()
+            if items[-1] is _END:
+                items.pop()
+                done = True
+            await loop.run_in_executor(self.publish_executor, self._publish_batch, items)
+
+    @staticmethod
+    def _publish_batch(items):
+        for func, args, kwargs in items:
+            func(*args, **kwargs)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import queue
+import sys
+import threading
+import time
+import urllib.parse
+
+import config
+
+######################
+# GraphQL connection #
+######################
+# One persistent (keep-alive) HTTP connection to a GraphQL endpoint. post()
+# returns True if the server accepted the document without errors.
+
+class GraphQLConnection:
+    def __init__(self, url, timeout=config.PUBLISH_TIMEOUT):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.timeout = timeout
+        self.conn = self._connect()
+        self.last_size = 0  # Bytes of the last request body
+
+    def _connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def post(self, query, variables=None):
+        body = {'query': query}
+        if variables is not None:
+            body['variables'] = variables
+        body = json.dumps(body).encode('utf-8')
+        self.last_size = len(body)
+        # A kept-alive connection may have been closed by the server in the
+        # meantime, so a failed request gets one retry on a new connection.
+        for attempt in range(2):
+            try:
+                return self._post(body)
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = self._connect()
+        return False
+
+    def _post(self, body):
+        self.conn.request('POST', self.path, body=body, headers={
+            'Content-Type': 'application/json; charset=utf-8',
+            'Accept': 'application/json',
+        })
+        response = self.conn.getresponse()
+        data = response.read()  # Has to be read completely before the connection can be reused
+        if response.status != 200:
+            return False
+        try:
+            reply = json.loads(data)
+        except ValueError:
+            return False
+        return isinstance(reply, dict) and not reply.get('errors')
+
+    def close(self):
+        self.conn.close()
+
+
+#############
+# Publisher #
+#############
+# Sends GraphQL documents to the backend from a fixed pool of worker threads,
+# each with its own GraphQLConnection and bounded queue. Everything published
+# with the same key (a node ID) goes through the same worker, so updates of one
+# node arrive in the order they were made. When a queue is full its oldest entry
+# is dropped, the publishing thread never waits.
+
+_STOP = object()
+
+
+class Publisher:
+    def __init__(self, url=config.BACKEND_URL, workers=config.PUBLISH_WORKERS, queue_size=config.PUBLISH_QUEUE_SIZE,
+                 timeout=config.PUBLISH_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.lock = threading.Lock()
+
+        # Metrics
+        self.published_ctr = 0
+        self.sent_ctr = 0
+        self.failed_ctr = 0
+        self.dropped_ctr = 0
+        self.in_flight = 0
+        self.latency_sum = 0
+        self.latency_max = 0
+        self.bytes_sent = 0
+
+        self.threads = [threading.Thread(target=self._worker, args=(q,), name='publisher-{}'.format(i), daemon=True)
+                        for i, q in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def publish(self, query, variables=None, key=None):
+        # 'key' picks the worker; None goes to the first one
+        if key is None:
+            q = self.queues[0]
+        else:
+            q = self.queues[hash(key) % len(self.queues)]
+        item = (query, variables, time.perf_counter())
+        with self.lock:
+            self.published_ctr += 1
+            while True:
+                try:
+                    q.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                        q.task_done()
+                        self.dropped_ctr += 1
+                    except queue.Empty:
+                        pass
+
+    def flush(self):
+        # Waits until everything published so far has been sent (or has failed)
+        for q in self.queues:
+            q.join()
+
+    def close(self):
+        self.flush()
+        for q in self.queues:
+            q.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def _worker(self, q):
+        conn = GraphQLConnection(self.url, self.timeout)
+        while True:
+            item = q.get()
+            if item is _STOP:
+                q.task_done()
+                break
+            query, variables, queued = item
+            with self.lock:
+                self.in_flight += 1
+            ok = False
+            try:
+                ok = conn.post(query, variables)
+            finally:
+                # Even if the worker dies, flush() must not wait for this item forever
+                latency = time.perf_counter() - queued
+                with self.lock:
+                    self.in_flight -= 1
+                    if ok:
+                        self.sent_ctr += 1
+                        self.bytes_sent += conn.last_size
+                        self.latency_sum += latency
+                        self.latency_max = max(self.latency_max, latency)
+                    else:
+                        self.failed_ctr += 1
+                q.task_done()
+        conn.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queued': sum(q.qsize() for q in self.queues),
+                'in_flight': self.in_flight,
+                'published': self.published_ctr,
+                'sent': self.sent_ctr,
+                'failed': self.failed_ctr,
+                'dropped': self.dropped_ctr,
+                'bytes': self.bytes_sent,
+                'avg_latency': self.latency_sum / self.sent_ctr if self.sent_ctr else 0,
+                'max_latency': self.latency_max,
+            }
+
+
+####################
+# Stand-in backend #
+####################
+# A local GraphQL endpoint that answers every request with an empty result, for
+# benchmarks. 'delay' simulates the round trip to the real backend, and while
+# 'up' is False every request fails with a 503.
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if server.delay:
+            time.sleep(server.delay)
+        with server.lock:
+            server.requests += 1
+            server.bytes += len(body)
+            server.connections.add(self.client_address)
+        status, reply = (200, b'{"data": {}}') if server.up else (503, b'{"errors": [{"message": "down"}]}')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+class _StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, delay=0.0):
+        super().__init__(('127.0.0.1', 0), _StandInHandler)
+        self.delay = delay
+        self.up = True
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.connections = set()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/graphql'.format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+#############
+# Benchmark #
+#############
+# Publishes a stream of node updates to the stand-in backend, first with a new
+# thread (and connection) per mutation like Backend used to, then with Publisher.
+# Usage: python3 publisher.py [num_updates] [delay_in_ms] [workers]
+
+def _send_once(url, body, failures):
+    # What a new thread did for every mutation: new connection, one request
+    parts = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=5)
+    try:
+        conn.request('POST', parts.path, body=body, headers={'Content-Type': 'application/json'})
+        conn.getresponse().read()
+    except (http.client.HTTPException, OSError):
+        failures.append(body)
+    conn.close()
+
+
+if __name__ == "__main__":
+    num_updates = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 2.0 / 1000
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else config.PUBLISH_WORKERS
+    mutation = 'mutation { updateNode(id: "%s", node: {type: MOBILE name: "Node" pose: {position: ' \
+               '{lat: 34.217970 lon: -83.952380 accuracy: 1.000}}}) { id } }'
+
+    server = _StandInServer(delay)
+    start = time.perf_counter()
+    threads = []
+    failures = []
+    for n in range(num_updates):
+        body = json.dumps({'query': mutation % (n % 6)}).encode('utf-8')
+        thread = threading.Thread(target=_send_once, args=(server.url, body, failures))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    legacy_time = time.perf_counter() - start
+    legacy_connections = len(server.connections)
+    server.stop()
+
+    server = _StandInServer(delay)
+    publisher = Publisher(server.url, workers=workers, queue_size=num_updates)  # Measure throughput, not drops
+    start = time.perf_counter()
+    for n in range(num_updates):
+        publisher.publish(mutation % (n % 6), key=str(n % 6))
+    publisher.flush()
+    pool_time = time.perf_counter() - start
+    stats = publisher.stats()
+    publisher.close()
+    server.stop()
+
+    print("{} updates, {:.1f} ms backend delay".format(num_updates, delay * 1000))
+    print("Thread per mutation: {:.3f} secs, {} threads, {} connections, {} failed".format(
+        legacy_time, num_updates, legacy_connections, len(failures)))
+    print("Publisher:           {:.3f} secs, {} threads, {} connections, {} sent, {} dropped, {} failed, "
+          "{:.1f} ms avg latency ({:.1f} max)".format(
+              pool_time, len(publisher.threads), len(server.connections), stats['sent'], stats['dropped'],
+              stats['failed'], stats['avg_latency'] * 1000, stats['max_latency'] * 1000))
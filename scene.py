@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+import random
+import sys
+import time
+from tkinter import font
+
+#########
+# Scene #
+#########
+# Retained-mode layer over a Tk canvas. Instead of deleting and recreating
+# everything each frame, every logical object drawn between begin_frame() and
+# end_frame() keeps its canvas item, keyed by (kind, ident, occurrence):
+#   - kind: what it is to the display ("node", "node_label", "link", ...)
+#   - ident: a stable ID if there is one (e.g. a node name), else None
+#   - occurrence: how many objects with the same kind and ident came before it
+#     this frame, so objects without an ident are matched by drawing order
+# Items are only touched when they change (coords() or itemconfig() with just the
+# changed options). Objects that aren't drawn in a frame are hidden and their
+# items pooled for reuse by the next object of the same item type and kind, so
+# a reused item only ever had the options of that kind.
+#
+# Options have to be passed the same way every time within a kind, an option
+# that is left out is not reset. Items get the scene's tags unless 'tags' is
+# one of the options. After moving or scaling the items on the canvas directly,
+# call invalidate() so coords are set again on the next frame.
+
+class FontCache:
+    def __init__(self, factory=None):
+        # factory(family, size) makes a font, tkinter.font.Font by default
+        self.factory = factory or (lambda family, size: font.Font(family=family, size=size))
+        self.fonts = {}
+
+    def get(self, family, size):
+        key = (family, size)
+        if key not in self.fonts:
+            self.fonts[key] = self.factory(family, size)
+        return self.fonts[key]
+
+
+class Scene:
+    def __init__(self, canvas, tags=("obj",)):
+        self.canvas = canvas
+        self.tags = tags
+        self.items = {}  # {(kind, ident, occurrence): [item ID, item type, coords, options]}
+        self.pool = {}  # {(item type, kind): [hidden item IDs]}
+        self.occurrences = {}  # {(kind, ident): objects drawn this frame}
+        self.used = set()  # Keys drawn this frame
+
+        # Counters
+        self.created_ctr = 0
+        self.reused_ctr = 0
+        self.moved_ctr = 0
+        self.restyled_ctr = 0
+        self.hidden_ctr = 0
+
+    def begin_frame(self):
+        self.occurrences = {}
+        self.used = set()
+
+    def end_frame(self):
+        # Hides and pools everything that wasn't drawn this frame
+        for key in [key for key in self.items if key not in self.used]:
+            item, item_type, _, _ = self.items.pop(key)
+            self.canvas.itemconfig(item, state='hidden')
+            self.pool.setdefault((item_type, key[0]), []).append(item)
+            self.hidden_ctr += 1
+
+    def clear(self):
+        self.begin_frame()
+        self.end_frame()
+
+    def invalidate(self):
+        for entry in self.items.values():
+            entry[2] = None
+
+    def oval(self, kind, ident, coords, **options):
+        return self.draw('oval', kind, ident, coords, options)
+
+    def line(self, kind, ident, coords, **options):
+        return self.draw('line', kind, ident, coords, options)
+
+    def text(self, kind, ident, coords, **options):
+        return self.draw('text', kind, ident, coords, options)
+
+    def draw(self, item_type, kind, ident, coords, options):
+        occurrence = self.occurrences.get((kind, ident), 0)
+        self.occurrences[(kind, ident)] = occurrence + 1
+        key = (kind, ident, occurrence)
+        self.used.add(key)
+        entry = self.items.get(key)
+        if entry is None:
+            pool = self.pool.get((item_type, kind))
+            if pool:
+                item = pool.pop()
+                self.canvas.coords(item, *coords)
+                self.canvas.itemconfig(item, state='normal', **options)
+                self.reused_ctr += 1
+            else:
+                item = getattr(self.canvas, 'create_' + item_type)(*coords, **dict({'tags': self.tags}, **options))
+                self.created_ctr += 1
+            self.items[key] = [item, item_type, coords, options]
+            return item
+        item, _, old_coords, old_options = entry
+        if coords != old_coords:
+            self.canvas.coords(item, *coords)
+            entry[2] = coords
+            self.moved_ctr += 1
+        if options != old_options:
+            self.canvas.itemconfig(item, **{name: value for name, value in options.items()
+                                            if old_options.get(name) != value})
+            entry[3] = options
+            self.restyled_ctr += 1
+        return item
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            'items': len(self.items),
+            'pooled': sum(len(pool) for pool in self.pool.values()),
+            'created': self.created_ctr,
+            'reused': self.reused_ctr,
+            'moved': self.moved_ctr,
+            'restyled': self.restyled_ctr,
+            'hidden': self.hidden_ctr,
+        }
+
+
+#############
+# Benchmark #
+#############
+# Draws frames of a network where a few nodes move per frame, deleting and
+# recreating every item like EngDisplay used to and through a Scene. Uses a Tk
+# canvas if there is a display, otherwise a stand-in that only counts canvas
+# calls (each one is a round trip into Tcl on a real canvas).
+# Usage: python3 scene.py [num_nodes] [num_frames]
+
+class _CountingCanvas:
+    def __init__(self):
+        self.calls = 0
+        self.next_id = 0
+
+    def _create(self, *args, **kwargs):
+        self.calls += 1
+        self.next_id += 1
+        return self.next_id
+
+    create_oval = create_line = create_text = _create
+
+    def coords(self, *args):
+        self.calls += 1
+
+    def itemconfig(self, *args, **kwargs):
+        self.calls += 1
+
+    def delete(self, *args):
+        self.calls += 1
+
+    def update(self):
+        pass
+
+
+def _draw_frame(canvas, scene, nodes, fonts):
+    # One frame like the display draws it: a circle and label per node, a link and label per neighbour pair
+    label_font = fonts.get('Courier New', 12)
+    if scene is None:
+        canvas.delete('obj')
+    else:
+        scene.begin_frame()
+    for name, (x, y) in nodes:
+        oval = (x - 10, y - 10, x + 10, y + 10)
+        if scene is None:
+            canvas.create_oval(*oval, fill='#fff', outline='', width=3, tags=('obj',))
+            canvas.create_text(x, y - 30, text=name, fill='#fff', font=fonts.get('Courier New', 12), tags=('obj',))
+        else:
+            scene.oval('node', name, oval, fill='#fff', outline='', width=3)
+            scene.text('node_label', name, (x, y - 30), text=name, fill='#fff', font=label_font)
+    for (_, (x1, y1)), (_, (x2, y2)) in zip(nodes, nodes[1:]):
+        label = '{:.0f}'.format(((x1 - x2) ** 2 + (y1 - y2) ** 2) ** 0.5)
+        if scene is None:
+            canvas.create_line(x1, y1, x2, y2, fill='#3c4048', dash=(4, 4), width=2, tags=('obj',))
+            canvas.create_text((x1 + x2) / 2, (y1 + y2) / 2, text=label, fill='#fff',
+                               font=fonts.get('Courier New', 10), tags=('obj',))
+        else:
+            scene.line('link', None, (x1, y1, x2, y2), fill='#3c4048', dash=(4, 4), width=2)
+            scene.text('link_label', None, ((x1 + x2) / 2, (y1 + y2) / 2), text=label, fill='#fff',
+                       font=fonts.get('Courier New', 10))
+    if scene is not None:
+        scene.end_frame()
+    canvas.update()
+
+
+if __name__ == "__main__":
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    num_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+        make_canvas = lambda: tk.Canvas(root, width=800, height=800)
+        real = True
+    except tk.TclError:
+        make_canvas = _CountingCanvas
+        real = False
+
+    results = []
+    for retained in (False, True):
+        random.seed(1)
+        canvas = make_canvas()
+        if real:
+            canvas.pack()
+        scene = Scene(canvas) if retained else None
+        fonts = FontCache(None if real else lambda family, size: (family, size))
+        if not retained:
+            fonts.get = fonts.factory  # The old display made a new Font for every text
+        nodes = [("Node {}".format(n), (random.uniform(0, 800), random.uniform(0, 800))) for n in range(num_nodes)]
+        calls = 0
+        start = time.perf_counter()
+        for frame in range(num_frames):
+            # A tenth of the nodes move each frame
+            for n in random.sample(range(num_nodes), max(1, num_nodes // 10)):
+                name, (x, y) = nodes[n]
+                nodes[n] = (name, (x + random.uniform(-5, 5), y + random.uniform(-5, 5)))
+            _draw_frame(canvas, scene, nodes, fonts)
+        elapsed = time.perf_counter() - start
+        if real:
+            canvas.destroy()
+        results.append((elapsed, getattr(canvas, 'calls', None), scene.stats() if scene else None))
+
+    (legacy_time, legacy_calls, _), (scene_time, scene_calls, stats) = results
+    print("{} nodes, {} frames on a {}".format(num_nodes, num_frames, "Tk canvas" if real else
+                                               "stand-in canvas (no display)"))
+    print("Delete and recreate: {:.2f} ms/frame{}".format(
+        legacy_time / num_frames * 1000, ", {:.0f} canvas calls/frame".format(legacy_calls / num_frames)
+        if legacy_calls is not None else ""))
+    print("Scene:               {:.2f} ms/frame{} ({} items created, {} moves, {} restyles)".format(
+        scene_time / num_frames * 1000, ", {:.0f} canvas calls/frame".format(scene_calls / num_frames)
+        if scene_calls is not None else "", stats['created'], stats['moved'], stats['restyled']))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+import os
+import select
+import stat
+import sys
+import threading
+import time
+import tty
+
+import config
+from packet_decoder import decode_buffer
+
+#################
+# Bulk reader   #
+#################
+# Drains everything that is available from the source in one read, straight
+# into a preallocated buffer, and hands out complete lines (or raw bytes for the
+# binary protocol) as memoryview slices of that buffer.
+#
+# Slices handed out are only valid until the next call to fill(), which may
+# move the trailing partial line to the front of the buffer.
+
+class BulkReader:
+    def __init__(self, src, capacity=1 << 20, log=None, timeout=0.1):
+        self.src = src
+        self.log = log
+        self.timeout = timeout
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.capacity = capacity
+        self.start = 0  # First unconsumed byte
+        self.end = 0  # One past the last byte read
+        self.eof = False
+        self.discard_partial_line = False
+
+        # Sources backed by a file descriptor (serial ports on POSIX, ptys, files)
+        # are read with os.readv, which writes directly into the buffer.
+        try:
+            self.fd = src.fileno()
+        except (AttributeError, OSError, ValueError):
+            self.fd = None
+        # Regular files are always readable, so only wait on ttys/pipes
+        self.is_file = self.fd is not None and stat.S_ISREG(os.fstat(self.fd).st_mode)
+
+        # Stats
+        self.bytes_read = 0
+        self.read_calls = 0
+        self.lines_read = 0
+        self.start_time = time.time()
+
+    def fill(self):
+        # Reads whatever is available (blocking for up to 'timeout' if nothing is).
+        # Returns the number of bytes read, 0 on timeout or at EOF.
+        if self.eof:
+            return 0
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == self.capacity:
+            self._compact()
+
+        if self.fd is not None:
+            if not self.is_file and not select.select([self.fd], [], [], self.timeout)[0]:
+                self._idle()
+                return 0
+            count = os.readv(self.fd, [self.view[self.end:]])
+            self.read_calls += 1
+            if count == 0:
+                self.eof = True
+        else:
+            # Fallback for sources without a file descriptor (e.g. pyserial on Windows)
+            waiting = getattr(self.src, 'in_waiting', None)
+            size = self.capacity - self.end
+            if waiting is not None:
+                size = min(max(waiting, 1), size)
+            data = self.src.read(size)
+            self.read_calls += 1
+            count = len(data)
+            if count == 0 and waiting is None:
+                self.eof = True
+            self.view[self.end:self.end + count] = data
+
+        if count and self.log is not None:
+            self.log.write(self.view[self.end:self.end + count])
+        elif self.log is not None:
+            self._idle()
+        self.end += count
+        self.bytes_read += count
+        return count
+
+    def _idle(self):
+        if self.log is not None:
+            self.log.tick()
+
+    def _compact(self):
+        # Move the partial tail to the front. If the whole buffer is one partial
+        # line it can't be a valid packet, so drop it.
+        if self.start == 0:
+            self.start = self.end = 0
+            self.discard_partial_line = True
+            return
+        tail = self.end - self.start
+        self.view[:tail] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = tail
+
+    def lines(self):
+        # Returns a memoryview over all complete lines in the buffer and marks them
+        # as consumed. Empty if there is no complete line yet.
+        last = self.buffer.rfind(b'\n', self.start, self.end)
+        if last < 0:
+            if self.eof and self.end > self.start:
+                last = self.end - 1  # Unterminated last line of a file
+            else:
+                return self.view[0:0]
+        start = self.start
+        if self.discard_partial_line:
+            first = self.buffer.find(b'\n', start, last + 1)
+            start = first + 1 if first >= 0 else last + 1
+            self.discard_partial_line = False
+        self.lines_read += self.buffer.count(b'\n', start, last + 1)
+        self.start = last + 1
+        return self.view[start:last + 1]
+
+    def consume_to(self, pos):
+        self.start = pos
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+    def stats(self):
+        elapsed = time.time() - self.start_time
+        return {
+            'bytes': self.bytes_read,
+            'reads': self.read_calls,
+            'lines': self.lines_read,
+            'bytes_per_sec': self.bytes_read / elapsed if elapsed > 0 else 0,
+        }
+
+
+#####################
+# Group commit log  #
+#####################
+# Collects raw bytes and writes them to the log file in one go every
+# 'interval' seconds or 'max_bytes' bytes, whichever comes first.
+
+class GroupCommitLog:
+    def __init__(self, file, interval=config.LOG_FLUSH_INTERVAL, max_bytes=config.LOG_FLUSH_BYTES):
+        self.file = file
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.pending = bytearray()
+        self.last_commit = time.time()
+        self.commits = 0
+
+    def write(self, data):
+        self.pending += data
+        if len(self.pending) >= self.max_bytes:
+            self.commit()
+        else:
+            self.tick()
+
+    def tick(self):
+        if self.pending and time.time() - self.last_commit >= self.interval:
+            self.commit()
+
+    def commit(self):
+        self.last_commit = time.time()
+        if not self.pending:
+            return
+        self.file.write(self.pending)
+        self.file.flush()
+        self.pending.clear()
+        self.commits += 1
+
+    def close(self):
+        self.commit()
+        self.file.close()
+
+
+#############
+# Benchmark #
+#############
+# Streams a generated log through a pseudo-terminal and compares the old
+# line-by-line iteration (pyserial style, one read per byte) with BulkReader.
+# Usage: python3 serial_reader.py [size_in_MB]
+
+class _CountingFileIO:
+    def __init__(self, fd):
+        self.fd = fd
+        self.read_calls = 0
+
+    def readline(self):
+        # Same as IOBase.readline without peek(), which is what pyserial does
+        line = bytearray()
+        while True:
+            byte = os.read(self.fd, 1)
+            self.read_calls += 1
+            if not byte:
+                break
+            line += byte
+            if byte == b'\n':
+                break
+        return bytes(line)
+
+
+def _feed_pty(fd, data, chunk=4096):
+    for offset in range(0, len(data), chunk):
+        os.write(fd, data[offset:offset + chunk])
+
+
+def _bench_legacy(data):
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    writer = threading.Thread(target=_feed_pty, args=(master, data))
+    src = _CountingFileIO(slave)
+    line_count = data.count(b'\n')
+    start = time.perf_counter()
+    writer.start()
+    for _ in range(line_count):
+        src.readline()
+    elapsed = time.perf_counter() - start
+    writer.join()
+    os.close(master)
+    os.close(slave)
+    return elapsed, src.read_calls, line_count
+
+
+def _bench_bulk(data):
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    writer = threading.Thread(target=_feed_pty, args=(master, data))
+    reader = BulkReader(os.fdopen(slave, 'rb', buffering=0))
+    packets = 0
+    start = time.perf_counter()
+    writer.start()
+    while reader.bytes_read < len(data):
+        reader.fill()
+        packets += sum(1 for _ in decode_buffer(reader.lines()))
+    elapsed = time.perf_counter() - start
+    writer.join()
+    os.close(master)
+    return elapsed, reader.read_calls, packets
+
+
+if __name__ == "__main__":
+    from packet_decoder import _make_log
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    log_data = ''.join(_make_log(size_mb)).encode('utf-8')
+    for name, bench in (("line iteration", _bench_legacy), ("bulk reader", _bench_bulk)):
+        secs, calls, count = bench(log_data)
+        print("{:<15} {:.3f} secs, {:>12,.0f} bytes/sec, {:>8} reads, {:.3f} reads/packet".format(
+            name, secs, len(log_data) / secs, calls, calls / count))
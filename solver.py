@@ -0,0 +1,230 @@
+from collections import namedtuple
+import importlib
+from multiprocessing import Process, Pipe
+import queue
+import threading
+import time
+
+###################
+# Cycle snapshots #
+###################
+# Everything the algorithm needs from one cycle boundary:
+#   cycle         - Main's (reboot independent) cycle counter
+#   measurements  - [(node_id_1, node_id_2, avg, std), ...] as fed to Node.add_measurement
+#   base_x        - new x position of the calculated base (auto base setup), or None
+
+CycleSnapshot = namedtuple('CycleSnapshot', ['cycle', 'measurements', 'base_x'])
+
+
+def apply_snapshot(nodes, snapshot, calculated_base):
+    # Does to 'nodes' what Main.process_range does to Main.r_nodes at a cycle boundary
+    for node in nodes.values():
+        node.start_new_cycle()
+    for n1, n2, avg, std in snapshot.measurements:
+        nodes[n1].add_measurement(nodes[n2], avg, std=std)
+        nodes[n2].add_measurement(nodes[n1], avg, std=std)
+    if snapshot.base_x is not None:
+        nodes[calculated_base].set_real_x_pos(snapshot.base_x)
+
+
+#######################
+# Algorithm lifecycle #
+#######################
+# Algorithms that implement update(snapshot) and solve(callback, multi_pipe=None,
+# seeds=None) are constructed once and keep their state between cycles. 'seeds'
+# holds the previous solution ({node_id: (x, y)}) to warm-start from. Everything
+# else is constructed and _process()'d from scratch every cycle, as before.
+# Cycles that aren't solved (see change_detector.py) still go through update().
+
+class AlgorithmRunner:
+    def __init__(self, algorithm, nodes, anchored_base, calculated_base):
+        self.algorithm = algorithm
+        self.nodes = nodes
+        self.anchored_base = anchored_base
+        self.calculated_base = calculated_base
+        self.seeds = {}
+        self.persistent = callable(getattr(algorithm, 'update', None)) and callable(getattr(algorithm, 'solve', None))
+        self.instance = algorithm(nodes, anchored_base, calculated_base) if self.persistent else None
+
+    def update(self, snapshot):
+        # 'snapshot' is the CycleSnapshot already applied to the nodes (None before the first one)
+        if self.persistent and snapshot is not None:
+            self.instance.update(snapshot)
+
+    def run(self, snapshot, callback, multi_pipe=None):
+        self.update(snapshot)
+        self.solve(callback, multi_pipe=multi_pipe)
+
+    def solve(self, callback, multi_pipe=None):
+        kwargs = {} if multi_pipe is None else {'multi_pipe': multi_pipe}
+
+        def seeded_callback(nodes, t, n):
+            self.seeds = {node_id: (node.x, node.y) for node_id, node in nodes.items()
+                          if node.is_resolved() and node.x is not None and node.y is not None}
+            callback(nodes, t, n)
+
+        if self.persistent:
+            self.instance.solve(seeded_callback, seeds=self.seeds, **kwargs)
+        else:
+            self.algorithm(self.nodes, self.anchored_base, self.calculated_base)._process(seeded_callback, **kwargs)
+
+
+class MessageRecorder:
+    # Stands in for the display pipe inside the worker; the parent forwards the
+    # recorded messages with the result.
+    def __init__(self):
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append(msg)
+
+    def take(self):
+        messages = self.messages
+        self.messages = []
+        return messages
+
+
+#################
+# Worker side   #
+#################
+
+def _solver_main(conn, alg_name, nodes, anchored_base, calculated_base):
+    alg_module = importlib.import_module('algorithms.' + alg_name + '.' + alg_name)
+    runner = AlgorithmRunner(getattr(alg_module, alg_name), nodes, anchored_base, calculated_base)
+    recorder = MessageRecorder()
+    for node in nodes.values():
+        node.set_pipe(recorder)
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        snapshot, solve = job
+        start = time.perf_counter()
+        apply_snapshot(nodes, snapshot, calculated_base)
+        runner.update(snapshot)
+        if not solve:
+            conn.send((snapshot.cycle, None, [], time.perf_counter() - start))
+            continue
+        results = {}
+
+        def callback(result_nodes, _t, _n):
+            results.update(result_nodes)
+
+        runner.solve(callback, multi_pipe=recorder)
+        messages = recorder.take()
+        conn.send((snapshot.cycle, results, messages, time.perf_counter() - start))
+    conn.close()
+
+
+#################
+# Parent side   #
+#################
+# At most one snapshot is being solved and at most one is waiting. If a new
+# snapshot arrives while one is waiting, the waiting one is stale and replaced:
+# the new one is solved if either of them had to be, and the nodes dirty in
+# either of them are published after it. Snapshots that don't need solving are
+# still sent, so the worker's nodes and algorithm stay up to date.
+
+
+def merge_dirty(dirty_1, dirty_2):
+    # Dirty node IDs of both, None (everything) wins
+    if dirty_1 is None or dirty_2 is None:
+        return None
+    return dirty_1 | dirty_2
+
+
+class SolverWorker:
+    def __init__(self, alg_name, nodes, anchored_base, calculated_base):
+        self.conn, child_conn = Pipe()
+        self.proc = Process(target=_solver_main, args=(child_conn, alg_name, nodes, anchored_base, calculated_base),
+                            daemon=True)
+        self.proc.start()
+        child_conn.close()
+
+        self.lock = threading.Lock()
+        self.busy = False
+        self.pending = None  # (snapshot, solve, dirty) waiting for the worker
+        self.in_flight_dirty = None  # Dirty node IDs of the snapshot being solved
+        self.closing = False
+        self.results = queue.Queue()
+
+        # Counters
+        self.submitted_ctr = 0
+        self.dropped_ctr = 0
+        self.completed_ctr = 0
+        self.solve_time = 0
+
+        self.receiver = threading.Thread(target=self._receive, daemon=True)
+        self.receiver.start()
+
+    def submit(self, snapshot, solve=True, dirty=None):
+        # 'dirty' is handed back with the result, see dispatch_results()
+        with self.lock:
+            self.submitted_ctr += 1
+            if self.busy:
+                if self.pending is not None:
+                    self.dropped_ctr += 1
+                    _, pending_solve, pending_dirty = self.pending
+                    solve = solve or pending_solve
+                    dirty = merge_dirty(dirty, pending_dirty)
+                self.pending = (snapshot, solve, dirty)
+            else:
+                self.busy = True
+                self._send(snapshot, solve, dirty)
+
+    def _send(self, snapshot, solve, dirty):
+        self.in_flight_dirty = dirty
+        self.conn.send((snapshot, solve))
+
+    def _receive(self):
+        while True:
+            try:
+                result = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            cycle, nodes, messages, elapsed = result
+            with self.lock:
+                if nodes is not None:
+                    self.results.put((cycle, nodes, messages, self.in_flight_dirty))
+                    self.completed_ctr += 1
+                    self.solve_time += elapsed
+                if self.pending is not None:
+                    self._send(*self.pending)
+                    self.pending = None
+                else:
+                    self.busy = False
+                    if self.closing:
+                        break
+        self.results.put(None)
+
+    def dispatch_results(self, handler):
+        # Calls handler(cycle, nodes, messages, dirty) for every finished solve. Meant
+        # to be called from the ingest thread so results are published from there.
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if result is not None:
+                handler(*result)
+
+    def close(self, handler=None):
+        # Waits for outstanding solves, publishes them and stops the worker
+        with self.lock:
+            self.closing = True
+            idle = not self.busy
+        if not idle:
+            self.receiver.join()
+        if handler is not None:
+            self.dispatch_results(handler)
+        self.conn.send(None)
+        self.proc.join(timeout=5)
+
+    def stats(self):
+        return {
+            'submitted': self.submitted_ctr,
+            'dropped': self.dropped_ctr,
+            'completed': self.completed_ctr,
+            'avg_solve_time': self.solve_time / self.completed_ctr if self.completed_ctr else 0,
+        }
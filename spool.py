@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import config
+from publisher import GraphQLConnection
+
+#########
+# Spool #
+#########
+# Node updates wait in an SQLite database (WAL mode) until the backend has
+# confirmed them, so nothing is lost while the backend is unreachable. A
+# background thread replays the oldest updates in batches of 'batch_size' (one
+# request each) and backs off exponentially while requests fail. Updates left
+# over from an earlier run are not replayed: Main clears the backend when it
+# starts, which drops them (see clear()).
+#
+# Rows are (node ID, kind, contents), kind being the parts of the node the update
+# sets ('position', 'telemetry' or both). A new update replaces the waiting ones
+# of the same node that it fully covers, so a long outage leaves the latest state
+# per node rather than a backlog. 'clear' rows are sent on their own and drop
+# everything queued before them. Beyond 'max_rows', the oldest rows are dropped.
+
+CLEAR = 'clear'
+_COVERS = {  # Kinds a new update replaces
+    'position': ('position',),
+    'telemetry': ('telemetry',),
+    'position,telemetry': ('position', 'telemetry', 'position,telemetry'),
+}
+
+
+class Spool:
+    def __init__(self, build, path=config.SPOOL_PATH, url=config.BACKEND_URL, max_rows=config.SPOOL_MAX_ROWS,
+                 batch_size=config.SPOOL_BATCH, backoff=config.SPOOL_BACKOFF, timeout=config.PUBLISH_TIMEOUT):
+        # build([(node_id, contents), ...]) returns the mutation for a batch
+        self.build = build
+        self.url = url
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self.min_backoff, self.max_backoff = backoff
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS updates (id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, '
+                        'node_id TEXT, kind TEXT, contents TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS updates_node ON updates (node_id, kind)')
+        self.adds_since_trim = 0
+        self.sending_upto = 0  # Highest row ID in the batch being sent
+        self.wakeup = threading.Event()  # Set when updates are added
+        self.stop = threading.Event()  # Only this one cuts a backoff short
+        self.stopping = False
+        self.backoff = 0
+
+        # Counters
+        self.added_ctr = 0
+        self.compacted_ctr = 0  # Replaced by a newer update of the same node
+        self.trimmed_ctr = 0  # Dropped because the spool was full
+        self.sent_ctr = 0
+        self.request_ctr = 0
+        self.failed_ctr = 0
+
+        self.thread = threading.Thread(target=self._drain, name='spool', daemon=True)
+        self.thread.start()
+
+    def add(self, updates):
+        # [(node_id, kind, contents), ...]
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN')
+            for node_id, kind, contents in updates:
+                covers = _COVERS.get(kind, ())
+                if covers:
+                    # Rows that are being sent stay, they are deleted once the backend confirms them
+                    cursor = self.db.execute('DELETE FROM updates WHERE node_id = ? AND kind IN ({}) AND id > ?'.format(
+                        ','.join('?' * len(covers))), (node_id,) + covers + (self.sending_upto,))
+                    self.compacted_ctr += cursor.rowcount
+                self.db.execute('INSERT INTO updates (created, node_id, kind, contents) VALUES (?, ?, ?, ?)',
+                                (now, node_id, kind, contents))
+            self.adds_since_trim += len(updates)
+            if self.adds_since_trim >= 100:
+                self._trim()
+            self.db.execute('COMMIT')
+            self.added_ctr += len(updates)
+        self.wakeup.set()
+
+    def clear(self, mutation):
+        # Queues 'mutation' (which clears the backend), dropping everything before it
+        with self.lock:
+            self.db.execute('BEGIN')
+            cursor = self.db.execute('DELETE FROM updates')
+            self.compacted_ctr += cursor.rowcount
+            self.db.execute('INSERT INTO updates (created, node_id, kind, contents) VALUES (?, ?, ?, ?)',
+                            (time.time(), '', CLEAR, mutation))
+            self.db.execute('COMMIT')
+        self.wakeup.set()
+
+    def _trim(self):
+        self.adds_since_trim = 0
+        cursor = self.db.execute('DELETE FROM updates WHERE id IN (SELECT id FROM updates ORDER BY id DESC '
+                                 'LIMIT -1 OFFSET ?)', (self.max_rows,))
+        self.trimmed_ctr += cursor.rowcount
+
+    def _next_batch(self):
+        with self.lock:
+            rows = self.db.execute('SELECT id, node_id, kind, contents FROM updates ORDER BY id LIMIT ?',
+                                   (self.batch_size,)).fetchall()
+            if rows and rows[0][2] == CLEAR:
+                batch = rows[:1]
+            else:
+                batch = []
+                for row in rows:
+                    if row[2] == CLEAR:
+                        break
+                    batch.append(row)
+            if not batch:
+                return None
+            self.sending_upto = batch[-1][0]
+        if batch[0][2] == CLEAR:
+            return [batch[0][0]], batch[0][3], 0
+        return [row[0] for row in batch], self.build([(row[1], row[3]) for row in batch]), len(batch)
+
+    def _drain(self):
+        conn = GraphQLConnection(self.url, self.timeout)
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                if self.stopping:
+                    break
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                continue
+            ids, mutation, count = batch
+            self.request_ctr += 1
+            if conn.post(mutation):
+                with self.lock:
+                    self.db.execute('DELETE FROM updates WHERE id IN ({})'.format(','.join('?' * len(ids))), ids)
+                    self.sending_upto = 0
+                self.sent_ctr += count
+                self.backoff = 0
+                continue
+            self.failed_ctr += 1
+            with self.lock:
+                self.sending_upto = 0
+            if self.stopping:
+                break
+            self.backoff = min(self.max_backoff, self.backoff * 2 or self.min_backoff)
+            self.stop.wait(self.backoff)
+        conn.close()
+
+    def flush(self, timeout=None):
+        # Waits until the spool is empty, or for 'timeout' secs. Returns whether it is.
+        end = None if timeout is None else time.time() + timeout
+        while self.pending():
+            if end is not None and time.time() > end:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout=config.SPOOL_CLOSE_TIMEOUT):
+        # Tries to send what is left for up to 'timeout' secs, the rest is dropped by the next run's clear
+        self.flush(timeout)
+        self.stopping = True
+        self.wakeup.set()
+        self.stop.set()
+        self.thread.join()
+        with self.lock:
+            self.final_counts = self._counts()
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.db.close()
+            self.db = None
+
+    def _counts(self):
+        if self.db is None:
+            return self.final_counts
+        return self.db.execute('SELECT COUNT(*), MIN(created) FROM updates').fetchone()
+
+    def pending(self):
+        with self.lock:
+            return self._counts()[0]
+
+    def stats(self):
+        with self.lock:
+            count, oldest = self._counts()
+        return {
+            'spooled': count,
+            'oldest_age': time.time() - oldest if oldest is not None else 0,
+            'added': self.added_ctr,
+            'compacted': self.compacted_ctr,
+            'trimmed': self.trimmed_ctr,
+            'replayed': self.sent_ctr,
+            'replay_requests': self.request_ctr,
+            'replay_failures': self.failed_ctr,
+            'backoff': self.backoff,
+        }
+
+
+#############
+# Benchmark #
+#############
+# Spools node updates while the stand-in backend is down, brings it back up and
+# measures how fast the backlog is replayed.
+# Usage: python3 spool.py [num_cycles] [num_nodes] [batch_size]
+
+if __name__ == "__main__":
+    import tempfile
+    from publisher import _StandInServer
+
+    num_cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    num_nodes = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else config.SPOOL_BATCH
+
+    def build(updates):
+        return 'mutation {\n  %s\n}' % '\n  '.join('n%s: updateNode(id: "%s", node: {%s}) { id }' % (n, n, c)
+                                                   for n, c in updates)
+
+    server = _StandInServer()
+    server.up = False
+    path = os.path.join(tempfile.mkdtemp(), 'spool.db')
+    spool = Spool(build, path=path, url=server.url, batch_size=batch_size, backoff=(0.05, 0.2))
+    start = time.perf_counter()
+    for cycle in range(num_cycles):
+        spool.add([(str(n), 'position', 'pose: {position: {lat: %.6f lon: %.6f accuracy: 1.000}}' % (cycle, n))
+                   for n in range(num_nodes)])
+        if cycle % 10 == 0:
+            spool.add([(str(n), 'telemetry', 'telemetry: {temp: 20.00 batt: 80.00}') for n in range(num_nodes)])
+    add_time = time.perf_counter() - start
+    down_stats = spool.stats()
+    db_size = os.path.getsize(path) + os.path.getsize(path + '-wal')
+
+    # A backlog that doesn't compact (one update each for many nodes) to measure replay
+    for batch in range(num_cycles // 10):
+        spool.add([('%d_%d' % (batch, n), 'position', 'pose: {position: {lat: 1.0 lon: 1.0 accuracy: 1.000}}')
+                   for n in range(num_nodes)])
+    backlog = spool.pending()
+    requests_before = server.requests
+    server.up = True
+    start = time.perf_counter()
+    spool.flush()
+    replay_time = time.perf_counter() - start
+    stats = spool.stats()
+    spool.close()
+    server.stop()
+
+    print("{} cycles of {} nodes spooled while down in {:.3f} secs ({:.0f} updates/sec): "
+          "{} failed requests, {} rows left after compaction, {} KB on disk".format(
+              num_cycles, num_nodes, add_time, down_stats['added'] / add_time, down_stats['replay_failures'],
+              down_stats['spooled'], db_size // 1024))
+    print("Replayed a backlog of {} updates in {:.3f} secs ({:.0f} updates/sec, {} requests of up to {})".format(
+        backlog, replay_time, backlog / replay_time, server.requests - requests_before, batch_size))
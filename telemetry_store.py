@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+import math
+import sys
+import threading
+import time
+
+import numpy
+
+import config
+
+METRICS = ('batt', 'temp', 'heading')
+
+
+###################
+# Telemetry store #
+###################
+# Telemetry of every node in fixed-size NumPy rings, so nothing has to be
+# re-parsed from logs to show a trend and memory stays the same over multi-day
+# runs. Per node there is:
+#   - a ring of the last 'capacity' raw samples (time, cycle and one column per metric)
+#   - for each of 'resolutions' (secs), a ring of 'capacity' buckets with the
+#     count, min, max and sum of every metric, which reach much further back
+# Like CycleHistory, rows are written twice (at i and i + capacity) so the stored
+# window is always one contiguous, time-ordered slice.
+#
+# Queries take an optional [start, end] time range and return copies:
+#   - samples(): raw samples of one metric
+#   - rollup(): min/max/mean per bucket, at any resolution (built from the
+#     coarsest level that is at least as fine, or the raw samples)
+#   - downsample(): 'points' raw samples picked with Largest-Triangle-Three-Buckets,
+#     which keeps the peaks a plot would otherwise lose
+#   - latest(): the newest sample of a node, as a dict
+#
+# add() may be called from one thread while others query.
+
+class _Ring:
+    def __init__(self, dtype, capacity):
+        self.capacity = capacity
+        self.rows = numpy.zeros(2 * capacity, dtype=dtype)
+        self.total = 0  # Number of rows ever added
+
+    def extend(self, block):
+        block = block[-self.capacity:]
+        positions = numpy.arange(self.total, self.total + len(block)) % self.capacity
+        self.rows[positions] = block
+        self.rows[positions + self.capacity] = block
+        self.total += len(block)
+
+    def last(self):
+        return self.rows[(self.total - 1) % self.capacity] if self.total else None
+
+    def replace_last(self, row):
+        pos = (self.total - 1) % self.capacity
+        self.rows[pos] = row
+        self.rows[pos + self.capacity] = row
+
+    def window(self, start=None, end=None):
+        # Rows with start <= time <= end, oldest first (a view)
+        count = min(self.total, self.capacity)
+        begin = (self.total - count) % self.capacity
+        rows = self.rows[begin:begin + count]
+        if start is not None:
+            rows = rows[numpy.searchsorted(rows['time'], start, side='left'):]
+        if end is not None:
+            rows = rows[:numpy.searchsorted(rows['time'], end, side='right')]
+        return rows
+
+
+class _Rollup:
+    # Count, min, max and sum of each metric per 'resolution' secs. The newest
+    # bucket stays open, later blocks of samples are merged into it.
+    def __init__(self, resolution, num_metrics, capacity):
+        self.resolution = resolution
+        self.ring = _Ring([('time', numpy.float64), ('count', numpy.int32), ('min', numpy.float64, (num_metrics,)),
+                           ('max', numpy.float64, (num_metrics,)), ('sum', numpy.float64, (num_metrics,))], capacity)
+
+    def add(self, times, values):
+        # 'values' has one row per sample and one column per metric
+        buckets = numpy.floor(times / self.resolution) * self.resolution
+        last = self.ring.last()
+        if last is not None:
+            buckets = numpy.maximum(buckets, last['time'])  # Late samples go into the newest bucket
+        buckets = numpy.maximum.accumulate(buckets)
+        starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+        rows = numpy.zeros(len(starts), dtype=self.ring.rows.dtype)
+        rows['time'] = buckets[starts]
+        rows['count'] = numpy.diff(numpy.append(starts, len(times)))
+        rows['min'] = numpy.fmin.reduceat(values, starts, axis=0)
+        rows['max'] = numpy.fmax.reduceat(values, starts, axis=0)
+        rows['sum'] = numpy.add.reduceat(values, starts, axis=0)
+        if last is not None and rows['time'][0] == last['time']:
+            merged = rows[0].copy()
+            merged['count'] += last['count']
+            merged['min'] = numpy.fmin(merged['min'], last['min'])
+            merged['max'] = numpy.fmax(merged['max'], last['max'])
+            merged['sum'] += last['sum']
+            self.ring.replace_last(merged)
+            rows = rows[1:]
+        self.ring.extend(rows)
+
+
+class _NodeSeries:
+    # Raw samples and rollups of one node. New samples wait in a list and are
+    # written to all rings in one go when the node is queried (or the list is full).
+    def __init__(self, dtype, metrics, capacity, resolutions):
+        self.metrics = metrics
+        self.samples = _Ring(dtype, capacity)
+        self.rollups = [_Rollup(resolution, len(metrics), capacity) for resolution in resolutions]
+        self.pending = []
+
+    def add(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= self.samples.capacity:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        block = numpy.array(self.pending, dtype=self.samples.rows.dtype)
+        self.pending = []
+        self.samples.extend(block)
+        values = numpy.column_stack([block[metric] for metric in self.metrics])
+        for rollup in self.rollups:
+            rollup.add(block['time'], values)
+
+
+class TelemetryStore:
+    def __init__(self, metrics=METRICS, capacity=config.TELEMETRY_CAPACITY, resolutions=config.TELEMETRY_RESOLUTIONS):
+        self.metrics = metrics
+        self.columns = {metric: i for i, metric in enumerate(metrics)}
+        self.capacity = capacity
+        self.resolutions = sorted(resolutions)
+        self.dtype = numpy.dtype([('time', numpy.float64), ('cycle', numpy.int32)] +
+                                 [(metric, numpy.float64) for metric in metrics])
+        self.series = {}  # {node_id: _NodeSeries}
+        self.lock = threading.Lock()
+
+    def add(self, node_id, cycle, timestamp=None, **values):
+        # Metrics missing from 'values' are stored as NaN
+        if timestamp is None:
+            timestamp = time.time()
+        row = tuple([timestamp, cycle] + [values.get(metric, math.nan) for metric in self.metrics])
+        with self.lock:
+            series = self.series.get(node_id)
+            if series is None:
+                series = self.series[node_id] = _NodeSeries(self.dtype, self.metrics, self.capacity, self.resolutions)
+            series.add(row)
+
+    def _flushed(self, node_id):
+        # The node's _NodeSeries with everything written, None if it has no samples
+        series = self.series.get(node_id)
+        if series is not None:
+            series.flush()
+        return series
+
+    def nodes(self):
+        return list(self.series)
+
+    def latest(self, node_id):
+        # {'time': ..., 'cycle': ..., metric: ...} of the newest sample, None if there is none
+        with self.lock:
+            series = self.series.get(node_id)
+            if series is None:
+                return None
+            if series.pending:
+                return dict(zip(self.dtype.names, series.pending[-1]))
+            row = series.samples.last()
+            return {name: row[name].item() for name in self.dtype.names}
+
+    def samples(self, node_id, metric, start=None, end=None):
+        # (times, cycles, values) of the raw samples
+        with self.lock:
+            series = self._flushed(node_id)
+            if series is None:
+                return numpy.zeros(0), numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0)
+            rows = series.samples.window(start, end)
+            return rows['time'].copy(), rows['cycle'].copy(), rows[metric].copy()
+
+    def rollup(self, node_id, metric, resolution, start=None, end=None):
+        # (bucket start times, mins, maxs, means) per 'resolution' secs
+        column = self.columns[metric]
+        empty = numpy.zeros(0)
+        with self.lock:
+            series = self._flushed(node_id)
+            if series is None:
+                return empty, empty, empty, empty
+            levels = [rollup for rollup in series.rollups if rollup.resolution <= resolution]
+            if levels:
+                rows = levels[-1].ring.window(start, end)
+                times, counts = rows['time'], rows['count']
+                mins, maxs, sums = rows['min'][:, column], rows['max'][:, column], rows['sum'][:, column]
+            else:
+                rows = series.samples.window(start, end)
+                times, counts = rows['time'], numpy.ones(len(rows), dtype=numpy.int32)
+                mins = maxs = sums = rows[metric]
+            if not len(rows):
+                return empty, empty, empty, empty
+            # Merge consecutive rows that fall into the same bucket
+            buckets = numpy.floor(times / resolution)
+            starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+            counts = numpy.add.reduceat(counts, starts)
+            return (buckets[starts] * resolution, numpy.fmin.reduceat(mins, starts),
+                    numpy.fmax.reduceat(maxs, starts), numpy.add.reduceat(sums, starts) / counts)
+
+    def downsample(self, node_id, metric, points, start=None, end=None):
+        # (times, values) of at most 'points' raw samples, picked with LTTB
+        times, _, values = self.samples(node_id, metric, start, end)
+        count = len(times)
+        if count <= points or points < 3:
+            return times, values
+        x = times - times[0]
+        every = (count - 2) / (points - 2)
+        picked = numpy.zeros(points, dtype=numpy.int64)
+        a = 0
+        for i in range(points - 2):
+            # Pick the point of this bucket that makes the largest triangle with the last pick
+            # and the average of the next bucket
+            begin, end = int(i * every) + 1, int((i + 1) * every) + 1
+            next_end = min(int((i + 2) * every) + 1, count)
+            avg_x, avg_y = x[end:next_end].mean(), values[end:next_end].mean()
+            area = numpy.abs((x[a] - avg_x) * (values[begin:end] - values[a]) -
+                             (x[a] - x[begin:end]) * (avg_y - values[a]))
+            a = begin + int(numpy.argmax(area))
+            picked[i + 1] = a
+        picked[-1] = count - 1
+        return times[picked], values[picked]
+
+    def __len__(self):
+        # Raw samples currently stored
+        return sum(min(series.samples.total + len(series.pending), self.capacity) for series in self.series.values())
+
+    def nbytes(self):
+        return sum(series.samples.rows.nbytes + sum(rollup.ring.rows.nbytes for rollup in series.rollups)
+                   for series in self.series.values())
+
+
+#############
+# Benchmark #
+#############
+# Feeds simulated telemetry for a multi-day run and compares memory and queries
+# with keeping every sample in a list.
+# Usage: python3 telemetry_store.py [num_nodes] [hours] [secs_between_samples]
+
+if __name__ == "__main__":
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 48
+    interval = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    num_samples = int(hours * 3600 / interval)
+    numpy.random.seed(1)
+    t0 = 444444 * 3600.0
+    batt = 100 - numpy.linspace(0, 60, num_samples) + numpy.random.normal(0, 0.5, num_samples)
+    temp = 25 + 5 * numpy.sin(numpy.linspace(0, hours / 24 * 2 * math.pi, num_samples))
+    heading = numpy.random.uniform(0, 360, num_samples)
+    batt, temp, heading = batt.tolist(), temp.tolist(), heading.tolist()  # Python floats, like decoded packets
+
+    legacy = {}
+    start = time.perf_counter()
+    for i in range(num_samples):
+        for node in range(num_nodes):
+            legacy.setdefault(str(node), []).append((t0 + i * interval, i, batt[i], temp[i], heading[i]))
+    legacy_add = time.perf_counter() - start
+    legacy_size = sum(sys.getsizeof(samples) + len(samples) * (sys.getsizeof((0.0,) * 5) + 5 * 24)
+                      for samples in legacy.values())
+    start = time.perf_counter()
+    day_start = t0 + (hours - 24) * 3600
+    hourly = {}
+    for sample in legacy['1']:
+        if sample[0] >= day_start:
+            hourly.setdefault(int(sample[0] // 3600), []).append(sample[2])
+    legacy_rollup = [(min(v), max(v), sum(v) / len(v)) for v in hourly.values()]
+    legacy_query = time.perf_counter() - start
+
+    store = TelemetryStore()
+    start = time.perf_counter()
+    for i in range(num_samples):
+        for node in range(num_nodes):
+            store.add(str(node), i, t0 + i * interval, batt=batt[i], temp=temp[i], heading=heading[i])
+    store_add = time.perf_counter() - start
+    start = time.perf_counter()
+    times, mins, maxs, means = store.rollup('1', 'batt', 3600, start=day_start)
+    store_query = time.perf_counter() - start
+    start = time.perf_counter()
+    plot_times, plot_values = store.downsample('1', 'batt', 200)
+    downsample_time = time.perf_counter() - start
+
+    print("{} nodes, {} samples each ({:.0f} hours, one every {:.0f} secs)".format(num_nodes, num_samples, hours,
+                                                                                  interval))
+    print("List of tuples:  {:.3f} secs to add, ~{} KB, hourly rollup of the last day in {:.4f} secs".format(
+        legacy_add, legacy_size // 1024, legacy_query))
+    print("TelemetryStore:  {:.3f} secs to add, {} KB (fixed), hourly rollup of the last day in {:.4f} secs "
+          "({} buckets, max error of the means {:.2g})".format(
+              store_add, store.nbytes() // 1024, store_query, len(times),
+              numpy.abs(means[-len(legacy_rollup):] - [r[2] for r in legacy_rollup]).max()))
+    print("LTTB: {} raw samples down to {} in {:.4f} secs".format(len(store.samples('1', 'batt')[0]),
+                                                                   len(plot_times), downsample_time))
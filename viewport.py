@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import math
+import random
+import sys
+import time
+
+import config
+from scene import FontCache, Scene, _CountingCanvas
+
+############
+# Viewport #
+############
+# Decides per frame what the display draws. update() takes the canvas position
+# and scale (screen px per mm) and computes the visible world rectangle (mm),
+# widened by 'margin' px. Circles and links outside it are culled. Below
+# 'label_scale' px per metre link labels are hidden and links whose ends land in
+# the same 'merge_px' grid cells as an already drawn link (or both in the same
+# one) are merged into it. Below 'point_scale' px per metre nodes are drawn as
+# points of 'point_radius' px instead of their guess circles.
+#
+# Counters are per frame (reset by begin_frame()) and in total.
+
+class Viewport:
+    def __init__(self, margin=config.DISPLAY_CULL_MARGIN, label_scale=config.DISPLAY_LOD_LABELS,
+                 point_scale=config.DISPLAY_LOD_POINTS, merge_px=config.DISPLAY_LOD_MERGE,
+                 point_radius=config.DISPLAY_POINT_RADIUS):
+        self.margin = margin
+        self.label_scale = label_scale
+        self.point_scale = point_scale
+        self.merge_px = merge_px
+        self.point_radius = point_radius
+        self.rect = (-math.inf, -math.inf, math.inf, math.inf)
+        self.scale = 1
+        self.link_labels = True
+        self.points = False
+        self.merge = False
+        self.merged = set()  # Grid cells of the link ends drawn this frame
+        self.counts = self._zero()
+        self.totals = self._zero()
+
+    @staticmethod
+    def _zero():
+        return {'circles': 0, 'links': 0, 'culled': 0, 'merged': 0, 'labels_hidden': 0}
+
+    def update(self, x_pos, y_pos, scale, width, height):
+        # (x_pos, y_pos) is where the world origin is on the canvas
+        self.scale = scale
+        self.rect = ((-self.margin - x_pos) / scale, (-self.margin - y_pos) / scale,
+                     (width + self.margin - x_pos) / scale, (height + self.margin - y_pos) / scale)
+        px_per_m = scale * 1000
+        self.link_labels = px_per_m >= self.label_scale
+        self.merge = not self.link_labels
+        self.points = px_per_m < self.point_scale
+
+    def begin_frame(self):
+        self.merged = set()
+        self.counts = self._zero()
+
+    def _count(self, name):
+        self.counts[name] += 1
+        self.totals[name] += 1
+
+    def circle_visible(self, x, y, r):
+        x0, y0, x1, y1 = self.rect
+        if self.points:
+            r = 0
+        if x + r < x0 or x - r > x1 or y + r < y0 or y - r > y1:
+            self._count('culled')
+            return False
+        self._count('circles')
+        return True
+
+    def link_visible(self, x1, y1, x2, y2):
+        # Whether the link has to be drawn: not outside the view and not merged into another one
+        left, top, right, bottom = self.rect
+        if max(x1, x2) < left or min(x1, x2) > right or max(y1, y2) < top or min(y1, y2) > bottom:
+            self._count('culled')
+            return False
+        if self.merge:
+            cell = self.merge_px / self.scale
+            ends = sorted(((round(x1 / cell), round(y1 / cell)), (round(x2 / cell), round(y2 / cell))))
+            key = (ends[0], ends[1])
+            if key in self.merged or ends[0] == ends[1]:  # The same cell at both ends is under the node
+                self._count('merged')
+                return False
+            self.merged.add(key)
+        self._count('links')
+        if not self.link_labels:
+            self._count('labels_hidden')
+        return True
+
+    def drawn(self):
+        # (primitives drawn, primitives offered) this frame
+        drawn = self.counts['circles'] + self.counts['links']
+        return drawn, drawn + self.counts['culled'] + self.counts['merged']
+
+
+#############
+# Benchmark #
+#############
+# Draws a full-mesh network like the display does (circle and label per node,
+# link and rotated label per pair) through a Scene on a stand-in canvas at
+# several zoom levels, with and without a Viewport, while the view pans.
+# Usage: python3 viewport.py [num_nodes] [num_frames]
+
+def _draw_frame(scene, viewport, nodes, scale, x_pos, y_pos, fonts):
+    scene.begin_frame()
+    if viewport is not None:
+        viewport.update(x_pos, y_pos, scale, 1200, 800)
+        viewport.begin_frame()
+    for name, (x, y, r) in nodes:
+        if viewport is not None and not viewport.circle_visible(x, y, r):
+            continue
+        sx, sy, sr = x * scale + x_pos, y * scale + y_pos, r * scale
+        if viewport is not None and viewport.points:
+            sr = viewport.point_radius
+        scene.oval('node', name, (sx - sr, sy - sr, sx + sr, sy + sr), fill='#fff', outline='', width=3)
+        scene.text('node_label', name, (sx, sy - sr - 20), text=name, fill='#fff', font=fonts.get('Courier New', 12))
+    for i, (name1, (x1, y1, _)) in enumerate(nodes):
+        for name2, (x2, y2, _) in nodes[i + 1:]:
+            if viewport is not None and not viewport.link_visible(x1, y1, x2, y2):
+                continue
+            p1 = (x1 * scale + x_pos, y1 * scale + y_pos)
+            p2 = (x2 * scale + x_pos, y2 * scale + y_pos)
+            if viewport is None or viewport.link_labels:
+                rotation = 180 - math.degrees(math.atan2(p1[1] - p2[1], p1[0] - p2[0]))
+                if 90 < rotation < 270:
+                    rotation -= 180
+                label = '{:.2f}'.format(math.hypot(x1 - x2, y1 - y2) / 1000)
+                scene.text('link_label', name1 + name2, ((p1[0] + p2[0]) / 2, (p1[1] + p2[1]) / 2), text=label,
+                           fill='#fff', font=fonts.get('Courier New', 10), angle=rotation)
+            scene.line('link', name1 + name2, p1 + p2, fill='#3c4048', dash=(1, 5), width=1)
+    scene.end_frame()
+
+
+if __name__ == "__main__":
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    num_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    random.seed(1)
+    # Two sites 2 km apart with nodes spread over 300 m around each (mm)
+    nodes = [("Node {}".format(n), (random.gauss(0, 300000) + 2000000 * (n % 2), random.gauss(0, 300000),
+                                    random.uniform(500, 5000))) for n in range(num_nodes)]
+    fonts = FontCache(lambda family, size: (family, size))
+    print("{} nodes, {} links, {} frames per zoom level on a stand-in canvas (1200x800 px)".format(
+        num_nodes, num_nodes * (num_nodes - 1) // 2, num_frames))
+    for px_per_m in (50, 10, 2, 0.5, 0.1):
+        scale = px_per_m / 1000
+        results = []
+        for culling in (False, True):
+            canvas = _CountingCanvas()
+            scene = Scene(canvas)
+            viewport = Viewport() if culling else None
+            drawn = 0
+            start = time.perf_counter()
+            for frame in range(num_frames):
+                # Centred on the first site, panning a little every frame
+                _draw_frame(scene, viewport, nodes, scale, 600 + frame * 5, 400, fonts)
+                drawn += viewport.drawn()[0] if culling else 0
+            elapsed = time.perf_counter() - start
+            results.append((elapsed / num_frames, canvas.calls / num_frames, drawn / num_frames))
+        (plain_time, plain_calls, _), (cull_time, cull_calls, cull_drawn) = results
+        print("{:>5} px/m: everything {:.2f} ms/frame, {:.0f} canvas calls/frame; culled and LOD {:.2f} ms/frame, "
+              "{:.0f} canvas calls/frame, {:.0f} primitives drawn/frame".format(
+                  px_per_m, plain_time * 1000, plain_calls, cull_time * 1000, cull_calls, cull_drawn))